@@ -0,0 +1,63 @@
+#!/usr/bin/python
+
+'''
+* DESCRIPTION :
+*       Startup time of check_unity.py per transport
+*
+* Runs check_unity.py as Nagios would (a fresh process per check) and prints
+* the wall time of:
+*
+*	help		--help, nothing but argument parsing
+*	<transport>	a check against a closed local port, i.e. interpreter
+*			startup, imports and one failed connect, no array involved
+*	<transport>+array	a real check, when -H/-u/-p are given
+*
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'check_unity.py')
+
+TRANSPORTS = ['requests', 'stdlib']
+
+
+def timeRuns(argv, runs):
+	times = []
+	devnull = open(os.devnull, 'w')
+	for n in range(runs):
+		started = time.time()
+		subprocess.call([sys.executable, PLUGIN] + argv, stdout=devnull, stderr=devnull)
+		times.append(time.time() - started)
+	devnull.close()
+	return sorted(times)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Startup time of check_unity.py per transport")
+	parser.add_argument("-n", "--runs", type=int, default=20, help="Runs per scenario (default: 20)")
+	parser.add_argument("-H", "--hostaddress", type=str, help="Also time real checks against this array")
+	parser.add_argument("-u", "--user", type=str, help="Username for system login")
+	parser.add_argument("-p", "--password", type=str, help="Password for system login")
+	parser.add_argument("-m", "--module", type=str, default='system', help="Module of the real checks (default: system)")
+	args = parser.parse_args()
+
+	scenarios = [('help', ['--help'])]
+	for transport in TRANSPORTS:
+		scenarios.append((transport, ['-H', '127.0.0.1:1', '-u', 'x', '-p', 'x', '-m', 'system', '--retries', '0', '--transport', transport]))
+	if args.hostaddress:
+		for transport in TRANSPORTS:
+			scenarios.append((transport + '+array', ['-H', args.hostaddress, '-u', args.user, '-p', args.password, '-m', args.module, '--transport', transport]))
+
+	print ('%-16s %10s %10s %10s' % ('scenario', 'min ms', 'median ms', 'max ms'))
+	for name, argv in scenarios:
+		times = timeRuns(argv, args.runs)
+		print ('%-16s %10.1f %10.1f %10.1f' % (name, times[0] * 1000, times[len(times) // 2] * 1000, times[-1] * 1000))
+
+
+if __name__ == '__main__':
+	main()
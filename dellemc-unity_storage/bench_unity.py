@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+'''
+* DESCRIPTION :
+*       Throughput/latency benchmark of check_unity.py against mock_unity.py
+*
+* Starts mock_unity.py (options given with --mock) and runs check_unity.py
+* as Nagios would, a fresh process per check, for every execution mode and
+* transport asked for:
+*
+*	per-module	one check per module (-m disk, -m fan, ...), one row each
+*	multi		one check of all modules (-m disk,fan,...), one row
+*
+* For each row it prints checks/sec, p50/p99 latency, peak RSS of a single
+* check process and the number of checks that did not answer OK/WARNING/
+* CRITICAL.
+*
+* Example:
+*	./bench_unity.py --runs 50 --concurrency 8 --mock '--count disk=20000 --latency 20'
+*
+'''
+
+import argparse
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+
+HERE   = os.path.dirname(os.path.abspath(__file__))
+PLUGIN = os.path.join(HERE, 'check_unity.py')
+MOCK   = os.path.join(HERE, 'mock_unity.py')
+
+MODULES = ['battery', 'dae', 'disk', 'dpe', 'ethernetport', 'fan', 'fcport', 'iomodule', 'lcc', 'memorymodule', 'powersupply', 'sasport', 'ssc', 'ssd', 'storageprocessor', 'system', 'uncommittedport']
+
+
+def startMock(options):
+	p = subprocess.Popen([sys.executable, MOCK] + shlex.split(options), stdout=subprocess.PIPE)
+	line = p.stdout.readline().decode('utf-8').strip()
+	if not line.startswith('listening on '):
+		p.kill()
+		raise RuntimeError('mock_unity.py did not start: %s' % line)
+	return p, line[len('listening on '):]
+
+
+## Runs one check process and returns (seconds, exit status, peak RSS in KB).
+#
+def runCheck(argv):
+	devnull = open(os.devnull, 'w')
+	started = time.time()
+	p = subprocess.Popen([sys.executable, PLUGIN] + argv, stdout=devnull, stderr=devnull)
+	pid, status, rusage = os.wait4(p.pid, 0)
+	elapsed = time.time() - started
+	p.returncode = os.WEXITSTATUS(status)
+	devnull.close()
+	return (elapsed, p.returncode, rusage.ru_maxrss)
+
+
+def runChecks(argv, runs, concurrency):
+	results = []
+	lock = threading.Lock()
+	pending = queue.Queue()
+	for n in range(runs):
+		pending.put(n)
+
+	def worker():
+		while True:
+			try:
+				pending.get_nowait()
+			except queue.Empty:
+				return
+			result = runCheck(argv)
+			with lock:
+				results.append(result)
+
+	started = time.time()
+	threads = [threading.Thread(target=worker) for n in range(max(1, min(concurrency, runs)))]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	return (time.time() - started, results)
+
+
+def percentile(values, p):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark check_unity.py against mock_unity.py")
+	parser.add_argument("--runs", type=int, default=20, help="Checks per row (default: 20)")
+	parser.add_argument("--concurrency", type=int, default=4, help="Check processes running at the same time (default: 4)")
+	parser.add_argument("-m", "--module", type=str, default='all', help="Modules, comma separated or 'all' (default: all)")
+	parser.add_argument("--modes", type=str, default='per-module,multi', help="Execution modes: per-module, multi (default: both)")
+	parser.add_argument("--transports", type=str, default='requests,stdlib', help="Transports to compare (default: requests,stdlib)")
+	parser.add_argument("--mock", type=str, default='', help="Options for mock_unity.py, as one string")
+	parser.add_argument("--plugin-args", type=str, default='', help="Extra options for every check_unity.py run, as one string")
+	args = parser.parse_args()
+
+	modules = MODULES if args.module == 'all' else args.module.split(',')
+	mock, hostaddress = startMock(args.mock)
+	try:
+		print ('%-10s %-9s %-18s %9s %9s %9s %9s %7s' % ('mode', 'transport', 'module', 'checks/s', 'p50 ms', 'p99 ms', 'rss MB', 'errors'))
+		for mode in args.modes.split(','):
+			rows = [(module, [module]) for module in modules] if mode == 'per-module' else [('all' if args.module == 'all' else args.module, [','.join(modules)])]
+			for transport in args.transports.split(','):
+				for name, module in rows:
+					argv = ['-H', hostaddress, '-u', 'bench', '-p', 'bench', '-m'] + module + ['--transport', transport] + shlex.split(args.plugin_args)
+					wall, results = runChecks(argv, args.runs, args.concurrency)
+					latencies = [elapsed for elapsed, status, rss in results]
+					print ('%-10s %-9s %-18s %9.1f %9.1f %9.1f %9.1f %7d' % (mode, transport, name,
+						len(results) / wall,
+						percentile(latencies, 50) * 1000,
+						percentile(latencies, 99) * 1000,
+						max([rss for elapsed, status, rss in results]) / 1024.0,
+						len([status for elapsed, status, rss in results if status not in (0, 1, 2)])))
+					sys.stdout.flush()
+	finally:
+		mock.kill()
+		mock.wait()
+
+
+if __name__ == '__main__':
+	main()
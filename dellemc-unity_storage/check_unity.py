@@ -15,9 +15,47 @@
 *
 '''
 
-import json, requests
+import json
 import argparse
+import array
+import atexit
+import base64
+import bisect
+import codecs
+import errno
+import fcntl
+import hashlib
+import heapq
+import os
+import random
+import re
+import select
+import signal
+import socket
+import string
 import sys
+import threading
+import time
+import zlib
+
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+try:
+	import SocketServer as socketserver
+except ImportError:
+	import socketserver
+
+try:
+	from urllib import quote
+except ImportError:
+	from urllib.parse import quote
+
+# requests, sqlite3, configparser, tempfile, the profilers and the stdlib HTTP
+# client and server are imported where they are used, so --help, usage errors
+# and --client checks do not pay for loading them.
 
 
 '''
@@ -65,6 +103,12 @@ def NagiosStatus(value, descid, desc):
 	return False
 
 
+## Nagios exit codes ordered by severity, so that the worst state wins when
+## several components or modules are combined: OK < WARNING < UNKNOWN < CRITICAL.
+#
+NAGIOS_SEVERITY = {0: 0, 1: 1, 3: 2, 2: 3}
+
+
 def EmptyOK():
 	return (5, 'GOT_EMPTY_FROM_UNITY', 'I got no entries in the entries list of HEALTH.')
 
@@ -72,501 +116,3049 @@ def EmptyCouldNotGet():
 	return (0, 'COULD_NOT_REQUEST_URL', 'I could not request the API url')
 
 
-## Information about general settings for the storage system. 
+def EmptyTimedOut():
+	return (0, 'TIMEOUT_BUDGET_EXHAUSTED', 'I ran out of --timeout before the API answered')
+
+
+## CRITICAL (a faulted health value) or UNKNOWN, as asked with --breaker-status.
 #
-def getSystem(hostaddress, token, cookie):
-	baseurl = '/api/types/system/instances'
-	options = '?fields=health,id&per_page=2000&compact=true'
-	requrl  = 'https://'+hostaddress+baseurl+options
-	
-	headers = {'Accept': 'application/json', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache', 'EMC-CSRF-TOKEN': token}
-	
-	ret = 0
-	sta = 0
-	while ((sta != 200) or (ret < 4)):
-		r = requests.get(requrl, headers=headers, verify=False, cookies=cookie)
-		sta = r.status_code
-		ret += 1
+def EmptyCircuitOpen(failures, retry, critical=False):
+	return (25 if critical else 0, 'CIRCUIT_OPEN', 'I did not ask the API after %d failed checks, next try in %ds' % (failures, retry))
+
+
+## Raised when Unity refuses the token/cookie of a (possibly cached) session.
+#
+class SessionExpired(Exception):
+	pass
+
+
+## Raised when the --timeout budget of the run does not leave room for another request.
+#
+class DeadlineExceeded(Exception):
+	pass
+
+
+## Raised by the transports for connection errors and timeouts.
+#
+class TransportError(Exception):
+	pass
+
+
+## Raised for an unexpected HTTP status, which is kept in 'status'.
+#
+class RestError(Exception):
+	def __init__(self, status):
+		Exception.__init__(self, 'HTTP %d' % status)
+		self.status = status
+
+
+## Raised when the state directory could be tampered with by another user.
+#
+class UnsafeStateDir(Exception):
+	pass
+
+
+## Request layer settings, filled in by main(). 'deadline' is the absolute time
+## (time.time()) after which no new request or retry is started.
+#
+REST = {
+	'transport':		'requests',
+	'connect_timeout':	5,
+	'read_timeout':		20,
+	'retries':		2,
+	'backoff':		0.5,
+	'deadline':		None,
+}
+
+# Seconds kept in reserve before the deadline for reporting the result.
+DEADLINE_MARGIN = 1
+
+
+def restHeaders(token=None):
+	headers = {'Accept': 'application/json', 'Accept-Encoding': 'gzip', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache'}
+	if token:
+		headers['EMC-CSRF-TOKEN'] = token
+	return headers
+
+
+## Transports
+#
+# A transport sends one request and returns an object with the parts of a
+# requests.Response the plugin uses: status_code, headers (lower case names),
+# cookies, text, iter_content() and close(). Errors are raised as
+# TransportError.
+#
+# --transport requests sends through one requests.Session per thread, so its
+# connection pool keeps the connections to each array alive for the whole run,
+# like the stdlib transport below. The session's cookie jar is emptied after
+# every request: cookies are passed explicitly, per host and user.
+#
+# python-requests older than 2.4 takes a single timeout, used for connect and
+# read alike; stream= needs 1.0.
+#
+REQUESTS_POOL = threading.local()
+
+
+def requestsTransport(method, hostaddress, url, headers, cookie, timeout, auth=None, data=None, stream=False):
+	import requests
+	if [int(n) for n in re.findall(r'\d+', requests.__version__)[:2]] < [2, 4]:
+		timeout = max(timeout)
+	session = getattr(REQUESTS_POOL, 'session', None)
+	if session is None:
+		session = REQUESTS_POOL.session = requests.Session()
+	try:
+		return session.request(method, 'https://'+hostaddress+url, headers=headers, verify=False, cookies=cookie, timeout=timeout, auth=auth, data=data, stream=stream)
+	except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+		raise TransportError(e)
+	finally:
+		session.cookies.clear()
+
+
+## --transport stdlib: http.client with one keep-alive connection per thread
+## and host, reused by every request of the run. Answers are asked for gzip
+## compressed and decompressed on the fly.
+#
+HTTP_POOL = threading.local()
+
+
+class StdlibResponse(object):
+
+	def __init__(self, conn, resp):
+		self.conn        = conn
+		self.resp        = resp
+		self.status_code = resp.status
+		self.headers     = dict((k.lower(), v) for k, v in resp.getheaders())
+		self.cookies     = {}
+		for k, v in resp.getheaders():
+			if k.lower() == 'set-cookie':
+				name, sep, value = v.split(';', 1)[0].partition('=')
+				self.cookies[name.strip()] = value.strip()
+		if self.headers.get('content-encoding') == 'gzip':
+			self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		else:
+			self.decoder = None
+
+	def iter_content(self, chunk_size=65536):
+		while True:
+			chunk = self.resp.read(chunk_size)
+			if not chunk:
+				break
+			if self.decoder:
+				chunk = self.decoder.decompress(chunk)
+			if chunk:
+				yield chunk
+		if self.decoder:
+			chunk = self.decoder.flush()
+			if chunk:
+				yield chunk
+
+	@property
+	def text(self):
+		if not hasattr(self, '_text'):
+			self._text = b''.join(self.iter_content()).decode('utf-8')
+		return self._text
+
+	def close(self):
+		# A partly read answer leaves the connection unusable for the next request.
+		if not self.resp.isclosed():
+			self.conn.close()
+			HTTP_POOL.conns.pop(self.conn.host_key, None)
+
+
+def stdlibTransport(method, hostaddress, url, headers, cookie, timeout, auth=None, data=None, stream=False):
 	try:
-		j = json.loads(r.text)
-		descid = str(j['entries'][0]['content']['health']['descriptionIds'][0])
-		desc   = str(j['entries'][0]['content']['health']['descriptions'][0])
-		value  = j['entries'][0]['content']['health']['value']
-	except ValueError:
-		value, descid, desc = EmptyCouldNotGet()
+		import http.client as httplib
+	except ImportError:
+		import httplib
+	import ssl
+
+	headers = dict(headers)
+	headers['Accept-Encoding'] = 'gzip'
+	if cookie:
+		headers['Cookie'] = '; '.join('%s=%s' % (k, v) for k, v in dict(cookie).items())
+	if auth:
+		headers['Authorization'] = 'Basic ' + base64.b64encode(('%s:%s' % auth).encode('utf-8')).decode('ascii')
+
+	conns = HTTP_POOL.__dict__.setdefault('conns', {})
+	for attempt in (0, 1):
+		conn = conns.get(hostaddress)
+		reused = conn is not None
+		try:
+			if not reused:
+				conn = httplib.HTTPSConnection(hostaddress, timeout=timeout[0], context=ssl._create_unverified_context())
+				conn.host_key = hostaddress
+				conns[hostaddress] = conn
+			if conn.sock is None:
+				conn.timeout = timeout[0]
+				conn.connect()
+			conn.sock.settimeout(timeout[1])
+			conn.request(method, url, data, headers)
+			resp = conn.getresponse()
+		except (socket.error, httplib.HTTPException) as e:
+			conn.close()
+			conns.pop(hostaddress, None)
+			# The array may have closed an idle keep-alive connection: retry
+			# once on a new one before calling it a failure.
+			if reused and attempt == 0:
+				continue
+			raise TransportError(e)
+
+		r = StdlibResponse(conn, resp)
+		if not stream:
+			r.text
+		return r
+
+
+TRANSPORTS = {
+	'requests':	requestsTransport,
+	'stdlib':	stdlibTransport,
+}
+
+
+## Per-phase timings
+#
+# With --timings or --trace-log, TRACE accounts per module the seconds spent
+# in login(), waiting for answer headers ('request'), waiting for body data
+# ('read'), decoding entries ('parse'), checking their health ('evaluate')
+# and logout(), plus the bytes and entries received. Otherwise TRACE stays
+# None and every hook is a single test.
+#
+TRACE = None
+
+TRACE_PHASES = ['login', 'request', 'read', 'parse', 'evaluate', 'logout']
+
+
+class Trace(object):
+
+	def __init__(self):
+		self.started  = time.time()
+		self.lock     = threading.Lock()
+		self.local    = threading.local()
+		self.counters = {}
+
+	## Counters go to the module run by the current thread (see runModule());
+	## login/logout run outside of any module and are kept under 'session'.
+	#
+	def add(self, counter, amount):
+		key = getattr(self.local, 'module', None) or 'session'
+		with self.lock:
+			counters = self.counters.setdefault(key, {})
+			counters[counter] = counters.get(counter, 0) + amount
+
+	def inModule(self):
+		return getattr(self.local, 'module', None) is not None
+
+	def chunks(self, chunks):
+		while True:
+			started = time.time()
+			chunk = next(chunks, None)
+			self.add('read', time.time() - started)
+			if chunk is None:
+				return
+			self.add('bytes', len(chunk))
+			if PROFILE is not None:
+				PROFILE.sample()
+			yield chunk
+
+	def entries(self, entries):
+		while True:
+			started = time.time()
+			entry = next(entries, None)
+			self.add('fetch', time.time() - started)
+			if entry is None:
+				return
+			self.add('entries', 1)
+			self.local.entries = getattr(self.local, 'entries', 0) + 1
+			started = time.time()
+			yield entry
+			self.add('evaluate', time.time() - started)
+
+	## {module: {phase: seconds, 'bytes': n, 'entries': n}}. 'fetch' covers
+	## everything until an entry is decoded, so parse is what is left of it.
+	#
+	def phases(self):
+		phases = {}
+		with self.lock:
+			for key, counters in self.counters.items():
+				p = dict(counters)
+				if 'fetch' in p:
+					p['parse'] = max(0, p.pop('fetch') - p.get('request', 0) - p.get('read', 0))
+				phases[key] = p
+		return phases
+
+	def totals(self):
+		totals = {}
+		for p in self.phases().values():
+			for counter, amount in p.items():
+				totals[counter] = totals.get(counter, 0) + amount
+		return totals
+
+	def perfdata(self):
+		totals = self.totals()
+		perfdata = [('time_%s' % phase, totals.get(phase, 0), 's', None, None, 0, None) for phase in TRACE_PHASES]
+		perfdata.append(('time_total', time.time() - self.started, 's', None, None, 0, None))
+		perfdata.append(('response_bytes', totals.get('bytes', 0), 'B', None, None, 0, None))
+		perfdata.append(('entries', totals.get('entries', 0), '', None, None, 0, None))
+		return perfdata
+
+	def write(self, path, hosts, modules, status):
+		line = json.dumps({
+			'time':		self.started,
+			'elapsed':	time.time() - self.started,
+			'hosts':	hosts,
+			'modules':	modules,
+			'status':	status,
+			'phases':	self.totals(),
+			'per_module':	self.phases(),
+		}, sort_keys=True) + '\n'
+		# One O_APPEND write per run keeps lines of concurrent checks whole.
+		fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+		try:
+			os.write(fd, line.encode('utf-8'))
+		finally:
+			os.close(fd)
+
+
+## Requests sent per host, and per host and module (REQUEST_MODULE.name, set
+## by runModule()), counted for --request-budget only (None otherwise).
+#
+REQUEST_COUNTS = None
+REQUEST_COUNTS_LOCK = threading.Lock()
+REQUEST_MODULE = threading.local()
 
-	return (value, descid, desc)
 
+def requestCount(hostaddress, module=None):
+	with REQUEST_COUNTS_LOCK:
+		return REQUEST_COUNTS.get((hostaddress, module) if module else hostaddress, 0)
 
-## (Applies to physical deployments only.) Information about batteries in the storage system. 
+
+## Profiling
 #
-def getBattery(hostaddress, token, cookie):
-	baseurl = '/api/types/battery/instances'
-	options = '?fields=health,id&per_page=2000&compact=true'
-	requrl  = 'https://'+hostaddress+baseurl+options
+# With --profile DIR every module runs under its own cProfile and the rest of
+# the run under another one, while tracemalloc
+# (Python 3.4+) follows the allocations of the whole run and keeps a snapshot
+# each time the traced memory reaches a new high while reading responses.
+# DIR receives, all named <time>-<pid>-:
+#
+#	<host>-<module>-<N>entries.prof/.txt	each module, N = entries read
+#	main.prof/.txt				the main thread
+#	alloc.txt				peak memory and the allocation
+#						sites of the highest snapshot
+#
+# The .txt files are sorted by cumulative time; the .prof files are for
+# pstats or any viewer of cProfile output. --profile turns on the --timings
+# counters to know the entry counts.
+#
+# Only one profiler can be active at a time (Python 3.12+ refuses a second
+# one even in another thread), so with --profile modules and arrays are
+# checked one at a time in the main thread, and the main profiler is paused
+# while a module runs under its own.
+#
+PROFILE = None
+
+PROFILE_LINES = 40
+
+
+class Profile(object):
+
+	def __init__(self, directory):
+		import cProfile
+		try:
+			import tracemalloc
+		except ImportError:
+			tracemalloc = None
+
+		self.directory   = directory
+		self.prefix      = os.path.join(directory, '%s-%d-' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+		self.cProfile    = cProfile
+		self.tracemalloc = tracemalloc
+		self.lock        = threading.Lock()
+		self.modules     = []
+		self.high        = 0
+		self.snapshot    = None
+		if tracemalloc is not None:
+			tracemalloc.start()
+		self.main = cProfile.Profile()
+		try:
+			self.main.enable()
+		except ValueError:
+			# Already running under another profiler.
+			self.main = None
+
+	def call(self, hostaddress, module, func, *args):
+		TRACE.local.entries = 0
+		started = time.time()
+		if self.main is not None:
+			self.main.disable()
+		try:
+			profiler = self.cProfile.Profile()
+			profiler.enable()
+		except Exception:
+			# Another profiling tool is active: the module still runs.
+			profiler = None
+		try:
+			return func(*args)
+		finally:
+			if profiler is not None:
+				profiler.disable()
+			if self.main is not None:
+				self.main.enable()
+			tag = '%s-%s-%dentries' % (re.sub(r'[^\w.-]', '_', hostaddress), module, TRACE.local.entries)
+			with self.lock:
+				self.modules.append((tag if profiler is not None else tag + ' (not profiled)', time.time() - started))
+			if profiler is not None:
+				self.dump(profiler, tag)
+
+	## Keeps the allocation sites when traced memory grew by a quarter.
+	def sample(self):
+		if self.tracemalloc is None:
+			return
+		current = self.tracemalloc.get_traced_memory()[0]
+		if current > self.high * 1.25:
+			with self.lock:
+				self.high = current
+				self.snapshot = self.tracemalloc.take_snapshot()
+
+	def dump(self, profiler, tag):
+		import pstats
+		profiler.dump_stats(self.prefix + tag + '.prof')
+		with open(self.prefix + tag + '.txt', 'w') as f:
+			f.write('# %s\n' % tag)
+			pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(PROFILE_LINES)
+
+	def finish(self):
+		if self.main is not None:
+			self.main.disable()
+			self.dump(self.main, 'main')
+		with open(self.prefix + 'alloc.txt', 'w') as f:
+			for tag, elapsed in self.modules:
+				f.write('# %s %.3fs\n' % (tag, elapsed))
+			if self.tracemalloc is None:
+				f.write('# tracemalloc is not available\n')
+				return
+			current, peak = self.tracemalloc.get_traced_memory()
+			f.write('# peak %d KiB, at exit %d KiB, highest snapshot %d KiB\n' % (peak // 1024, current // 1024, self.high // 1024))
+			snapshot = self.snapshot or self.tracemalloc.take_snapshot()
+			for stat in snapshot.statistics('lineno')[:PROFILE_LINES]:
+				f.write('%s\n' % stat)
+
+
+## Every call to the array goes through here. Connection errors, timeouts and
+## 5xx answers of GET and DELETE requests are retried up to REST['retries']
+## times with exponential backoff and full jitter, as long as the deadline
+## allows it. POSTs are sent once: the array may have acted on one whose
+## answer got lost (a second metric query would never be deleted). The last
+## 5xx response is returned to the caller; the last connection error is raised.
+#
+RETRIED_METHODS = ('GET', 'DELETE')
+
+
+def restRequest(method, hostaddress, url, token=None, cookie=None, **kwargs):
+	attempt = 0
+	while True:
+		timeout = (REST['connect_timeout'], REST['read_timeout'])
+		if REST['deadline']:
+			remaining = REST['deadline'] - time.time()
+			if remaining < DEADLINE_MARGIN:
+				raise DeadlineExceeded(url)
+			timeout = (min(timeout[0], remaining), min(timeout[1], remaining))
+
+		if REQUEST_COUNTS is not None:
+			module = getattr(REQUEST_MODULE, 'name', None)
+			with REQUEST_COUNTS_LOCK:
+				REQUEST_COUNTS[hostaddress] = REQUEST_COUNTS.get(hostaddress, 0) + 1
+				if module:
+					REQUEST_COUNTS[(hostaddress, module)] = REQUEST_COUNTS.get((hostaddress, module), 0) + 1
+
+		r = error = None
+		started = time.time()
+		try:
+			r = TRANSPORTS[REST['transport']](method, hostaddress, url, restHeaders(token), cookie, timeout, **kwargs)
+			if r.status_code < 500:
+				return r
+		except TransportError as e:
+			error = e
+		finally:
+			if TRACE is not None and TRACE.inModule():
+				TRACE.add('request', time.time() - started)
+
+		delay = random.uniform(0, REST['backoff'] * (2 ** attempt))
+		if method not in RETRIED_METHODS or attempt >= REST['retries'] or (REST['deadline'] and time.time() + delay + DEADLINE_MARGIN > REST['deadline']):
+			if error is not None:
+				raise error
+			return r
+
+		time.sleep(delay)
+		attempt += 1
+
+
+def restGet(hostaddress, url, token, cookie, stream=False):
+	r = restRequest('GET', hostaddress, url, token, cookie, stream=stream)
+	if r.status_code in (401, 403):
+		raise SessionExpired(r.status_code)
+	return r
+
+
+## Collection settings, filled in by main(). Entries are requested 'page_size'
+## at a time and parsed as they arrive; with 'early_exit' reading stops at the
+## first CRITICAL component instead of looking for the worst one. With
+## 'server_filter' the array only sends the components that are not OK.
+#
+FETCH = {
+	'page_size':		2000,
+	'early_exit':		False,
+	'server_filter':	False,
+}
 
-	headers = {'Accept': 'application/json', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache', 'EMC-CSRF-TOKEN': token}
-	r = requests.get(requrl, headers=headers, verify=False, cookies=cookie)
-	j = json.loads(r.text)
+UNHEALTHY_FILTER = 'health.value ne 5'
 
-	for x in j['entries']:
+ENTRIES_RE = re.compile(r'"entries"\s*:\s*\[')
+ENTRYCOUNT_RE = re.compile(r'"entryCount"\s*:\s*(\d+)')
+SEPARATOR_RE = re.compile(r'[\s,]*')
+
+
+## Yields the objects of the top level "entries" list of a JSON document read
+## from 'chunks' (bytes), without holding more than one chunk plus one entry
+## in memory. An "entryCount" found before the list is stored in 'head'.
+#
+def iterEntries(chunks, head=None):
+	decoder = json.JSONDecoder()
+	text = codecs.getincrementaldecoder('utf-8')()
+	chunks = iter(chunks)
+	buf = ''
+
+	for chunk in chunks:
+		buf += text.decode(chunk)
+		m = ENTRIES_RE.search(buf)
+		if head is not None:
+			n = ENTRYCOUNT_RE.search(buf, 0, m.start() if m else len(buf))
+			if n:
+				head['entryCount'] = int(n.group(1))
+		if m:
+			pos = m.end()
+			break
+		buf = buf[-32:]
+	else:
+		return
+
+	while True:
+		pos = SEPARATOR_RE.match(buf, pos).end()
+		if pos < len(buf):
+			if buf[pos] == ']':
+				return
+			try:
+				entry, pos = decoder.raw_decode(buf, pos)
+			except ValueError:
+				pass
+			else:
+				yield entry
+				continue
+
+		chunk = next(chunks, None)
+		if chunk is None:
+			raise ValueError('truncated entries list')
+		buf = buf[pos:] + text.decode(chunk)
+		pos = 0
+
+
+## Yields the 'content' of every instance of 'resource' (optionally matching
+## the Unity 'filter' expression, sorted by 'orderby', at most 'limit' of
+## them), following Unity's page/per_page pagination until a short page is
+## returned. With 'entrycount' the array also reports the size of the
+## collection, which saves asking for an empty page when it is a multiple of
+## the page size.
+#
+def iterInstances(hostaddress, token, cookie, resource, fields, filter=None, limit=None, entrycount=False, orderby=None):
+	baseurl = '/api/types/%s/instances' % resource
+	per_page = min(FETCH['page_size'], limit or FETCH['page_size'])
+	head = {'entryCount': limit}
+	total = 0
+	page = 1
+	while True:
+		options = '?fields=%s&per_page=%d&page=%d&compact=true' % (fields, per_page, page)
+		if filter:
+			options += '&filter=' + quote(filter)
+		if orderby:
+			options += '&orderby=' + quote(orderby)
+		if entrycount:
+			options += '&with_entrycount=true'
+		r = restGet(hostaddress, baseurl+options, token, cookie, stream=True)
+		try:
+			if r.status_code != 200:
+				raise RestError(r.status_code)
+			count = 0
+			chunks = r.iter_content(65536)
+			if TRACE is not None:
+				chunks = TRACE.chunks(chunks)
+			for x in iterEntries(chunks, head if entrycount else None):
+				count += 1
+				yield x['content']
+			# Read what follows the list, so the connection can be reused.
+			for chunk in chunks:
+				pass
+		finally:
+			r.close()
+		total += count
+		if count < per_page or (head['entryCount'] is not None and total >= head['entryCount']):
+			return
+		page += 1
+
+
+## With --history or --snapshot, the health of every component in a complete
+## walk of a collection is kept in OBSERVED[(hostaddress, module)] =
+## {id: value}, for recordHistory() and recordSnapshot(). A walk cut short
+## (--early-exit) is not recorded.
+#
+OBSERVED = None
+OBSERVED_LOCK = threading.Lock()
+
+
+def observeHealth(hostaddress, resource, entries):
+	if OBSERVED is None:
+		return entries
+	return observedHealth(hostaddress, resource.lower(), entries)
+
+
+def observedHealth(hostaddress, module, entries):
+	components = {}
+	for x in entries:
+		components[x['id']] = x['health']['value']
+		yield x
+	with OBSERVED_LOCK:
+		OBSERVED[(hostaddress, module)] = components
+
+
+## Returns the (value, descid, desc) of the worst health in 'entries', or
+## None when there are none.
+#
+def worstHealth(entries):
+	worst = None
+	if TRACE is not None:
+		entries = TRACE.entries(entries)
+	for x in entries:
 		#print x
-		descid = str(x['content']['health']['descriptionIds'][0])
-		desc   = str(x['content']['health']['descriptions'][0])
-		value  = x['content']['health']['value']
+		# '%s' rather than str(): on Python 2 the descriptions are unicode and
+		# may not be ASCII (localized).
+		descid = '%s' % x['health']['descriptionIds'][0]
+		desc   = '%s' % x['health']['descriptions'][0]
+		value  = x['health']['value']
 		s_nagios, s_msg1, s_msg2, s_val, s_exit = NagiosStatus(value, descid, desc)
-		if (s_nagios != "OK"):
-			return (value, descid, desc)
+		if (worst is None) or (NAGIOS_SEVERITY[s_exit] > worst[0]):
+			worst = (NAGIOS_SEVERITY[s_exit], (value, descid, desc))
+		if FETCH['early_exit'] and (s_nagios == "CRITICAL"):
+			break
+	if worst is None:
+		return None
+	return worst[1]
+
+
+## Walks the health of every instance of 'resource' and returns the
+## (value, descid, desc) of the worst one. An empty collection is OK for
+## 'emptyok' resources and a failed request otherwise.
+#
+## With FETCH['server_filter'] only the components that are not OK are
+## transferred; when there are none, the first component stands for all of
+## them, which is what the full walk would have answered as well.
+#
+def getHealth(hostaddress, token, cookie, resource, emptyok=False):
+	if FETCH['server_filter']:
+		worst = worstHealth(observeHealth(hostaddress, resource, iterInstances(hostaddress, token, cookie, resource, 'health,id', filter=UNHEALTHY_FILTER, entrycount=True)))
+		if worst is None:
+			worst = worstHealth(iterInstances(hostaddress, token, cookie, resource, 'health,id', limit=1))
+	else:
+		worst = worstHealth(observeHealth(hostaddress, resource, iterInstances(hostaddress, token, cookie, resource, 'health,id')))
 
-	return (value, descid, desc)
+	if worst is None:
+		return EmptyOK() if emptyok else EmptyCouldNotGet()
+	return worst
 
 
-## Information about Disk Array Enclosure (DAE) components in the storage system. 
+## Information about general settings for the storage system. 
 #
-def getDae(hostaddress, token, cookie):
-	baseurl = '/api/types/dae/instances'
-	options = '?fields=health,id&per_page=2000&compact=true'
-	requrl  = 'https://'+hostaddress+baseurl+options
+def getSystem(hostaddress, token, cookie):
+	return getHealth(hostaddress, token, cookie, 'system')
 
-	headers = {'Accept': 'application/json', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache', 'EMC-CSRF-TOKEN': token}
-	r = requests.get(requrl, headers=headers, verify=False, cookies=cookie)
-	j = json.loads(r.text)
 
-	for x in j['entries']:
-		#print x
-		descid = str(x['content']['health']['descriptionIds'][0])
-		desc   = str(x['content']['health']['descriptions'][0])
-		value  = x['content']['health']['value']
-		s_nagios, s_msg1, s_msg2, s_val, s_exit = NagiosStatus(value, descid, desc)
-		if (s_nagios != "OK"):
-			return (value, descid, desc)
+## (Applies to physical deployments only.) Information about batteries in the storage system. 
+#
+def getBattery(hostaddress, token, cookie):
+	return getHealth(hostaddress, token, cookie, 'battery')
+
 
-	return (value, descid, desc)
+## Information about Disk Array Enclosure (DAE) components in the storage system. 
+#
+def getDae(hostaddress, token, cookie):
+	return getHealth(hostaddress, token, cookie, 'dae')
 
 
 ## Information about the disks's attributes in the storage system. 
 #
 def getDisk(hostaddress, token, cookie):
-	baseurl = '/api/types/disk/instances'
-	options = '?fields=health,id&per_page=2000&compact=true'
-	requrl  = 'https://'+hostaddress+baseurl+options
-	
-	headers = {'Accept': 'application/json', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache', 'EMC-CSRF-TOKEN': token}
-	r = requests.get(requrl, headers=headers, verify=False, cookies=cookie)
-	j = json.loads(r.text)
-
-	for x in j['entries']:
-		#print x
-		descid = str(x['content']['health']['descriptionIds'][0])
-		desc   = str(x['content']['health']['descriptions'][0])
-		value  = x['content']['health']['value']
-		s_nagios, s_msg1, s_msg2, s_val, s_exit = NagiosStatus(value, descid, desc)
-		if (s_nagios != "OK"):
-			return (value, descid, desc)
-
-	return (value, descid, desc)
+	return getHealth(hostaddress, token, cookie, 'disk')
 
 
 ## Information about Disk Processor Enclosures (DPEs) in the storage system. 
 #
 def getDpe(hostaddress, token, cookie):
-	baseurl = '/api/types/dpe/instances'
-	options = '?fields=health,id&per_page=2000&compact=true'
-	requrl  = 'https://'+hostaddress+baseurl+options
+	return getHealth(hostaddress, token, cookie, 'dpe')
 
-	headers = {'Accept': 'application/json', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache', 'EMC-CSRF-TOKEN': token}
-	r = requests.get(requrl, headers=headers, verify=False, cookies=cookie)
-	j = json.loads(r.text)
 
-	descid = str(j['entries'][0]['content']['health']['descriptionIds'][0])
-	desc   = str(j['entries'][0]['content']['health']['descriptions'][0])
-	value  = j['entries'][0]['content']['health']['value']
+## Information about Ethernet ports in the storage system. 
+#
+def getEthernetport(hostaddress, token, cookie):
+	return getHealth(hostaddress, token, cookie, 'ethernetPort')
 
-	return (value, descid, desc)
 
+## (Applies to physical deployments only.) Information about the fans in the storage system.
+#
+def getFan(hostaddress, token, cookie):
+	return getHealth(hostaddress, token, cookie, 'fan')
 
-## Information about Ethernet ports in the storage system. 
+
+## Fibre Channel (FC) front end port settings. Applies if the FC protocol is supported on the system and the corresponding license is installed.
 #
-def getEthernetport(hostaddress, token, cookie):
-	baseurl = '/api/types/ethernetPort/instances'
-	options = '?fields=health,id&per_page=2000&compact=true'
-	requrl  = 'https://'+hostaddress+baseurl+options
+def getFcport(hostaddress, token, cookie):
+	return getHealth(hostaddress, token, cookie, 'fcPort')
 
-	headers = {'Accept': 'application/json', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache', 'EMC-CSRF-TOKEN': token}
-	r = requests.get(requrl, headers=headers, verify=False, cookies=cookie)
-	j = json.loads(r.text)
 
-	for x in j['entries']:
-		#print x
-		descid = str(x['content']['health']['descriptionIds'][0])
-		desc   = str(x['content']['health']['descriptions'][0])
-		value  = x['content']['health']['value']
-		s_nagios, s_msg1, s_msg2, s_val, s_exit = NagiosStatus(value, descid, desc)
-		if (s_nagios != "OK"):
-			return (value, descid, desc)
+## (Applies to physical deployments only.) Information about I/O module SLICs (small I/O cards) in the storage system. I/O modules provide connectivity between SPs and Disk-Array Enclosures (DAEs). 
+#
+def getIomodule(hostaddress, token, cookie):
+	return getHealth(hostaddress, token, cookie, 'ioModule')
 
-	return (value, descid, desc)
 
+## (Applies to physical deployments only.) Information about Link Control Cards (LCCs) in the storage system. 
+#
+def getLcc(hostaddress, token, cookie):
+	return getHealth(hostaddress, token, cookie, 'lcc')
 
-## (Applies to physical deployments only.) Information about the fans in the storage system.
+
+## (Applies to physical deployments only.) Information about memory modules in the storage system.
 #
-def getFan(hostaddress, token, cookie):
-	baseurl = '/api/types/fan/instances'
-	options = '?fields=health,id&per_page=2000&compact=true'
-	requrl  = 'https://'+hostaddress+baseurl+options
+def getMemorymodule(hostaddress, token, cookie):
+	return getHealth(hostaddress, token, cookie, 'memoryModule')
 
-	headers = {'Accept': 'application/json', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache', 'EMC-CSRF-TOKEN': token}
-	r = requests.get(requrl, headers=headers, verify=False, cookies=cookie)
-	j = json.loads(r.text)
 
-	for x in j['entries']:
-		#print x
-		descid = str(x['content']['health']['descriptionIds'][0])
-		desc   = str(x['content']['health']['descriptions'][0])
-		value  = x['content']['health']['value']
-		s_nagios, s_msg1, s_msg2, s_val, s_exit = NagiosStatus(value, descid, desc)
-		if (s_nagios != "OK"):
-			return (value, descid, desc)
+## (Applies to physical deployments only.) Information about power supplies in the storage system.
+#
+def getPowersupply(hostaddress, token, cookie):
+	return getHealth(hostaddress, token, cookie, 'powerSupply')
 
-	return (value, descid, desc)
 
+## (Applies to physical deployments only.) Information about Serial Attached SCSI (SAS) ports in the storage system. 
+#
+def getSasport(hostaddress, token, cookie):
+	return getHealth(hostaddress, token, cookie, 'sasPort')
 
-## Fibre Channel (FC) front end port settings. Applies if the FC protocol is supported on the system and the corresponding license is installed.
+
+## (Applies to physical deployments only.) Information about System Status Cards (SSCs) in the storage system. 
 #
-def getFcport(hostaddress, token, cookie):
-	baseurl = '/api/types/fcPort/instances'
-	options = '?fields=health,id&per_page=2000&compact=true'
-	requrl  = 'https://'+hostaddress+baseurl+options
+def getSsc(hostaddress, token, cookie):
+	return getHealth(hostaddress, token, cookie, 'ssc', emptyok=True)
 
-	headers = {'Accept': 'application/json', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache', 'EMC-CSRF-TOKEN': token}
-	r = requests.get(requrl, headers=headers, verify=False, cookies=cookie)
-	j = json.loads(r.text)
 
-	for x in j['entries']:
-		#print x
-		descid = str(x['content']['health']['descriptionIds'][0])
-		desc   = str(x['content']['health']['descriptions'][0])
-		value  = x['content']['health']['value']
-		s_nagios, s_msg1, s_msg2, s_val, s_exit = NagiosStatus(value, descid, desc)
-		if (s_nagios != "OK"):
-			return (value, descid, desc)
+## (Applies to physical deployments only.) Information about internal Flash-based Solid State Disks (SSDs, mSATAs) in the storage system. 
+#
+def getSsd(hostaddress, token, cookie):
+	return getHealth(hostaddress, token, cookie, 'ssd')
+
 
-	return (value, descid, desc)
+## Information about Storage Processors (SPs) in the storage system.
+#
+def getStorageprocessor(hostaddress, token, cookie):
+	return getHealth(hostaddress, token, cookie, 'storageProcessor')
 
 
-## (Applies to physical deployments only.) Information about I/O module SLICs (small I/O cards) in the storage system. I/O modules provide connectivity between SPs and Disk-Array Enclosures (DAEs). 
+## (Applies to physical deployments only.) Information about Uncommitted ports in the storage system.
 #
-def getIomodule(hostaddress, token, cookie):
-	baseurl = '/api/types/ioModule/instances'
-	options = '?fields=health,id&per_page=2000&compact=true'
-	requrl  = 'https://'+hostaddress+baseurl+options
+def getUncommittedport(hostaddress, token, cookie):
+	return getHealth(hostaddress, token, cookie, 'uncommittedPort', emptyok=True)
+
+
+def logout(hostaddress, token, cookie):
+	baseurl = '/api/types/loginSessionInfo/action/logout'
 
-	headers = {'Accept': 'application/json', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache', 'EMC-CSRF-TOKEN': token}
-	r = requests.get(requrl, headers=headers, verify=False, cookies=cookie)
+	payload = {'localCleanupOnly': 'true'}
+	started = time.time()
+	try:
+		r = restRequest('POST', hostaddress, baseurl, token, cookie, data=json.dumps(payload))
+	finally:
+		if TRACE is not None:
+			TRACE.add('logout', time.time() - started)
 	j = json.loads(r.text)
+	return j['logout']
 
-	for x in j['entries']:
-		#print x
-		descid = str(x['content']['health']['descriptionIds'][0])
-		desc   = str(x['content']['health']['descriptions'][0])
-		value  = x['content']['health']['value']
-		s_nagios, s_msg1, s_msg2, s_val, s_exit = NagiosStatus(value, descid, desc)
-		if (s_nagios != "OK"):
-			return (value, descid, desc)
 
-	return (value, descid, desc)
+def login(hostaddress, user, password):
+	baseurl = '/api/types/loginSessionInfo'
 
+	started = time.time()
+	try:
+		r = restRequest('GET', hostaddress, baseurl, auth=(user, password))
+	except (TransportError, DeadlineExceeded):
+		return (0, 0)
+	finally:
+		if TRACE is not None:
+			TRACE.add('login', time.time() - started)
 
-## (Applies to physical deployments only.) Information about Link Control Cards (LCCs) in the storage system. 
+	if r.status_code == 200:
+		token  = r.headers['emc-csrf-token']
+		cookie = r.cookies
+	else:
+		token  = 0
+		cookie = 0
+
+	return (token, cookie)
+
+
+## Session cache
 #
-def getLcc(hostaddress, token, cookie):
-	baseurl = '/api/types/lcc/instances'
-	options = '?fields=health,id&per_page=2000&compact=true'
-	requrl  = 'https://'+hostaddress+baseurl+options
+# With --session-cache the CSRF token and cookies of a login are kept in
+# <state-dir>/session-<sha1>.json (one file per host/user, mode 0600) for
+# --session-ttl seconds, so later runs skip login() and logout(). An exclusive
+# lock on the matching .lock file serializes logins, so overlapping checks
+# reuse the same session instead of each opening a new one on the array.
+#
+def stateFile(statedir, prefix, *key):
+	digest = hashlib.sha1('\0'.join(key).encode('utf-8')).hexdigest()
+	return os.path.join(statedir, '%s-%s' % (prefix, digest))
 
-	headers = {'Accept': 'application/json', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache', 'EMC-CSRF-TOKEN': token}
-	r = requests.get(requrl, headers=headers, verify=False, cookies=cookie)
-	j = json.loads(r.text)
 
-	for x in j['entries']:
-		#print x
-		descid = str(x['content']['health']['descriptionIds'][0])
-		desc   = str(x['content']['health']['descriptions'][0])
-		value  = x['content']['health']['value']
-		s_nagios, s_msg1, s_msg2, s_val, s_exit = NagiosStatus(value, descid, desc)
-		if (s_nagios != "OK"):
-			return (value, descid, desc)
+## Creates statedir (mode 0700) if needed. Unless 'private' is False it must
+## then be a real directory owned by the current user and not writable by
+## anyone else, as it holds session tokens: in a shared /var/tmp another user
+## could have created it first.
+#
+def makeStateDir(statedir, private=True):
+	try:
+		os.makedirs(statedir, 0o700)
+	except OSError as e:
+		if e.errno != errno.EEXIST:
+			raise
+	if private:
+		checkStateDir(statedir)
+
+
+def checkStateDir(statedir):
+	if os.path.islink(statedir) or not os.path.isdir(statedir):
+		raise UnsafeStateDir('%s is not a directory' % statedir)
+	st = os.stat(statedir)
+	if st.st_uid != os.geteuid():
+		raise UnsafeStateDir('%s is owned by uid %d, not %d' % (statedir, st.st_uid, os.geteuid()))
+	if st.st_mode & 0o022:
+		raise UnsafeStateDir('%s is writable by group or others (mode %04o)' % (statedir, st.st_mode & 0o7777))
+
+
+def writeStateFile(path, data):
+	tmp = '%s.%d.tmp' % (path, os.getpid())
+	fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+	try:
+		os.write(fd, json.dumps(data).encode('utf-8'))
+	finally:
+		os.close(fd)
+	os.rename(tmp, path)
 
-	return (value, descid, desc)
 
+def readStateFile(path):
+	try:
+		with open(path) as f:
+			return json.load(f)
+	except (IOError, OSError, ValueError):
+		return None
 
-## (Applies to physical deployments only.) Information about memory modules in the storage system.
+
+## Takes an exclusive lock on path.lock. With a deadline the lock is polled
+## and None is returned if it is still held by someone else at that time.
 #
-def getMemorymodule(hostaddress, token, cookie):
-	baseurl = '/api/types/memoryModule/instances'
-	options = '?fields=health,id&per_page=2000&compact=true'
-	requrl  = 'https://'+hostaddress+baseurl+options
+def lockStateFile(path, deadline=None):
+	fd = os.open(path + '.lock', os.O_WRONLY | os.O_CREAT, 0o600)
+	if deadline is None:
+		fcntl.flock(fd, fcntl.LOCK_EX)
+		return fd
+	while True:
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			return fd
+		except (IOError, OSError) as e:
+			if e.errno not in (errno.EAGAIN, errno.EACCES):
+				raise
+		if time.time() >= deadline:
+			os.close(fd)
+			return None
+		time.sleep(0.05)
+
+
+def unlockStateFile(fd):
+	fcntl.flock(fd, fcntl.LOCK_UN)
+	os.close(fd)
+
+
+## Returns (token, cookie, cached) for hostaddress/user. A cached session is
+## returned while its TTL lasts, unless it is the 'stale' token the caller just
+## got a 401/403 for. Expired sessions are logged out before logging in again.
+#
+def getSession(statedir, ttl, hostaddress, user, password, stale=None):
+	makeStateDir(statedir)
+	path = stateFile(statedir, 'session', hostaddress, user) + '.json'
+	lock = lockStateFile(path)
+	try:
+		now = time.time()
+		session = readStateFile(path)
+		if session and session.get('token') != stale:
+			if session.get('expires', 0) > now:
+				return (session['token'], session['cookie'], True)
+			try:
+				logout(hostaddress, session['token'], session['cookie'])
+			except Exception:
+				pass
+
+		token, cookie = login(hostaddress, user, password)
+		if token and cookie:
+			writeStateFile(path, {'token': token, 'cookie': dict(cookie), 'expires': now + ttl})
+		elif session:
+			os.unlink(path)
+		return (token, cookie, False)
+	finally:
+		unlockStateFile(lock)
+
+
+## Real-time metrics
+#
+# Metric modules create a metricRealTimeQuery on the array once and keep its
+# id, together with the timestamp and values of the last sample read, in
+# <state-dir>/metricquery-<sha1>.json. Later runs only read the
+# metricQueryResult samples newer than that timestamp. Queries expire on the
+# array when nobody reads them: when reading fails, or there has been no new
+# sample for three intervals and the query instance itself is gone (404), a new
+# query is created. A query that is replaced, or was created with another
+# --metric-interval, is deleted first so they do not pile up on the array.
+#
+# module: (paths, unit, how values of one object are combined across paths
+# and SPs, default warning, default critical, description)
+#
+METRICS = {
+	'spcpu':	(['sp.*.cpu.summary.utilization'], '%', max, 80, 90, 'SP CPU utilization'),
+	'luniops':	(['sp.*.storage.lun.*.readsRate', 'sp.*.storage.lun.*.writesRate'], '', sum, None, None, 'LUN IOPS'),
+	'lunlatency':	(['sp.*.storage.lun.*.responseTime'], 'us', max, 20000, 50000, 'LUN response time'),
+}
 
-	headers = {'Accept': 'application/json', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache', 'EMC-CSRF-TOKEN': token}
-	r = requests.get(requrl, headers=headers, verify=False, cookies=cookie)
-	j = json.loads(r.text)
+# Metric settings, filled in by main(). 'warning'/'critical' override the
+# module defaults above; 'state_dir' also holds the state of the trend and
+# alert modules.
+METRIC = {
+	'state_dir':	'/var/tmp/check_unity',
+	'interval':	60,
+	'warning':	None,
+	'critical':	None,
+}
 
-	for x in j['entries']:
-		#print x
-		descid = str(x['content']['health']['descriptionIds'][0])
-		desc   = str(x['content']['health']['descriptions'][0])
-		value  = x['content']['health']['value']
-		s_nagios, s_msg1, s_msg2, s_val, s_exit = NagiosStatus(value, descid, desc)
-		if (s_nagios != "OK"):
-			return (value, descid, desc)
+# Above this many objects only max/avg/total are reported as perfdata.
+METRIC_PERF_OBJECTS = 4
 
-	return (value, descid, desc)
 
+def perfNumber(value):
+	return ('%.3f' % value).rstrip('0').rstrip('.')
 
-## (Applies to physical deployments only.) Information about power supplies in the storage system.
+
+## perfdata is a list of (label, value, uom, warning, critical, min, max).
 #
-def getPowersupply(hostaddress, token, cookie):
-	baseurl = '/api/types/powerSupply/instances'
-	options = '?fields=health,id&per_page=2000&compact=true'
-	requrl  = 'https://'+hostaddress+baseurl+options
+def formatPerfdata(perfdata):
+	items = []
+	for label, value, uom, warning, critical, low, high in perfdata:
+		thresholds = ';'.join([perfNumber(v) if v is not None else '' for v in (warning, critical, low, high)])
+		items.append(("'%s'=%s%s;%s" % (label, perfNumber(value), uom, thresholds)).rstrip(';'))
+	return ' '.join(items)
 
-	headers = {'Accept': 'application/json', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache', 'EMC-CSRF-TOKEN': token}
-	r = requests.get(requrl, headers=headers, verify=False, cookies=cookie)
-	j = json.loads(r.text)
 
-	for x in j['entries']:
-		#print x
-		descid = str(x['content']['health']['descriptionIds'][0])
-		desc   = str(x['content']['health']['descriptions'][0])
-		value  = x['content']['health']['value']
-		s_nagios, s_msg1, s_msg2, s_val, s_exit = NagiosStatus(value, descid, desc)
-		if (s_nagios != "OK"):
-			return (value, descid, desc)
+def createMetricQuery(hostaddress, token, cookie, paths, interval):
+	baseurl = '/api/types/metricRealTimeQuery/instances'
 
-	return (value, descid, desc)
+	payload = {'paths': paths, 'interval': interval}
+	r = restRequest('POST', hostaddress, baseurl, token, cookie, data=json.dumps(payload))
+	if r.status_code in (401, 403):
+		raise SessionExpired(r.status_code)
+	if r.status_code not in (200, 201):
+		raise RestError(r.status_code)
+	return json.loads(r.text)['content']['id']
 
 
-## (Applies to physical deployments only.) Information about Serial Attached SCSI (SAS) ports in the storage system. 
+## Returns False when metric query 'id' no longer exists on the array.
 #
-def getSasport(hostaddress, token, cookie):
-	baseurl = '/api/types/sasPort/instances'
-	options = '?fields=health,id&per_page=2000&compact=true'
-	requrl  = 'https://'+hostaddress+baseurl+options
+def metricQueryExists(hostaddress, token, cookie, id):
+	r = restGet(hostaddress, '/api/instances/metricRealTimeQuery/%d?fields=id' % id, token, cookie)
+	if r.status_code == 404:
+		return False
+	if r.status_code != 200:
+		raise RestError(r.status_code)
+	return True
 
-	headers = {'Accept': 'application/json', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache', 'EMC-CSRF-TOKEN': token}
-	r = requests.get(requrl, headers=headers, verify=False, cookies=cookie)
-	j = json.loads(r.text)
 
-	for x in j['entries']:
-		#print x
-		descid = str(x['content']['health']['descriptionIds'][0])
-		desc   = str(x['content']['health']['descriptions'][0])
-		value  = x['content']['health']['value']
-		s_nagios, s_msg1, s_msg2, s_val, s_exit = NagiosStatus(value, descid, desc)
-		if (s_nagios != "OK"):
-			return (value, descid, desc)
+## Deletes metric query 'id'; one that is already gone is not an error.
+#
+def deleteMetricQuery(hostaddress, token, cookie, id):
+	r = restRequest('DELETE', hostaddress, '/api/instances/metricRealTimeQuery/%d' % id, token, cookie)
+	if r.status_code in (401, 403):
+		raise SessionExpired(r.status_code)
+	if r.status_code not in (200, 204, 404):
+		raise RestError(r.status_code)
 
-	return (value, descid, desc)
 
+## Returns {object: value} of the newest sample of query 'id' after 'since',
+## combining the values of each object (LUN, or SP) over paths and SPs, and
+## the timestamp of that sample. ({}, since) when there is nothing new.
+#
+def readMetricQuery(hostaddress, token, cookie, id, since, combine):
+	filter = 'queryId eq %d' % id
+	if since:
+		filter += ' and timestamp gt "%s"' % since
+
+	latest = since
+	samples = {}
+	for x in iterInstances(hostaddress, token, cookie, 'metricQueryResult', 'queryId,path,timestamp,values', filter):
+		if (not latest) or (x['timestamp'] > latest):
+			latest = x['timestamp']
+			samples = {}
+		if x['timestamp'] == latest:
+			samples[x['path']] = x['values']
+
+	values = {}
+	for path, sample in samples.items():
+		for sp, v in sample.items():
+			for obj, value in (v.items() if isinstance(v, dict) else [(sp, v)]):
+				values.setdefault(obj, []).append(value)
+	return (dict((obj, combine(v)) for obj, v in values.items()), latest)
+
+
+def getMetric(hostaddress, token, cookie, module):
+	paths, unit, combine, warning, critical, what = METRICS[module]
+	if METRIC['warning'] is not None:
+		warning = METRIC['warning']
+	if METRIC['critical'] is not None:
+		critical = METRIC['critical']
+
+	makeStateDir(METRIC['state_dir'])
+	path = stateFile(METRIC['state_dir'], 'metricquery', hostaddress, module) + '.json'
+	lock = lockStateFile(path)
+	try:
+		now = time.time()
+		state = readStateFile(path) or {}
+		stale = gone = False
+		if state.get('id') and state.get('interval') != METRIC['interval']:
+			stale = True
+		elif state.get('id'):
+			try:
+				values, latest = readMetricQuery(hostaddress, token, cookie, state['id'], state.get('timestamp'), combine)
+			except RestError:
+				stale = True
+			else:
+				if values:
+					state.update({'values': values, 'timestamp': latest, 'sampled': now})
+				elif now - state.get('sampled', now) >= 3 * state['interval']:
+					stale = gone = not metricQueryExists(hostaddress, token, cookie, state['id'])
+
+		if stale and not gone:
+			try:
+				deleteMetricQuery(hostaddress, token, cookie, state['id'])
+			except (RestError, TransportError):
+				pass
+		if stale or not state.get('id'):
+			interval = METRIC['interval']
+			state = {'id': createMetricQuery(hostaddress, token, cookie, paths, interval), 'interval': interval, 'sampled': now}
+		writeStateFile(path, state)
+	finally:
+		unlockStateFile(lock)
+
+	values = state.get('values')
+	if not values:
+		return (0, 'METRIC_QUERY_PENDING', 'Waiting for the first sample of metric query %d' % state['id'], [])
+
+	worst = max(values, key=values.get)
+	top = values[worst]
+	if critical is not None and top >= critical:
+		value = 25
+	elif warning is not None and top >= warning:
+		value = 10
+	else:
+		value = 5
 
-## (Applies to physical deployments only.) Information about System Status Cards (SSCs) in the storage system. 
+	high = 100 if unit == '%' else None
+	if len(values) <= METRIC_PERF_OBJECTS:
+		perfdata = [('%s_%s' % (module, obj), values[obj], unit, warning, critical, 0, high) for obj in sorted(values)]
+	else:
+		perfdata = [
+			('%s_max' % module, top, unit, warning, critical, 0, high),
+			('%s_avg' % module, sum(values.values()) / len(values), unit, None, None, 0, high),
+			('%s_total' % module, sum(values.values()), unit, None, None, 0, None),
+		]
+
+	descid = 'METRIC_%s_%s' % (module.upper(), NagiosStatus(value, '', '')[0])
+	desc   = '%s max %s%s on %s (%d objects at %s)' % (what, perfNumber(top), unit, worst, len(values), state['timestamp'])
+	return (value, descid, desc, perfdata)
+
+
+def getSpcpu(hostaddress, token, cookie):
+	return getMetric(hostaddress, token, cookie, 'spcpu')
+
+
+def getLuniops(hostaddress, token, cookie):
+	return getMetric(hostaddress, token, cookie, 'luniops')
+
+
+def getLunlatency(hostaddress, token, cookie):
+	return getMetric(hostaddress, token, cookie, 'lunlatency')
+
+
+## Metric trends
 #
-def getSsc(hostaddress, token, cookie):
-	baseurl = '/api/types/ssc/instances'
-	options = '?fields=health,id&per_page=2000&compact=true'
-	requrl  = 'https://'+hostaddress+baseurl+options
+# Trend modules read the historical samples (metricValue) of a METRICS module
+# for the last --trend-hours and keep them in typed arrays: one array('l') of
+# timestamps and one array('d') of values per object (SP or LUN), NaN where an
+# object has no sample, values combined over paths and SPs as for the
+# real-time module. They are summarized per --trend-window minutes (min, avg,
+# max and TREND_PERCENTILES of every object), with NumPy over all objects at
+# once when it is installed and plain Python otherwise.
+#
+# The statistics of complete windows are kept in <state-dir>/trend-<sha1>.dat
+# (TrendStore: one array per object and statistic), so a run only reads and
+# summarizes the samples after the last complete window; only the first run,
+# or one after --trend-window, --trend-interval or a longer --trend-hours, reads
+# the whole range. The figures of the whole range are derived from the
+# windows: min, max and average exactly, percentiles from a histogram of the
+# samples (see TREND_BUCKET_RATIO). The status is the highest 95th percentile
+# against -w/-c; --trend-export writes every window as CSV.
+#
+TRENDS = {
+	'spcputrend':		'spcpu',
+	'luniopstrend':		'luniops',
+	'lunlatencytrend':	'lunlatency',
+}
+
+# Trend settings, filled in by main().
+TREND = {
+	'hours':	24,
+	'window':	60,
+	'interval':	300,
+	'export':	None,
+}
+
+TREND_PERCENTILES = [50, 95, 99]
+
+NAN = float('nan')
+
+
+class Series(object):
+
+	def __init__(self, combine):
+		self.step    = max if combine is max else (lambda a, b: a + b)
+		self.stamps  = array.array('l')
+		self.index   = {}
+		self.objects = {}
+
+	## Adds the (object, value) pairs of one sample.
+	def add(self, stamp, pairs):
+		i = self.index.get(stamp)
+		if i is None:
+			i = self.index[stamp] = len(self.stamps)
+			self.stamps.append(stamp)
+			for values in self.objects.values():
+				values.append(NAN)
+		objects, step = self.objects, self.step
+		for obj, value in pairs:
+			values = objects.get(obj)
+			if values is None:
+				values = objects[obj] = array.array('d', [NAN]) * len(self.stamps)
+			current = values[i]
+			values[i] = value if current != current else step(current, value)
+
+	## Puts the samples in time order; Unity sends the newest first.
+	def sort(self):
+		stamps = self.stamps
+		if all(stamps[i] >= stamps[i + 1] for i in range(len(stamps) - 1)):
+			stamps.reverse()
+			for values in self.objects.values():
+				values.reverse()
+		elif not all(stamps[i] <= stamps[i + 1] for i in range(len(stamps) - 1)):
+			order = sorted(range(len(stamps)), key=stamps.__getitem__)
+			self.stamps = array.array('l', [stamps[i] for i in order])
+			for obj, values in self.objects.items():
+				self.objects[obj] = array.array('d', [values[i] for i in order])
+		self.index = {}
+
+
+def percentileOf(values, p):
+	k = (len(values) - 1) * p / 100.0
+	f = int(k)
+	c = min(f + 1, len(values) - 1)
+	return values[f] + (values[c] - values[f]) * (k - f)
+
+
+## Returns [(start, obj, samples, min, avg, max, [percentiles])] for every
+## window of 'window' seconds (all of the series when None) and object that
+## has samples in it.
+#
+def summarizeSeries(series, window=None):
+	stamps = series.stamps
+	bounds = []
+	a = 0
+	while a < len(stamps):
+		if window:
+			start = stamps[a] - stamps[a] % window
+			b = bisect.bisect_left(stamps, start + window, a)
+		else:
+			start, b = stamps[0], len(stamps)
+		bounds.append((start, a, b))
+		a = b
 
-	headers = {'Accept': 'application/json', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache', 'EMC-CSRF-TOKEN': token}
-	r = requests.get(requrl, headers=headers, verify=False, cookies=cookie)
-	j = json.loads(r.text)
+	names = sorted(series.objects)
+	rows = []
+	try:
+		import numpy
+	except ImportError:
+		numpy = None
+
+	if numpy is not None and names:
+		import warnings
+		matrix = numpy.vstack([numpy.frombuffer(series.objects[name], dtype=numpy.float64) for name in names])
+		with warnings.catch_warnings():
+			# Objects without samples in a window give all-NaN slices.
+			warnings.simplefilter('ignore', RuntimeWarning)
+			for start, a, b in bounds:
+				block = matrix[:, a:b]
+				counts = (~numpy.isnan(block)).sum(axis=1)
+				lows, means, highs = numpy.nanmin(block, axis=1), numpy.nanmean(block, axis=1), numpy.nanmax(block, axis=1)
+				percentiles = numpy.nanpercentile(block, TREND_PERCENTILES, axis=1)
+				for j, name in enumerate(names):
+					if counts[j]:
+						rows.append((start, name, int(counts[j]), float(lows[j]), float(means[j]), float(highs[j]), [float(p) for p in percentiles[:, j]]))
+		return rows
+
+	for start, a, b in bounds:
+		for name in names:
+			values = sorted([v for v in series.objects[name][a:b] if v == v])
+			if values:
+				rows.append((start, name, len(values), values[0], sum(values) / len(values), values[-1], [percentileOf(values, p) for p in TREND_PERCENTILES]))
+	return rows
+
+
+## Whole-range percentiles come from a histogram per object: samples are
+## counted in logarithmic buckets TREND_BUCKET_RATIO apart (bucket 0 holds
+## everything below TREND_BUCKET_BASE), so they are within about 1% of the
+## exact value.
+#
+TREND_BUCKET_BASE  = 0.001
+TREND_BUCKET_RATIO = 1.02
+TREND_BUCKETS      = 1400
+
+# Lower bound of every bucket but the first.
+TREND_BOUNDS = [TREND_BUCKET_BASE * TREND_BUCKET_RATIO ** i for i in range(TREND_BUCKETS - 1)]
+
+
+def trendBucket(value):
+	return bisect.bisect_right(TREND_BOUNDS, value)
 
-	if not j['entries']:
-		value, descid, desc = EmptyOK()
+
+def trendBucketValue(bucket):
+	return TREND_BUCKET_BASE * TREND_BUCKET_RATIO ** (bucket - 0.5) if bucket else 0.0
+
+
+## Per-window statistics of every object: 'starts' holds the window starts,
+## objects[name]['stats'][stat] one array('d') per TREND_STATS entry, aligned
+## with 'starts' (count 0, min +inf and max -inf where the object had no
+## sample). Each object also keeps the bucket of every sample of those windows
+## in time order ('samples', array('H')) and their 'histogram', so windows
+## can be dropped again. 'since' is the time from which samples were read.
+#
+TREND_STATS = ['count', 'min', 'sum', 'max'] + ['p%d' % p for p in TREND_PERCENTILES]
+
+INF = float('inf')
+
+
+class TrendStore(object):
+
+	def __init__(self, settings, since):
+		self.settings = settings
+		self.since    = since
+		self.starts   = array.array('l')
+		self.objects  = {}
+
+	## First second after the last window, or None when there is none.
+	def end(self):
+		return self.starts[-1] + self.settings['window'] if self.starts else None
+
+	def newObject(self, name):
+		stats = {}
+		for stat in TREND_STATS:
+			stats[stat] = array.array('d', [INF if stat == 'min' else -INF if stat == 'max' else 0.0]) * len(self.starts)
+		obj = self.objects[name] = {'stats': stats, 'samples': array.array('H'), 'histogram': array.array('l', [0]) * TREND_BUCKETS}
+		return obj
+
+	## Appends the summarizeSeries() 'rows' of complete windows, in window
+	## order, and the samples of 'series' before 'end'.
+	def append(self, rows, series, end):
+		for start, name, count, low, mean, high, percentiles in rows:
+			if not self.starts or self.starts[-1] != start:
+				self.starts.append(start)
+				for obj in self.objects.values():
+					for stat, values in obj['stats'].items():
+						values.append(INF if stat == 'min' else -INF if stat == 'max' else 0.0)
+			obj = self.objects.get(name) or self.newObject(name)
+			for stat, value in zip(TREND_STATS, [count, low, mean * count, high] + percentiles):
+				obj['stats'][stat][-1] = value
+
+		n = bisect.bisect_left(series.stamps, end)
+		for name, values in series.objects.items():
+			obj = self.objects.get(name)
+			if obj is None:
+				continue
+			histogram = obj['histogram']
+			buckets = [bisect.bisect_right(TREND_BOUNDS, v) for v in values[:n] if v == v]
+			for bucket in buckets:
+				histogram[bucket] += 1
+			obj['samples'].extend(buckets)
+
+	## Drops the windows that ended before 'oldest', and the objects left
+	## without samples.
+	def trim(self, oldest):
+		self.since = max(self.since, oldest)
+		n = bisect.bisect_right(self.starts, oldest - self.settings['window'])
+		if not n:
+			return
+		del self.starts[:n]
+		for name, obj in list(self.objects.items()):
+			dropped = int(sum(obj['stats']['count'][:n]))
+			for bucket in obj['samples'][:dropped]:
+				obj['histogram'][bucket] -= 1
+			del obj['samples'][:dropped]
+			for values in obj['stats'].values():
+				del values[:n]
+			if not obj['samples']:
+				del self.objects[name]
+
+	## summarizeSeries() style rows for the whole range: the stored windows
+	## plus the 'rows' and the samples of 'series' from 'start' on, which are
+	## not stored yet.
+	def overall(self, rows, series, start):
+		totals = {}
+		for name, obj in self.objects.items():
+			stats = obj['stats']
+			totals[name] = [sum(stats['count']), min(stats['min']), sum(stats['sum']), max(stats['max'])]
+		for row in rows:
+			t = totals.get(row[1], [0, INF, 0.0, -INF])
+			totals[row[1]] = [t[0] + row[2], min(t[1], row[3]), t[2] + row[4] * row[2], max(t[3], row[5])]
+
+		n = bisect.bisect_left(series.stamps, start)
+		result = []
+		for name, (count, low, total, high) in sorted(totals.items()):
+			if not count:
+				continue
+			extra = {}
+			if name in series.objects:
+				for v in series.objects[name][n:]:
+					if v == v:
+						bucket = trendBucket(v)
+						extra[bucket] = extra.get(bucket, 0) + 1
+			obj = self.objects.get(name)
+			histogram = obj['histogram'] if obj is not None else array.array('l', [0]) * TREND_BUCKETS
+			result.append((self.since, name, int(count), low, total / count, high, self.percentiles(histogram, extra, int(count), low, high)))
+		return result
+
+	## The TREND_PERCENTILES of 'count' samples in histogram + extra, walking
+	## down from the highest bucket, clamped to the exact min and max.
+	@staticmethod
+	def percentiles(histogram, extra, count, low, high):
+		ranks = sorted([(count - 1 - int(round((count - 1) * p / 100.0)), i) for i, p in enumerate(TREND_PERCENTILES)])
+		found = [None] * len(ranks)
+		above = 0
+		bucket = TREND_BUCKETS - 1
+		for rank, i in ranks:
+			while bucket > 0 and above + histogram[bucket] + extra.get(bucket, 0) <= rank:
+				above += histogram[bucket] + extra.get(bucket, 0)
+				bucket -= 1
+			found[i] = min(high, max(low, trendBucketValue(bucket)))
+		return found
+
+	## Stored windows as summarizeSeries() rows.
+	def rows(self):
+		rows = []
+		for i, start in enumerate(self.starts):
+			for name in sorted(self.objects):
+				stats = self.objects[name]['stats']
+				count = stats['count'][i]
+				if count:
+					rows.append((start, name, int(count), stats['min'][i], stats['sum'][i] / count, stats['max'][i], [stats[stat][i] for stat in TREND_STATS[4:]]))
+		return rows
+
+	## A JSON header line, then the arrays in header order.
+	def save(self, path):
+		names = sorted(self.objects)
+		header = dict(self.settings, since=self.since, windows=len(self.starts), objects=names, samples=[len(self.objects[name]['samples']) for name in names], stats=TREND_STATS, buckets=[TREND_BUCKET_BASE, TREND_BUCKET_RATIO, TREND_BUCKETS])
+		tmp = '%s.%d.tmp' % (path, os.getpid())
+		with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+			f.write((json.dumps(header) + '\n').encode('utf-8'))
+			self.starts.tofile(f)
+			for name in names:
+				obj = self.objects[name]
+				for stat in TREND_STATS:
+					obj['stats'][stat].tofile(f)
+				obj['samples'].tofile(f)
+				obj['histogram'].tofile(f)
+		os.rename(tmp, path)
+
+	## Returns the store in 'path', or None when it is missing, unreadable or
+	## was built with other settings.
+	@classmethod
+	def load(cls, path, settings):
+		try:
+			with open(path, 'rb') as f:
+				header = json.loads(f.readline().decode('utf-8'))
+				if header.get('stats') != TREND_STATS or header.get('buckets') != [TREND_BUCKET_BASE, TREND_BUCKET_RATIO, TREND_BUCKETS] or any(header.get(k) != v for k, v in settings.items()):
+					return None
+				store = cls(settings, header['since'])
+				store.starts.fromfile(f, header['windows'])
+				for name, samples in zip(header['objects'], header['samples']):
+					obj = store.objects[name] = {'stats': {}, 'samples': array.array('H'), 'histogram': array.array('l')}
+					for stat in TREND_STATS:
+						obj['stats'][stat] = array.array('d')
+						obj['stats'][stat].fromfile(f, header['windows'])
+					obj['samples'].fromfile(f, samples)
+					obj['histogram'].fromfile(f, TREND_BUCKETS)
+				return store
+		except (IOError, OSError, EOFError, ValueError, KeyError):
+			return None
+
+
+def readTrend(hostaddress, token, cookie, paths, combine, since):
+	import calendar
+	since = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(since - 1))
+	series = Series(combine)
+	for path in paths:
+		filter = 'path eq "%s" and interval eq %d and timestamp gt "%s"' % (path, TREND['interval'], since)
+		entries = iterInstances(hostaddress, token, cookie, 'metricValue', 'path,timestamp,interval,values', filter)
+		if TRACE is not None:
+			entries = TRACE.entries(entries)
+		for x in entries:
+			stamp = calendar.timegm(time.strptime(x['timestamp'][:19], '%Y-%m-%dT%H:%M:%S'))
+			for sp, v in x['values'].items():
+				series.add(stamp, v.items() if isinstance(v, dict) else [(sp, v)])
+	series.sort()
+	return series
+
+
+def exportTrend(path, rows):
+	lines = ['window,object,samples,min,avg,max,%s\n' % ','.join('p%d' % p for p in TREND_PERCENTILES)]
+	for start, name, count, low, mean, high, percentiles in rows:
+		lines.append('%s,%s,%d,%s\n' % (time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(start)), name, count, ','.join(perfNumber(v) for v in [low, mean, high] + percentiles)))
+	tmp = '%s.%d.tmp' % (path, os.getpid())
+	with open(tmp, 'w') as f:
+		f.writelines(lines)
+	os.rename(tmp, path)
+
+
+def getTrend(hostaddress, token, cookie, module):
+	metric = TRENDS[module]
+	paths, unit, combine, warning, critical, what = METRICS[metric]
+	if METRIC['warning'] is not None:
+		warning = METRIC['warning']
+	if METRIC['critical'] is not None:
+		critical = METRIC['critical']
+
+	window = TREND['window'] * 60
+	settings = {'window': window, 'interval': TREND['interval']}
+	makeStateDir(METRIC['state_dir'])
+	path = stateFile(METRIC['state_dir'], 'trend', hostaddress, module) + '.dat'
+	lock = lockStateFile(path)
+	try:
+		now = time.time()
+		oldest = now - TREND['hours'] * 3600
+		store = TrendStore.load(path, settings)
+		# A longer --trend-hours needs samples from before the store.
+		if store is None or store.since > oldest + window:
+			store = TrendStore(settings, oldest)
+		store.trim(oldest)
+
+		series = readTrend(hostaddress, token, cookie, paths, combine, store.end() or store.since)
+		rows = summarizeSeries(series, window)
+		# A window is complete once its last sample can have been published.
+		complete = [row for row in rows if row[0] + window + TREND['interval'] <= now]
+		store.append(complete, series, complete[-1][0] + window if complete else 0)
+		store.save(path)
+	finally:
+		unlockStateFile(lock)
+
+	rows = rows[len(complete):]
+	if TREND['export']:
+		exportTrend(TREND['export'] % {'module': module}, store.rows() + rows)
+
+	overall = store.overall(rows, series, store.end() or 0)
+	if not overall:
+		return (0, 'METRIC_NO_HISTORY', 'The array has no %s samples of the last %dh' % (what, TREND['hours']), [])
+
+	p95 = TREND_PERCENTILES.index(95)
+	worst = max(overall, key=lambda row: row[6][p95])
+	top = worst[6][p95]
+	if critical is not None and top >= critical:
+		value = 25
+	elif warning is not None and top >= warning:
+		value = 10
 	else:
-		for x in j['entries']:
-			#print x
-			descid = str(x['content']['health']['descriptionIds'][0])
-			desc   = str(x['content']['health']['descriptions'][0])
-			value  = x['content']['health']['value']
-			s_nagios, s_msg1, s_msg2, s_val, s_exit = NagiosStatus(value, descid, desc)
-			if (s_nagios != "OK"):
-				return (value, descid, desc)
+		value = 5
+
+	high = 100 if unit == '%' else None
+	if len(overall) <= METRIC_PERF_OBJECTS:
+		perfdata = []
+		for start, name, count, low, mean, peak, percentiles in overall:
+			perfdata.append(('%s_%s_p95' % (metric, name), percentiles[p95], unit, warning, critical, 0, high))
+			perfdata.append(('%s_%s_max' % (metric, name), peak, unit, None, None, 0, high))
+	else:
+		perfdata = [
+			('%s_p95_max' % metric, top, unit, warning, critical, 0, high),
+			('%s_max' % metric, max(row[5] for row in overall), unit, None, None, 0, high),
+			('%s_avg' % metric, sum(row[4] * row[2] for row in overall) / sum(row[2] for row in overall), unit, None, None, 0, high),
+		]
+	samples = max(row[2] for row in overall)
+	perfdata.append(('%s_samples' % metric, samples, '', None, None, 0, None))
 
-	return (value, descid, desc)
+	descid = 'METRIC_%s_%s' % (module.upper(), NagiosStatus(value, '', '')[0])
+	desc   = '%s p95 %s%s on %s over the last %dh (%d samples of %d objects)' % (what, perfNumber(top), unit, worst[1], TREND['hours'], samples, len(overall))
+	return (value, descid, desc, perfdata)
 
 
-## (Applies to physical deployments only.) Information about internal Flash-based Solid State Disks (SSDs, mSATAs) in the storage system. 
+def getSpcputrend(hostaddress, token, cookie):
+	return getTrend(hostaddress, token, cookie, 'spcputrend')
+
+
+def getLuniopstrend(hostaddress, token, cookie):
+	return getTrend(hostaddress, token, cookie, 'luniopstrend')
+
+
+def getLunlatencytrend(hostaddress, token, cookie):
+	return getTrend(hostaddress, token, cookie, 'lunlatencytrend')
+
+
+## Capacity
 #
-def getSsd(hostaddress, token, cookie):
-	baseurl = '/api/types/ssd/instances'
-	options = '?fields=health,id&per_page=2000&compact=true'
-	requrl  = 'https://'+hostaddress+baseurl+options
+# Capacity modules walk a collection once, a page at a time and with only the
+# size fields, keeping the 'top' fullest objects in a heap and running sums
+# for the aggregates, so memory and perfdata stay bounded however many
+# objects the array has. The fullest object decides the status against
+# -w/-c (percent used).
+#
+# Only thin LUNs are counted: a thick LUN is allocated in full when created,
+# so its sizeAllocated always equals sizeTotal.
+#
+# module: (resource, field counted as used, filter, description, default
+# warning, default critical)
+#
+CAPACITIES = {
+	'pool':		('pool', 'sizeUsed', None, 'pools', 80, 90),
+	'lun':		('lun', 'sizeAllocated', 'isThinEnabled eq true', 'thin LUNs', 80, 90),
+	'filesystem':	('filesystem', 'sizeUsed', None, 'filesystems', 80, 90),
+}
+
+# Capacity settings, filled in by main().
+CAPACITY = {
+	'top':		5,
+}
+
+
+def perfLabel(name):
+	return re.sub(r"['=]", '_', name)
+
+
+def getCapacity(hostaddress, token, cookie, module):
+	resource, usedfield, filter, what, warning, critical = CAPACITIES[module]
+	if METRIC['warning'] is not None:
+		warning = METRIC['warning']
+	if METRIC['critical'] is not None:
+		critical = METRIC['critical']
+
+	top = []
+	count = over = 0
+	total = used = 0
+	entries = iterInstances(hostaddress, token, cookie, resource, 'id,name,sizeTotal,%s' % usedfield, filter)
+	if TRACE is not None:
+		entries = TRACE.entries(entries)
+	for x in entries:
+		size = x.get('sizeTotal') or 0
+		inuse = x.get(usedfield) or 0
+		percent = 100.0 * inuse / size if size else 0
+		count += 1
+		total += size
+		used += inuse
+		if warning is not None and percent >= warning:
+			over += 1
+		item = (percent, x.get('name') or x['id'], size, inuse)
+		if len(top) < CAPACITY['top']:
+			heapq.heappush(top, item)
+		elif item > top[0]:
+			heapq.heapreplace(top, item)
+
+	if not count:
+		return (5, 'CAPACITY_%s_EMPTY' % module.upper(), 'No %s on the array' % what, [('%s_count' % module, 0, '', None, None, 0, None)])
+
+	top.sort(reverse=True)
+	percent, name, size, inuse = top[0]
+	if critical is not None and percent >= critical:
+		value = 25
+	elif warning is not None and percent >= warning:
+		value = 10
+	else:
+		value = 5
 
-	headers = {'Accept': 'application/json', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache', 'EMC-CSRF-TOKEN': token}
-	r = requests.get(requrl, headers=headers, verify=False, cookies=cookie)
-	j = json.loads(r.text)
-	
-	for x in j['entries']:
-		#print x
-		descid = str(x['content']['health']['descriptionIds'][0])
-		desc   = str(x['content']['health']['descriptions'][0])
-		value  = x['content']['health']['value']
-		s_nagios, s_msg1, s_msg2, s_val, s_exit = NagiosStatus(value, descid, desc)
-		if (s_nagios != "OK"):
-			return (value, descid, desc)
+	perfdata = [('%s_%s' % (module, perfLabel(n)), p, '%', warning, critical, 0, 100) for p, n, s, u in top]
+	perfdata.extend([
+		('%s_used_pct' % module, 100.0 * used / total if total else 0, '%', None, None, 0, 100),
+		('%s_used' % module, used, 'B', None, None, 0, total),
+		('%s_total' % module, total, 'B', None, None, 0, None),
+		('%s_count' % module, count, '', None, None, 0, None),
+		('%s_over_warning' % module, over, '', None, None, 0, count),
+	])
 
-	return (value, descid, desc)
+	descid = 'CAPACITY_%s_%s' % (module.upper(), NagiosStatus(value, '', '')[0])
+	desc   = '%d of %d %s at or above %s%%, fullest %s at %s%% (%s of %s GiB)' % (over, count, what, perfNumber(warning) if warning is not None else '-', name, perfNumber(percent), perfNumber(inuse / 1073741824.0), perfNumber(size / 1073741824.0))
+	return (value, descid, desc, perfdata)
 
 
-## Information about Storage Processors (SPs) in the storage system.
+def getPool(hostaddress, token, cookie):
+	return getCapacity(hostaddress, token, cookie, 'pool')
+
+
+def getLun(hostaddress, token, cookie):
+	return getCapacity(hostaddress, token, cookie, 'lun')
+
+
+def getFilesystem(hostaddress, token, cookie):
+	return getCapacity(hostaddress, token, cookie, 'filesystem')
+
+
+## Alerts
 #
-def getStorageprocessor(hostaddress, token, cookie):
-	baseurl = '/api/types/storageProcessor/instances'
-	options = '?fields=health,id&per_page=2000&compact=true'
-	requrl  = 'https://'+hostaddress+baseurl+options
+# The alert module reports the alerts the array raised since the previous
+# check of the host. The timestamp of the newest alert seen, and the ids of
+# the alerts with exactly that timestamp, are kept in
+# <state-dir>/alert-<sha1>.json; later runs only ask for the alerts from that
+# timestamp on. The first run just records the newest alert, so the alert
+# history of the array is never walked.
+#
+# Unity alert severities (syslog levels) as health values for NagiosStatus().
+#
+ALERT_SEVERITY = {
+	0:	25,	# EMERGENCY
+	1:	25,	# ALERT
+	2:	25,	# CRITICAL
+	3:	20,	# ERROR
+	4:	10,	# WARNING
+	5:	5,	# NOTICE
+	6:	5,	# INFO
+	7:	5,	# DEBUG
+	8:	5,	# OK
+}
+
+ALERT_FIELDS = 'id,timestamp,severity,messageId,message,isAcknowledged'
+
+
+## Returns the alerts newer than 'cursor' and the cursor after them.
+#
+def readAlerts(hostaddress, token, cookie, cursor):
+	filter = cursor['timestamp'] and 'timestamp ge "%s"' % cursor['timestamp']
+	alerts = []
+	seen = set(cursor['ids'])
+	latest, ids = cursor['timestamp'], list(cursor['ids'])
+	for x in iterInstances(hostaddress, token, cookie, 'alert', ALERT_FIELDS, filter):
+		if x['id'] in seen:
+			continue
+		alerts.append(x)
+		if (not latest) or (x['timestamp'] > latest):
+			latest, ids = x['timestamp'], []
+		if x['timestamp'] == latest:
+			ids.append(x['id'])
+	return (alerts, {'timestamp': latest, 'ids': ids})
+
+
+def getAlert(hostaddress, token, cookie):
+	makeStateDir(METRIC['state_dir'])
+	path = stateFile(METRIC['state_dir'], 'alert', hostaddress) + '.json'
+	lock = lockStateFile(path)
+	try:
+		cursor = readStateFile(path)
+		if cursor is None:
+			alerts = []
+			cursor = {'timestamp': None, 'ids': []}
+			for x in iterInstances(hostaddress, token, cookie, 'alert', ALERT_FIELDS, limit=1, orderby='timestamp desc'):
+				cursor = {'timestamp': x['timestamp'], 'ids': [x['id']]}
+		else:
+			alerts, cursor = readAlerts(hostaddress, token, cookie, cursor)
+		writeStateFile(path, cursor)
+	finally:
+		unlockStateFile(lock)
 
-	headers = {'Accept': 'application/json', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache', 'EMC-CSRF-TOKEN': token}
-	r = requests.get(requrl, headers=headers, verify=False, cookies=cookie)
-	j = json.loads(r.text)
-	
-	for x in j['entries']:
-		#print x
-		descid = str(x['content']['health']['descriptionIds'][0])
-		desc   = str(x['content']['health']['descriptions'][0])
-		value  = x['content']['health']['value']
-		s_nagios, s_msg1, s_msg2, s_val, s_exit = NagiosStatus(value, descid, desc)
-		if (s_nagios != "OK"):
-			return (value, descid, desc)
+	alerts = [x for x in alerts if not x.get('isAcknowledged')]
+	perfdata = [('alerts', len(alerts), '', None, None, 0, None)]
+	if not alerts:
+		return (5, 'NO_NEW_ALERTS', 'No new alerts since %s' % (cursor['timestamp'] or 'the first check'), perfdata)
 
-	return (value, descid, desc)
+	worst = min(alerts, key=lambda x: x['severity'])
+	value = ALERT_SEVERITY.get(worst['severity'], 0)
+	return (value, str(worst['messageId']), '%d new alert(s), worst at %s: %s' % (len(alerts), worst['timestamp'], worst['message']), perfdata)
 
 
-## (Applies to physical deployments only.) Information about Uncommitted ports in the storage system.
+## Modules accepted by -m, in the order they are reported.
 #
-def getUncommittedport(hostaddress, token, cookie):
-	baseurl = '/api/types/uncommittedPort/instances'
-	options = '?fields=health,id&per_page=2000&compact=true'
-	requrl  = 'https://'+hostaddress+baseurl+options
+MODULES = [
+	('battery',		getBattery),
+	('dae',			getDae),
+	('disk',		getDisk),
+	('dpe',			getDpe),
+	('ethernetport',	getEthernetport),
+	('fan',			getFan),
+	('fcport',		getFcport),
+	('iomodule',		getIomodule),
+	('lcc',			getLcc),
+	('memorymodule',	getMemorymodule),
+	('powersupply',		getPowersupply),
+	('sasport',		getSasport),
+	('ssc',			getSsc),
+	('ssd',			getSsd),
+	('storageprocessor',	getStorageprocessor),
+	('system',		getSystem),
+	('uncommittedport',	getUncommittedport),
+]
+
+## Performance modules, only run when asked for by name (not part of 'all').
+#
+METRIC_MODULES = [
+	('spcpu',		getSpcpu),
+	('luniops',		getLuniops),
+	('lunlatency',		getLunlatency),
+	('spcputrend',		getSpcputrend),
+	('luniopstrend',	getLuniopstrend),
+	('lunlatencytrend',	getLunlatencytrend),
+]
+
+## Capacity modules, only run when asked for by name (not part of 'all').
+#
+CAPACITY_MODULES = [
+	('pool',		getPool),
+	('lun',			getLun),
+	('filesystem',		getFilesystem),
+]
 
-	headers = {'Accept': 'application/json', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache', 'EMC-CSRF-TOKEN': token}
-	r = requests.get(requrl, headers=headers, verify=False, cookies=cookie)
-	j = json.loads(r.text)
-	
-	if not j['entries']:
-		value, descid, desc = EmptyOK()
+## Event modules, only run when asked for by name (not part of 'all').
+#
+EVENT_MODULES = [
+	('alert',		getAlert),
+]
+
+MODULE_NAMES = [name for name, func in MODULES]
+MODULE_FUNCS = dict(MODULES + METRIC_MODULES + CAPACITY_MODULES + EVENT_MODULES)
+
+
+def worstStatus(results):
+	worst = None
+	for module, status in results:
+		if (worst is None) or (NAGIOS_SEVERITY[status[4]] > NAGIOS_SEVERITY[worst[1][4]]):
+			worst = (module, status)
+	return worst
+
+
+## Returns None when the session was refused, so the caller can log in again.
+#
+def runModule(module, hostaddress, token, cookie):
+	if TRACE is not None:
+		TRACE.local.module = module
+	if REQUEST_COUNTS is not None:
+		REQUEST_MODULE.name = module
+	try:
+		if PROFILE is not None:
+			return PROFILE.call(hostaddress, module, MODULE_FUNCS[module], hostaddress, token, cookie)
+		return MODULE_FUNCS[module](hostaddress, token, cookie)
+	except SessionExpired:
+		return None
+	except DeadlineExceeded:
+		return EmptyTimedOut()
+	except UnsafeStateDir as e:
+		return (0, 'UNSAFE_STATE_DIR', str(e))
+	except Exception:
+		return EmptyCouldNotGet()
+	finally:
+		if TRACE is not None:
+			TRACE.local.module = None
+		if REQUEST_COUNTS is not None:
+			REQUEST_MODULE.name = None
+
+
+## Calls func(item) for every item with at most 'workers' calls running at a
+## time. Returns the results in the order of 'items'. With one worker the
+## calls run in the calling thread.
+#
+def runConcurrently(func, items, workers):
+	if workers <= 1:
+		return [func(item) for item in items]
+
+	results = {}
+	pending = queue.Queue()
+	for n, item in enumerate(items):
+		pending.put((n, item))
+
+	def worker():
+		while True:
+			try:
+				n, item = pending.get_nowait()
+			except queue.Empty:
+				return
+			results[n] = func(item)
+
+	threads = []
+	for n in range(max(1, min(workers, len(items)))):
+		t = threading.Thread(target=worker)
+		t.daemon = True
+		t.start()
+		threads.append(t)
+	for t in threads:
+		t.join()
+
+	return [results[n] for n in range(len(items))]
+
+
+## Runs the requested modules over one authenticated session, at most
+## 'workers' requests in flight at a time. Results keep the order of 'modules'.
+#
+def runModules(hostaddress, token, cookie, modules, workers=4):
+	results = runConcurrently(lambda module: runModule(module, hostaddress, token, cookie), modules, workers)
+	return list(zip(modules, results))
+
+
+def parseModules(parser, values):
+	modules = []
+	for value in values:
+		for module in value.lower().split(','):
+			if not module:
+				continue
+			if module == 'all':
+				modules.extend(MODULE_NAMES)
+			elif module in MODULE_FUNCS:
+				modules.append(module)
+			else:
+				parser.error("argument -m/--module: invalid choice: '%s' (choose from %s)" % (module, ', '.join(MODULE_NAMES + [name for name, func in METRIC_MODULES + CAPACITY_MODULES + EVENT_MODULES] + ['all'])))
+
+	seen = set()
+	return [m for m in modules if not (m in seen or seen.add(m))]
+
+
+## Response cache
+#
+# With --cache-ttl the result (value, descid, desc[, perfdata]) of every module is shared between
+# plugin processes in <state-dir>/responses.db (SQLite), keeping at most
+# --cache-size rows. Before fetching a module a process takes the lock of its
+# host/module key, so when several checks of the same array start together
+# only the first one asks the array and the others wait for its result.
+# Results are keyed by cacheKey(), which includes the options the result of
+# the module depends on. Health modules skip the cache with --history or
+# --snapshot (see lookupHost()).
+#
+def openResponseCache(statedir):
+	import sqlite3
+	makeStateDir(statedir)
+	db = sqlite3.connect(os.path.join(statedir, 'responses.db'), timeout=10)
+	db.execute('CREATE TABLE IF NOT EXISTS responses (host TEXT, module TEXT, value INTEGER, descid TEXT, desc TEXT, perfdata TEXT, stored REAL, PRIMARY KEY (host, module))')
+	db.execute('CREATE INDEX IF NOT EXISTS responses_stored ON responses (stored)')
+	return db
+
+
+## Returns 'module' with a hash of the settings its result depends on, so
+## that checks with other -w/-c, --top, --trend-* or --early-exit options do
+## not get each other's results.
+#
+def cacheKey(module):
+	if module in METRICS:
+		settings = [METRIC['warning'], METRIC['critical'], METRIC['interval']]
+	elif module in TRENDS:
+		settings = [METRIC['warning'], METRIC['critical'], TREND['hours'], TREND['window'], TREND['interval']]
+	elif module in CAPACITIES:
+		settings = [METRIC['warning'], METRIC['critical'], CAPACITY['top']]
+	elif module in MODULE_NAMES:
+		settings = [FETCH['early_exit']]
 	else:
-		for x in j['entries']:
-			#print x
-			descid = str(x['content']['health']['descriptionIds'][0])
-			desc   = str(x['content']['health']['descriptions'][0])
-			value  = x['content']['health']['value']
-			s_nagios, s_msg1, s_msg2, s_val, s_exit = NagiosStatus(value, descid, desc)
-			if (s_nagios != "OK"):
-				return (value, descid, desc)
+		settings = []
+	return '%s:%s' % (module, hashlib.sha1(json.dumps(settings).encode('utf-8')).hexdigest()[:12])
+
+
+def cacheLookup(db, hostaddress, modules, ttl):
+	results = {}
+	keys = dict((cacheKey(module), module) for module in modules)
+	oldest = time.time() - ttl
+	for key, value, descid, desc, perfdata in db.execute('SELECT module, value, descid, desc, perfdata FROM responses WHERE host = ? AND stored >= ?', (hostaddress, oldest)):
+		if key in keys:
+			results[keys[key]] = (value, descid, desc, json.loads(perfdata))
+	return results
+
+
+def cacheStore(db, hostaddress, results, size):
+	now = time.time()
+	with db:
+		db.executemany('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)', [(hostaddress, cacheKey(module), result[0], result[1], result[2], json.dumps(resultPerfdata(result)), now) for module, result in results])
+		db.execute('DELETE FROM responses WHERE rowid IN (SELECT rowid FROM responses ORDER BY stored DESC LIMIT -1 OFFSET ?)', (size,))
+
+
+def checkHost(hostaddress, user, password, modules, args):
+	results = lookupHost(hostaddress, user, password, modules, args)
+	if OBSERVED is not None:
+		with OBSERVED_LOCK:
+			observed = dict((module, OBSERVED.pop((hostaddress, module), None)) for module, result in results)
+	if args.history:
+		results = recordHistory(args, hostaddress, results, observed)
+	if args.snapshot:
+		results = recordSnapshot(args, hostaddress, results, observed)
+	return results
+
+
+def lookupHost(hostaddress, user, password, modules, args):
+	# --history and --snapshot record the components a health module walked,
+	# which a cached result does not have: those modules always go to the array.
+	shared = [module for module in modules if not ((args.history or args.snapshot) and module in MODULE_NAMES)]
+	if args.cache_ttl <= 0 or not shared:
+		return guardedFetchHost(hostaddress, user, password, modules, args)
+
+	db = openResponseCache(args.state_dir)
+	locks = []
+	try:
+		results = cacheLookup(db, hostaddress, shared, args.cache_ttl)
+		missing = [module for module in shared if module not in results]
+
+		# Sorted so that processes wanting overlapping modules cannot deadlock.
+		deadline = REST['deadline'] and REST['deadline'] - DEADLINE_MARGIN
+		for module in sorted(missing):
+			fd = lockStateFile(stateFile(args.state_dir, 'fetch', hostaddress, cacheKey(module)), deadline)
+			if fd is not None:
+				locks.append(fd)
+
+		if missing and locks:
+			results.update(cacheLookup(db, hostaddress, missing, args.cache_ttl))
+		missing = [module for module in modules if module not in results]
+
+		if missing:
+			fetched = guardedFetchHost(hostaddress, user, password, missing, args)
+			# Failed requests and logins are not shared, the next check retries them.
+			cacheStore(db, hostaddress, [(module, result) for module, result in fetched if result[0] != 0 and result[1] != 'CIRCUIT_OPEN'], args.cache_size)
+			results.update(fetched)
+	finally:
+		for fd in locks:
+			unlockStateFile(fd)
+		db.close()
+
+	return [(module, results[module]) for module in modules]
+
+
+## Logs in (or reuses the cached session) and runs 'modules' against one array.
+## Returns [(module, (value, descid, desc)), ...] in the order of 'modules'.
+#
+def fetchHost(hostaddress, user, password, modules, args):
+	if args.session_cache:
+		token, cookie, cached = getSession(args.state_dir, args.session_ttl, hostaddress, user, password)
+	else:
+		token, cookie = login(hostaddress, user, password)
+		cached = False
 
-	return (value, descid, desc)
+	if not (token and cookie):
+		return [(module, (0, 'COULD_NOT_LOGIN', 'Could not login on REST url')) for module in modules]
 
+	results = runModules(hostaddress, token, cookie, modules, args.workers)
 
-def logout(hostaddress, token, cookie):
-        baseurl = '/api/types/loginSessionInfo/action/logout'
-        requrl  = 'https://'+hostaddress+baseurl
+	expired = [module for module, result in results if result is None]
+	if expired and cached:
+		token, cookie, cached = getSession(args.state_dir, args.session_ttl, hostaddress, user, password, stale=token)
+		if token and cookie:
+			retried = dict(runModules(hostaddress, token, cookie, expired, args.workers))
+			results = [(module, retried.get(module, result)) for module, result in results]
 
-        payload = {'localCleanupOnly': 'true'}
-        headers = {'Accept': 'application/json', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache', 'EMC-CSRF-TOKEN': token}
-        r = requests.post(requrl, headers=headers, verify=False, cookies=cookie, data=json.dumps(payload))
-        j = json.loads(r.text)
-        return j['logout']
+	if token and cookie and not args.session_cache:
+		try:
+			s = logout(hostaddress, token, cookie)
+		except Exception:
+			pass
 
+	return [(module, result or EmptyCouldNotGet()) for module, result in results]
 
-def login(hostaddress, user, password):
-	baseurl = '/api/types/loginSessionInfo'
-	requrl  = 'https://'+hostaddress+baseurl
 
-	headers = {'Accept': 'application/json', 'Content-type': 'application/json', 'X-EMC-REST-CLIENT': 'true', 'Cache-Control': 'no-cache', 'Pragma': 'no-cache'}
-	r = requests.get(requrl, headers=headers, verify=False, auth=(user, password))
+## Circuit breaker
+#
+# With --breaker-threshold N, consecutive checks of a host in which the array
+# could not be reached at all (no login, or no module got an answer) are
+# counted in <state-dir>/breaker-<sha1>.json, shared by all plugin processes.
+# After N of them the breaker opens: checks answer CIRCUIT_OPEN at once for
+# --breaker-cooldown seconds. Then the next check becomes the only probe
+# (claimed under the lock, other checks keep short-circuiting), and its
+# outcome closes the breaker again or restarts the cool-down.
+#
+BREAKER_FAILURES = ('COULD_NOT_LOGIN', 'COULD_NOT_REQUEST_URL', 'TIMEOUT_BUDGET_EXHAUSTED')
+
 
-	if r.status_code == 200:
-		token  = r.headers['emc-csrf-token']
-		cookie = r.cookies
+## Returns None when the check may go to the array, or (failures, seconds to
+## the next probe) while the breaker is open.
+#
+def breakerCheck(path, threshold, cooldown):
+	lock = lockStateFile(path)
+	try:
+		now = time.time()
+		state = readStateFile(path) or {}
+		failures = state.get('failures', 0)
+		if failures < threshold:
+			return None
+		# A probe that has not reported back within the cool-down is given up.
+		retry = max(state.get('opened', 0), state.get('probe', 0)) + cooldown
+		if now >= retry:
+			state['probe'] = now
+			writeStateFile(path, state)
+			return None
+		return (failures, int(retry - now) + 1)
+	finally:
+		unlockStateFile(lock)
+
+
+def breakerRecord(path, threshold, failed):
+	lock = lockStateFile(path)
+	try:
+		state = readStateFile(path) or {}
+		if not failed:
+			if state:
+				os.unlink(path)
+			return
+		state['failures'] = state.get('failures', 0) + 1
+		if state['failures'] >= threshold:
+			state['opened'] = time.time()
+			state['probe']  = 0
+		writeStateFile(path, state)
+	finally:
+		unlockStateFile(lock)
+
+
+def guardedFetchHost(hostaddress, user, password, modules, args):
+	if args.breaker_threshold <= 0:
+		return fetchHost(hostaddress, user, password, modules, args)
+
+	makeStateDir(args.state_dir)
+	path = stateFile(args.state_dir, 'breaker', hostaddress) + '.json'
+	circuit = breakerCheck(path, args.breaker_threshold, args.breaker_cooldown)
+	if circuit is not None:
+		return [(module, EmptyCircuitOpen(circuit[0], circuit[1], args.breaker_status == 'critical')) for module in modules]
+
+	results = fetchHost(hostaddress, user, password, modules, args)
+	breakerRecord(path, args.breaker_threshold, all(result[1] in BREAKER_FAILURES for module, result in results))
+	return results
+
+
+## Health history
+#
+# With --history every check also goes to <state-dir>/history.db (SQLite):
+#
+#	results		the last FLAP_WINDOW health values of each host/module,
+#			a fixed number of rows per module
+#	components	the components that are not OK right now, with their
+#			health value and since when
+#	changes		every state change of a module (component '') or of a
+#			component, indexed by host and time, pruned after
+#			--history-days
+#	flapping	the modules currently considered flapping
+#
+# A module whose Nagios state changed in --flap-high percent or more of its
+# last FLAP_WINDOW (at least FLAP_MIN) checks (recent changes weighing more, as in Nagios) starts
+# flapping and stops once below --flap-low. While it flaps, the worst result
+# of the window is reported instead of the current one, so it does not page
+# again on every change.
+#
+FLAP_WINDOW = 21
+FLAP_MIN    = 5
+
+
+def openHistory(statedir):
+	import sqlite3
+	makeStateDir(statedir)
+	db = sqlite3.connect(os.path.join(statedir, 'history.db'), timeout=10)
+	db.executescript('''
+		CREATE TABLE IF NOT EXISTS results (host TEXT, module TEXT, stamp REAL, value INTEGER);
+		CREATE INDEX IF NOT EXISTS results_key ON results (host, module, stamp);
+		CREATE TABLE IF NOT EXISTS components (host TEXT, module TEXT, component TEXT, value INTEGER, since REAL, PRIMARY KEY (host, module, component));
+		CREATE TABLE IF NOT EXISTS changes (host TEXT, module TEXT, component TEXT, stamp REAL, old INTEGER, new INTEGER);
+		CREATE INDEX IF NOT EXISTS changes_key ON changes (host, stamp);
+		CREATE INDEX IF NOT EXISTS changes_stamp ON changes (stamp);
+		CREATE TABLE IF NOT EXISTS flapping (host TEXT, module TEXT, since REAL, PRIMARY KEY (host, module));
+	''')
+	return db
+
+
+def healthState(value):
+	status = NagiosStatus(value, '', '')
+	return status[4] if status else 3
+
+
+## Weighted percent of state changes in 'states' (oldest first).
+#
+def flapPercent(states):
+	if len(states) < FLAP_MIN:
+		return 0
+	changed = 0
+	for i in range(1, len(states)):
+		if states[i] != states[i - 1]:
+			changed += 0.8 + 0.4 * (i - 1) / (len(states) - 2)
+	return 100.0 * changed / (len(states) - 1)
+
+
+def recordComponents(db, hostaddress, module, unhealthy, now):
+	current = dict(db.execute('SELECT component, value FROM components WHERE host = ? AND module = ?', (hostaddress, module)))
+	for component, value in unhealthy.items():
+		if current.get(component) != value:
+			db.execute('INSERT INTO changes VALUES (?, ?, ?, ?, ?, ?)', (hostaddress, module, component, now, current.get(component, 5), value))
+			db.execute('INSERT OR REPLACE INTO components VALUES (?, ?, ?, ?, ?)', (hostaddress, module, component, value, now))
+	for component, value in current.items():
+		if component not in unhealthy:
+			db.execute('INSERT INTO changes VALUES (?, ?, ?, ?, ?, ?)', (hostaddress, module, component, now, value, 5))
+			db.execute('DELETE FROM components WHERE host = ? AND module = ? AND component = ?', (hostaddress, module, component))
+
+
+## Records 'results' of hostaddress (with the 'observed' components of each
+## module) and returns them with flapping modules
+## replaced by the worst result of their window.
+#
+def recordHistory(args, hostaddress, results, observed):
+	now = time.time()
+	db = openHistory(args.state_dir)
+	recorded = []
+	try:
+		with db:
+			for module, result in results:
+				# Nothing was learnt about the array itself.
+				if result[1] in BREAKER_FAILURES or result[1] == 'CIRCUIT_OPEN':
+					recorded.append((module, result))
+					continue
+
+				value = result[0]
+				previous = db.execute('SELECT value FROM results WHERE host = ? AND module = ? ORDER BY stamp DESC LIMIT 1', (hostaddress, module)).fetchone()
+				if previous is not None and healthState(previous[0]) != healthState(value):
+					db.execute('INSERT INTO changes VALUES (?, ?, ?, ?, ?, ?)', (hostaddress, module, '', now, previous[0], value))
+				db.execute('INSERT INTO results VALUES (?, ?, ?, ?)', (hostaddress, module, now, value))
+				db.execute('DELETE FROM results WHERE host = ? AND module = ? AND stamp < (SELECT stamp FROM results WHERE host = ? AND module = ? ORDER BY stamp DESC LIMIT 1 OFFSET ?)', (hostaddress, module, hostaddress, module, FLAP_WINDOW - 1))
+				if observed.get(module) is not None:
+					recordComponents(db, hostaddress, module, dict((k, v) for k, v in observed[module].items() if v != 5), now)
+
+				values = [v for (v,) in db.execute('SELECT value FROM results WHERE host = ? AND module = ? ORDER BY stamp', (hostaddress, module))]
+				percent = flapPercent([healthState(v) for v in values])
+				flapping = db.execute('SELECT since FROM flapping WHERE host = ? AND module = ?', (hostaddress, module)).fetchone() is not None
+				if not flapping and percent >= args.flap_high:
+					db.execute('INSERT OR REPLACE INTO flapping VALUES (?, ?, ?)', (hostaddress, module, now))
+					flapping = True
+				elif flapping and percent < args.flap_low:
+					db.execute('DELETE FROM flapping WHERE host = ? AND module = ?', (hostaddress, module))
+					flapping = False
+
+				if flapping:
+					worst = max(values, key=lambda v: NAGIOS_SEVERITY[healthState(v)])
+					result = (worst, 'FLAPPING', 'State changed in %d%% of the last %d checks, reporting the worst (now %s)' % (percent, len(values), result[1])) + tuple(result[3:])
+				recorded.append((module, result))
+
+			db.execute('DELETE FROM changes WHERE stamp < ?', (now - args.history_days * 86400,))
+	finally:
+		db.close()
+	return recorded
+
+
+## Prints the state changes of the last 'hours' (of hostaddress, or of every
+## host), oldest first.
+#
+def queryHistory(statedir, hours, hostaddress=None):
+	db = openHistory(statedir)
+	try:
+		since = time.time() - hours * 3600
+		if hostaddress:
+			rows = db.execute('SELECT stamp, host, module, component, old, new FROM changes WHERE host = ? AND stamp >= ? ORDER BY stamp', (hostaddress, since))
+		else:
+			rows = db.execute('SELECT stamp, host, module, component, old, new FROM changes WHERE stamp >= ? ORDER BY stamp', (since,))
+		for stamp, host, module, component, old, new in rows:
+			print ('%s %s %s %s %s(%s) -> %s(%s)' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stamp)), host, module, component or '-',
+				(NagiosStatus(old, '', '') or ('UNKNOWN',))[0], old, (NagiosStatus(new, '', '') or ('UNKNOWN',))[0], new))
+	finally:
+		db.close()
+
+
+## Inventory snapshots
+#
+# With --snapshot the components seen by each health module are kept per host
+# in --state-dir: an index with one content hash per module (sha1 of its
+# sorted 'id health' lines), and one file per module with its {id: value}.
+# The next check only compares hashes; the component file of a module is
+# read and diffed only when its hash changed. New, removed and changed
+# components are reported as an extra 'snapshot' result, WARNING when a
+# component disappeared.
+#
+SNAPSHOT_LISTED = 10
+
+
+def snapshotHash(components):
+	digest = hashlib.sha1()
+	for id in sorted(components):
+		digest.update(('%s %s\n' % (id, components[id])).encode('utf-8'))
+	return digest.hexdigest()
+
+
+def diffSnapshot(module, old, new):
+	added   = [id for id in new if id not in old]
+	removed = [id for id in old if id not in new]
+	changed = [id for id in new if id in old and old[id] != new[id]]
+	changes = ['%s +%s(%s)' % (module, id, new[id]) for id in sorted(added)]
+	changes += ['%s -%s' % (module, id) for id in sorted(removed)]
+	changes += ['%s %s %s->%s' % (module, id, old[id], new[id]) for id in sorted(changed)]
+	return (len(added), len(removed), len(changed), changes)
+
+
+## Compares the 'observed' components of each module with the snapshot of
+## hostaddress, stores the new one and returns 'results' plus the snapshot
+## result.
+#
+def recordSnapshot(args, hostaddress, results, observed):
+	observed = dict((module, components) for module, components in observed.items() if components is not None)
+	if not observed:
+		return results
+
+	makeStateDir(args.state_dir)
+	path = stateFile(args.state_dir, 'snapshot', hostaddress) + '.json'
+	lock = lockStateFile(path)
+	try:
+		index = readStateFile(path) or {}
+		added = removed = changed = total = 0
+		changes = []
+		first = []
+		for module, components in sorted(observed.items()):
+			total += len(components)
+			digest = snapshotHash(components)
+			if index.get(module) == digest:
+				continue
+			modulepath = stateFile(args.state_dir, 'snapshot', hostaddress, module) + '.json'
+			if module in index:
+				a, r, c, lines = diffSnapshot(module, readStateFile(modulepath) or {}, components)
+				added, removed, changed = added + a, removed + r, changed + c
+				changes += lines
+			else:
+				first.append(module)
+			writeStateFile(modulepath, components)
+			index[module] = digest
+		writeStateFile(path, index)
+	finally:
+		unlockStateFile(lock)
+
+	if changes:
+		value  = 10 if removed else 5
+		descid = 'SNAPSHOT_CHANGED'
+		desc   = '%d new, %d removed, %d changed of %d components: %s' % (added, removed, changed, total, ', '.join(changes[:SNAPSHOT_LISTED]) + (', ...' if len(changes) > SNAPSHOT_LISTED else ''))
+	elif first:
+		value, descid, desc = 5, 'SNAPSHOT_RECORDED', 'Recorded %d components of %s' % (total, ', '.join(first))
 	else:
-		token  = 0
-		cookie = 0
+		value, descid, desc = 5, 'SNAPSHOT_UNCHANGED', 'No change in %d components' % total
+	perfdata = [
+		('components', total, '', None, None, 0, None),
+		('components_new', added, '', None, None, 0, None),
+		('components_removed', removed, '', None, None, 0, None),
+		('components_changed', changed, '', None, None, 0, None),
+	]
+	return results + [('snapshot', (value, descid, desc, perfdata))]
+
+
+## Module results are (value, descid, desc), plus perfdata for the modules
+## that measure something.
+#
+def resultPerfdata(result):
+	return result[3] if len(result) > 3 else []
 
-	return (token, cookie)
+
+def prefixPerfdata(result, prefix):
+	return tuple(result[:3]) + ([(prefix + p[0],) + tuple(p[1:]) for p in resultPerfdata(result)],)
+
+
+## Prints a line of plugin output, as UTF-8 also on Python 2, which would
+## encode unicode (descriptions from the array) as ASCII when stdout is a pipe.
+#
+def printOutput(line):
+	if sys.version_info[0] < 3 and not isinstance(line, str):
+		line = line.encode('utf-8')
+	print (line)
+
+
+## Prints the combined Nagios output for 'results' and returns its exit status.
+#
+def report(results, perfdata=None):
+	statuses = []
+	perfdata = list(perfdata or [])
+	for module, result in results:
+		value, descid, desc = result[:3]
+		if (value or value == 0) and descid and desc:
+			statuses.append((module, NagiosStatus(value, descid, desc)))
+			perfdata.extend(resultPerfdata(result))
+
+	if not statuses:
+		return 0
+
+	perf = perfdata and (' | ' + formatPerfdata(perfdata)) or ''
+	module, (s_nagios, s_msg1, s_msg2, s_val, s_exit) = worstStatus(statuses)
+	if len(results) == 1:
+		printOutput('%s: %s,%s,%s%s' % (s_nagios,s_msg1,s_msg2,s_val,perf))
+	else:
+		printOutput('%s: %s: %s,%s,%s%s' % (s_nagios,module,s_msg1,s_msg2,s_val,perf))
+		for module, status in statuses:
+			printOutput('%s: %s: %s,%s,%s' % ((module,) + status[:4]))
+	return s_exit
+
+
+## Inventory file (INI), one section per array:
+#
+#	[unity01]
+#	hostaddress = unity01.foo.com
+#	user = monituser
+#	password = monitpass
+#
+# Instead of 'password' a section can reference the secret with
+# 'password_file' (first line of a file) or 'password_env' (environment).
+#
+def readInventory(path):
+	try:
+		import ConfigParser as configparser
+	except ImportError:
+		import configparser
+
+	config = configparser.RawConfigParser()
+	if not config.read(path):
+		raise IOError('could not read inventory %s' % path)
+
+	arrays = []
+	for name in config.sections():
+		array = dict(config.items(name))
+		array['name'] = name
+		array.setdefault('hostaddress', name)
+		if 'password_file' in array:
+			with open(array['password_file']) as f:
+				array['password'] = f.readline().strip()
+		elif 'password_env' in array:
+			array['password'] = os.environ.get(array['password_env'])
+		if not (array.get('user') and array.get('password')):
+			raise ValueError('inventory %s: no user or password for %s' % (path, name))
+		arrays.append(array)
+	return arrays
+
+
+## Fleet mode: checks every array of the inventory in one run, --fleet-workers
+## arrays at a time and --workers requests per array. Returns
+## [(name, [(module, (value, descid, desc)), ...]), ...] in inventory order.
+#
+def checkFleet(arrays, modules, args):
+	def check(array):
+		try:
+			return checkHost(array['hostaddress'], array['user'], array['password'], modules, args)
+		except Exception:
+			return [(module, EmptyCouldNotGet()) for module in modules]
+
+	return list(zip([array['name'] for array in arrays], runConcurrently(check, arrays, args.fleet_workers)))
+
+
+## Daemon mode
+#
+# One Collector thread per array stays logged in and polls every module each
+# --interval seconds, keeping the latest results in memory. Checks started
+# with --client ask the daemon over the --socket Unix socket and never touch
+# the array themselves. 'published' is called after every refresh.
+#
+# With --adaptive each module has its own interval instead: its base interval
+# below (scaled by --interval / 60), divided by POLL_TIGHTEN while the module
+# is not OK or its result just changed, and stretched POLL_BACKOFF times per
+# unchanged OK result up to POLL_MAX_FACTOR times the base. With
+# --request-budget N an array is sent at most N requests per minute (bursts of
+# POLL_BURST seconds' worth); due modules wait for the budget, the most
+# urgent first. Before a module is polled its cost is reserved: the requests
+# it took the last time (pages, retries), plus the login when there is no
+# session. What was really sent is settled afterwards, and the logout at
+# shutdown is taken from the budget too.
+#
+POLL_BASE = {
+	'system':		60,
+	'storageprocessor':	60,
+	'disk':			60,
+	'ssd':			60,
+	'powersupply':		60,
+	'fan':			60,
+	'battery':		120,
+	'dae':			120,
+	'dpe':			120,
+	'lcc':			120,
+	'ethernetport':		120,
+	'fcport':		120,
+	'sasport':		300,
+	'iomodule':		300,
+	'memorymodule':		600,
+	'ssc':			600,
+	'uncommittedport':	600,
+}
+
+POLL_MIN        = 10
+POLL_TIGHTEN    = 4
+POLL_BACKOFF    = 1.5
+POLL_MAX_FACTOR = 4
+POLL_BURST      = 10
+
+
+## Token bucket of the requests an array may still be sent. Only used by the
+## thread of its Collector, and by Collector.logout() once it is stopped.
+#
+class RequestBudget(object):
+
+	## A full bucket plus one minute of refill is exactly per_minute requests,
+	## so no minute sees more than that. Below 60 / POLL_BURST requests per
+	## minute the bucket holds less than one: a request then takes the whole
+	## bucket and charge() the rest of its token.
+	def __init__(self, per_minute):
+		self.capacity = per_minute * POLL_BURST / 60.0
+		self.rate     = max(per_minute - self.capacity, 0.0) / 60.0
+		self.tokens   = self.capacity
+		self.stamp    = time.time()
+
+	def refill(self):
+		now = time.time()
+		self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+		self.stamp  = now
+
+	## A cost above the capacity needs a full bucket; charge() then takes the
+	## rest, delaying the next polls. That one poll can go over per_minute by
+	## its excess.
+	def take(self, n):
+		self.refill()
+		n = min(n, self.capacity)
+		if self.tokens < n:
+			return False
+		self.tokens -= n
+		return True
+
+	## Settles the difference between what was taken and what was really sent.
+	def charge(self, n):
+		self.refill()
+		self.tokens -= n
+
+	def wait(self, n):
+		self.refill()
+		return max(0, (min(n, self.capacity) - self.tokens) / self.rate)
+
+
+class Collector(threading.Thread):
+
+	def __init__(self, array, modules, args, published=None):
+		threading.Thread.__init__(self)
+		self.daemon    = True
+		self.array     = array
+		self.modules   = modules
+		self.args      = args
+		self.published = published
+		self.lock      = threading.Lock()
+		self.results   = {}
+		self.token     = 0
+		self.cookie    = 0
+		# Refresh statistics: count, failed ones, last duration and success.
+		self.refreshes = 0
+		self.errors    = 0
+		self.duration  = 0
+		self.refreshed = 0
+		self.budget    = RequestBudget(args.request_budget) if args.request_budget > 0 else None
+
+	def poll(self, modules):
+		hostaddress = self.array['hostaddress']
+		if not (self.token and self.cookie):
+			self.token, self.cookie = login(hostaddress, self.array['user'], self.array['password'])
+		if not (self.token and self.cookie):
+			return [(module, (0, 'COULD_NOT_LOGIN', 'Could not login on REST url')) for module in modules]
+
+		results = runModules(hostaddress, self.token, self.cookie, modules, self.args.workers)
+		if [module for module, result in results if result is None]:
+			self.token, self.cookie = 0, 0
+		return [(module, result) for module, result in results if result is not None]
+
+	## Seconds until 'module' is due again after 'result' (None when there is
+	## none), and its new factor.
+	#
+	def interval(self, module, result, previous, factor):
+		if not self.args.adaptive:
+			return (self.args.interval, factor)
+		if result is None or result[1] in BREAKER_FAILURES:
+			pass
+		elif (not NagiosStatus(*result[:3])) or NagiosStatus(*result[:3])[4] != 0 or (previous is not None and tuple(previous[:3]) != tuple(result[:3])):
+			factor = 1.0 / POLL_TIGHTEN
+		else:
+			factor = min(POLL_MAX_FACTOR, max(1.0, factor * POLL_BACKOFF))
+		base = POLL_BASE.get(module, 60) * self.args.interval / 60.0
+		return (max(POLL_MIN, base * factor), factor)
+
+	def run(self):
+		hostaddress = self.array['hostaddress']
+		due     = dict((module, time.time()) for module in self.modules)
+		factors = dict((module, 1.0) for module in self.modules)
+		costs   = dict((module, 1) for module in self.modules)
+		while True:
+			delay = POLL_MIN
+			try:
+				ready = sorted([module for module in self.modules if due[module] <= time.time()], key=lambda module: (factors[module], due[module]))
+				batch = []
+				login = 0 if (self.token and self.cookie) else 1
+				reserved = 0
+				for module in ready:
+					cost = costs[module] + (0 if batch else login)
+					if self.budget is not None and not self.budget.take(cost):
+						break
+					batch.append(module)
+					reserved += min(cost, self.budget.capacity) if self.budget is not None else 0
+
+				if batch:
+					started = time.time()
+					# Modules without a result this time (poll failure, expired
+					# session) are tried again after their current interval.
+					for module in batch:
+						due[module] = started + self.interval(module, None, None, factors[module])[0]
+					if self.budget is not None:
+						sent = requestCount(hostaddress)
+						counts = dict((module, requestCount(hostaddress, module)) for module in batch)
+					try:
+						results = self.poll(batch)
+					except Exception as e:
+						sys.stderr.write('%s: poll failed: %s\n' % (self.array['name'], e))
+						results = []
+					finished = time.time()
+					if self.budget is not None:
+						self.budget.charge(requestCount(hostaddress) - sent - reserved)
+						for module in batch:
+							costs[module] = max(1, requestCount(hostaddress, module) - counts[module])
+
+					failed = not [module for module, result in results if result[1] not in BREAKER_FAILURES]
+					with self.lock:
+						for module, result in results:
+							previous = self.results.get(module)
+							delay, factors[module] = self.interval(module, result, previous and previous[0], factors[module])
+							due[module] = started + delay
+							self.results[module] = (result, finished)
+						self.refreshes += 1
+						self.duration = finished - started
+						if failed:
+							self.errors += 1
+						else:
+							self.refreshed = finished
+					if self.published is not None:
+						self.published(self)
+
+				waiting = sorted([module for module in self.modules if due[module] <= time.time()], key=lambda module: (factors[module], due[module]))
+				if waiting and self.budget is not None:
+					delay = self.budget.wait(costs[waiting[0]] + (0 if (self.token and self.cookie) else 1))
+				else:
+					delay = min(due.values()) - time.time()
+			except Exception:
+				# Anything failing outside poll() (a 'published' callback) must not
+				# stop the thread: the daemon would serve stale results forever.
+				import traceback
+				sys.stderr.write('%s: collector failed:\n%s' % (self.array['name'], traceback.format_exc()))
+			time.sleep(max(1, delay))
+
+	## Ends the session, unless the budget has no request left for it: the
+	## array then expires the session itself.
+	def logout(self):
+		if not (self.token and self.cookie):
+			return
+		if self.budget is not None and not self.budget.take(1):
+			return
+		try:
+			logout(self.array['hostaddress'], self.token, self.cookie)
+		except Exception:
+			pass
+
+	def snapshot(self, modules):
+		now = time.time()
+		with self.lock:
+			return [(module, self.results[module][0], now - self.results[module][1]) for module in modules if module in self.results]
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+
+	def handle(self):
+		try:
+			request   = json.loads(self.rfile.readline().decode('utf-8'))
+			collector = self.server.collectors.get(request['host'])
+			if collector is None:
+				reply = {'error': 'unknown host %s' % request['host']}
+			else:
+				reply = {'results': collector.snapshot(request['modules'])}
+		except Exception as e:
+			reply = {'error': str(e)}
+		self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+
+def runDaemon(args, arrays):
+	collectors = {}
+	for array in arrays:
+		collector = Collector(array, MODULE_NAMES, args)
+		collectors[array['name']] = collector
+		collectors[array['hostaddress']] = collector
+		collector.start()
+
+	if os.path.exists(args.socket):
+		os.unlink(args.socket)
+	server = DaemonServer(args.socket, DaemonHandler)
+	server.collectors = collectors
+	os.chmod(args.socket, 0o660)
+
+	def stop(signum, frame):
+		sys.exit(0)
+	signal.signal(signal.SIGTERM, stop)
+
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+		os.unlink(args.socket)
+		for collector in set(collectors.values()):
+			collector.logout()
+
+
+## Asks the daemon for the latest results of 'modules' on hostaddress. Missing
+## or older than max_age results are reported as UNKNOWN.
+#
+def queryDaemon(socketpath, hostaddress, modules, max_age, timeout=5):
+	s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	s.settimeout(timeout)
+	try:
+		s.connect(socketpath)
+		s.sendall((json.dumps({'host': hostaddress, 'modules': modules}) + '\n').encode('utf-8'))
+		f = s.makefile('rb')
+		reply = json.loads(f.readline().decode('utf-8'))
+		f.close()
+	except (socket.error, ValueError):
+		return [(module, (0, 'COULD_NOT_QUERY_DAEMON', 'I could not query the daemon on %s' % socketpath)) for module in modules]
+	finally:
+		s.close()
+
+	if 'error' in reply:
+		return [(module, (0, 'DAEMON_ERROR', reply['error'])) for module in modules]
+
+	fresh = dict((module, result) for module, result, age in reply['results'] if age <= max_age)
+	return [(module, tuple(fresh.get(module, (0, 'NO_RECENT_DAEMON_DATA', 'The daemon has no result younger than %ds' % max_age)))) for module in modules]
+
+
+## Exporter mode
+#
+# Serves the results of the Collectors as Prometheus/OpenMetrics text on
+# http://--listen/metrics. The page is rendered once after every refresh of
+# an array, so a scrape only copies the last page and never reaches an array,
+# however often Prometheus asks.
+#
+EXPORTER_METRICS = [
+	('unity_health', 'gauge', 'Health value of the worst component of the module (5 = OK)'),
+	('unity_status', 'gauge', 'Nagios state of the module (0 OK, 1 WARNING, 2 CRITICAL, 3 UNKNOWN)'),
+	('unity_module_up', 'gauge', 'Whether the module got an answer from the array in its last refresh'),
+	('unity_result_timestamp_seconds', 'gauge', 'Time of the last result of the module'),
+	('unity_perfdata', 'gauge', 'Performance and capacity values of the module'),
+	('unity_refresh_duration_seconds', 'gauge', 'Duration of the last refresh of the array'),
+	('unity_refreshes_total', 'counter', 'Refreshes of the array'),
+	('unity_refresh_errors_total', 'counter', 'Refreshes of the array that got no answer at all'),
+	('unity_last_refresh_success_timestamp_seconds', 'gauge', 'Time of the last refresh that got an answer from the array'),
+]
+
+
+def promLabels(**labels):
+	escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in sorted(labels.items())]
+	return '{%s}' % ','.join('%s="%s"' % kv for kv in escaped)
+
+
+## Sample values as the text exposition format spells them: repr() would
+## give 'nan' and 'inf'.
+#
+def promValue(value):
+	value = float(value)
+	if value != value:
+		return 'NaN'
+	if value in (INF, -INF):
+		return '+Inf' if value > 0 else '-Inf'
+	return repr(value)
+
+
+def renderMetrics(collectors):
+	samples = dict((name, []) for name, kind, help in EXPORTER_METRICS)
+	for collector in collectors:
+		array = collector.array['name']
+		with collector.lock:
+			results = sorted(collector.results.items())
+			stats = (collector.duration, collector.refreshes, collector.errors, collector.refreshed)
+		for module, (result, stamp) in results:
+			labels = promLabels(array=array, module=module)
+			value, descid, desc = result[:3]
+			samples['unity_health'].append((labels, value))
+			samples['unity_status'].append((labels, NagiosStatus(value, descid, desc)[4]))
+			samples['unity_module_up'].append((labels, 0 if descid in BREAKER_FAILURES else 1))
+			samples['unity_result_timestamp_seconds'].append((labels, stamp))
+			for p in resultPerfdata(result):
+				samples['unity_perfdata'].append((promLabels(array=array, module=module, label=p[0], unit=p[2]), p[1]))
+		labels = promLabels(array=array)
+		samples['unity_refresh_duration_seconds'].append((labels, stats[0]))
+		samples['unity_refreshes_total'].append((labels, stats[1]))
+		samples['unity_refresh_errors_total'].append((labels, stats[2]))
+		samples['unity_last_refresh_success_timestamp_seconds'].append((labels, stats[3]))
+
+	lines = []
+	for name, kind, help in EXPORTER_METRICS:
+		lines.append('# HELP %s %s' % (name, help))
+		lines.append('# TYPE %s %s' % (name, kind))
+		for labels, value in samples[name]:
+			lines.append('%s%s %s' % (name, labels, promValue(value)))
+	return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def runExporter(args, arrays, modules):
+	try:
+		from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	except ImportError:
+		from http.server import BaseHTTPRequestHandler, HTTPServer
+
+	class ExporterHandler(BaseHTTPRequestHandler):
+
+		def do_GET(self):
+			if self.path.split('?')[0] != '/metrics':
+				self.send_error(404)
+				return
+			page = self.server.page
+			self.send_response(200)
+			self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+			self.send_header('Content-Length', str(len(page)))
+			self.end_headers()
+			self.wfile.write(page)
+
+		def log_message(self, format, *args):
+			pass
+
+	class ExporterServer(socketserver.ThreadingMixIn, HTTPServer):
+		daemon_threads = True
+		allow_reuse_address = True
+
+	address, sep, port = args.listen.rpartition(':')
+	server = ExporterServer((address, int(port)), ExporterHandler)
+	render = threading.Lock()
+	collectors = []
+
+	def published(collector):
+		with render:
+			server.page = renderMetrics(collectors)
+
+	for array in arrays:
+		collectors.append(Collector(array, modules, args, published))
+	server.page = renderMetrics(collectors)
+	for collector in collectors:
+		collector.start()
+
+	def stop(signum, frame):
+		sys.exit(0)
+	signal.signal(signal.SIGTERM, stop)
+
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+		for collector in collectors:
+			collector.logout()
+
+
+## Passive check results
+#
+# With --passive-command-file and/or --passive-spool-dir every host/module
+# result of the run is also submitted to Nagios as a passive service check
+# result, named after --passive-service. Command file lines are grouped into
+# writes of at most PIPE_BUF bytes, which the pipe keeps atomic; spool results
+# all go into one check_result file that only appears (with its .ok marker)
+# once it is complete.
+#
+PIPE_BUF = getattr(select, 'PIPE_BUF', 512)
+
+
+def passiveResults(hosts, service):
+	for name, results in hosts:
+		for module, result in results:
+			value, descid, desc = result[:3]
+			perfdata = resultPerfdata(result)
+			s_nagios, s_msg1, s_msg2, s_val, s_exit = NagiosStatus(value, descid, desc)
+			output = '%s: %s,%s,%s' % (s_nagios,s_msg1,s_msg2,s_val)
+			if perfdata:
+				output += ' | ' + formatPerfdata(perfdata)
+			yield (name, service % {'host': name, 'module': module}, s_exit, output)
+
+
+def writeAll(fd, data):
+	while data:
+		data = data[os.write(fd, data):]
+
+
+def writeCommandFile(path, results, finished):
+	# O_NONBLOCK makes the open fail (ENXIO) instead of hanging when Nagios
+	# is not reading the pipe; the writes themselves are blocking.
+	fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_NONBLOCK)
+	try:
+		fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+		batch = b''
+		for host, service, code, output in results:
+			# A newline from the array would end the command and start another.
+			output = output.replace('\r', '').replace('\n', '\\n')
+			line = ('[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n' % (finished, host, service, code, output)).encode('utf-8')
+			if batch and len(batch) + len(line) > PIPE_BUF:
+				writeAll(fd, batch)
+				batch = b''
+			batch += line
+		if batch:
+			writeAll(fd, batch)
+	finally:
+		os.close(fd)
+
+
+def writeSpoolFile(spooldir, results, started, finished):
+	lines = ['### Passive Check Result File ###', 'file_time=%d' % finished, '']
+	for host, service, code, output in results:
+		lines += [
+			'### Nagios Service Check Result ###',
+			'# Time: %s' % time.ctime(finished),
+			'host_name=%s' % host,
+			'service_description=%s' % service,
+			'check_type=1',
+			'check_options=0',
+			'scheduled_check=0',
+			'reschedule_check=0',
+			'latency=0.0',
+			'start_time=%f' % started,
+			'finish_time=%f' % finished,
+			'early_timeout=0',
+			'exited_ok=1',
+			'return_code=%d' % code,
+			'output=%s' % output.replace('\\', '\\\\').replace('\n', '\\n'),
+			'',
+		]
+
+	import tempfile
+	fd, tmp = tempfile.mkstemp(prefix='.check_unity-', dir=spooldir)
+	try:
+		writeAll(fd, ('\n'.join(lines) + '\n').encode('utf-8'))
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+	# Nagios only picks up files named 'c' plus six characters, and only
+	# once the matching .ok file exists.
+	try:
+		while True:
+			path = os.path.join(spooldir, 'c' + ''.join(random.choice(string.ascii_letters + string.digits) for n in range(6)))
+			try:
+				os.link(tmp, path)
+				break
+			except OSError as e:
+				if e.errno != errno.EEXIST:
+					raise
+	finally:
+		os.unlink(tmp)
+	os.close(os.open(path + '.ok', os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+
+
+def submitPassive(hosts, args, started):
+	results = list(passiveResults(hosts, args.passive_service))
+	finished = time.time()
+	if args.passive_command_file:
+		writeCommandFile(args.passive_command_file, results, finished)
+	if args.passive_spool_dir:
+		writeSpoolFile(args.passive_spool_dir, results, started, finished)
+
+
+## Last resort when a request blocks past --timeout: answer UNKNOWN ourselves
+## before Nagios kills the plugin.
+#
+def timedOut(signum, frame):
+	sys.stdout.write('UNKNOWN: %s,%s,0\n' % EmptyTimedOut()[1:])
+	sys.stdout.flush()
+	if PROFILE is not None:
+		PROFILE.finish()
+	os._exit(3)
 
 
 def main():
-	parser = argparse.ArgumentParser(description="Script for EMC Unity Storage monitoring",epilog='''Example:  ./check_unity2.py -H 10.0.0.1 -m DAE -u user -p pass''')
-	parser.add_argument("-H", "--hostaddress", type=str, required=True, help="Host address for the URL")
-	parser.add_argument("-u", "--user", type=str, required=True, help="Username for system login")
-	parser.add_argument("-p", "--password", type=str, required=True, help="Password for system login")
-	parser.add_argument("-m", "--module", type=str, choices=['battery','dae','disk','dpe','ethernetport','fan','fcport','iomodule','lcc','memorymodule','powersupply','sasport','ssc','ssd','storageprocessor','system','uncommittedport'], required=True, help="Requested MODULE for getting status. Possible options are: battery dae disk dpe ethernetport fan fcPort ioModule lcc memoryModule powerSupply sasPort ssc ssd storageProcessor system uncommittedPort")
+	parser = argparse.ArgumentParser(description="Script for EMC Unity Storage monitoring",epilog='''Example:  ./check_unity2.py -H 10.0.0.1 -m dae,disk,fan -u user -p pass''')
+	parser.add_argument("-H", "--hostaddress", type=str, help="Host address for the URL (or inventory name with --client)")
+	parser.add_argument("-u", "--user", type=str, help="Username for system login")
+	parser.add_argument("-p", "--password", type=str, help="Password for system login")
+	parser.add_argument("-m", "--module", type=str, nargs='+', help="Requested MODULE(s) for getting status, separated by spaces or commas. Possible options are: all battery dae disk dpe ethernetport fan fcPort ioModule lcc memoryModule powerSupply sasPort ssc ssd storageProcessor system uncommittedPort, the performance modules spcpu luniops lunlatency (and their history over --trend-hours: spcputrend luniopstrend lunlatencytrend), the capacity modules pool lun (thin LUNs only) filesystem, and alert (new array alerts since the previous check)")
+	parser.add_argument("-w", "--warning", type=float, help="Warning threshold of the performance and capacity modules (default: per module)")
+	parser.add_argument("-c", "--critical", type=float, help="Critical threshold of the performance and capacity modules (default: per module)")
+	parser.add_argument("--trend-hours", type=int, default=24, help="Hours of metric history read by the trend modules (default: 24)")
+	parser.add_argument("--trend-window", type=int, default=60, help="Minutes per window of the trend summaries (default: 60)")
+	parser.add_argument("--trend-interval", type=int, default=300, help="Sample interval of the metric history in seconds, as kept by the array (default: 300)")
+	parser.add_argument("--trend-export", type=str, metavar='FILE', help="Write the per-window trend summaries as CSV to FILE ('%%(module)s' is replaced by the module)")
+	parser.add_argument("--top", type=int, default=5, help="Fullest objects of a capacity module reported as perfdata (default: 5)")
+	parser.add_argument("--metric-interval", type=int, default=60, help="Sampling interval of the real-time metric queries in seconds (default: 60)")
+	parser.add_argument("--workers", type=int, default=4, help="Maximum number of concurrent module requests (default: 4)")
+	parser.add_argument("-t", "--timeout", type=int, default=30, help="Overall time budget of the check in seconds, keep it below the Nagios service_check_timeout (default: 30)")
+	parser.add_argument("--transport", type=str, choices=['requests', 'stdlib'], default='requests', help="HTTP client: python-requests, or the lighter standard library client with keep-alive (default: requests)")
+	parser.add_argument("--connect-timeout", type=float, default=5, help="Connect timeout of each request in seconds (default: 5)")
+	parser.add_argument("--read-timeout", type=float, default=20, help="Read timeout of each request in seconds (default: 20)")
+	parser.add_argument("--page-size", type=int, default=2000, help="Instances requested per page of a collection (default: 2000)")
+	parser.add_argument("--early-exit", action='store_true', help="Stop reading a collection at the first CRITICAL component")
+	parser.add_argument("--server-filter", action='store_true', help="Have the array send only components that are not OK (Unity filter), plus one OK component when all are")
+	parser.add_argument("--retries", type=int, default=2, help="Retries of a GET or DELETE request on connection errors and 5xx answers (default: 2)")
+	parser.add_argument("--state-dir", type=str, default='/var/tmp/check_unity', help="Directory for the plugin state files (default: /var/tmp/check_unity)")
+	parser.add_argument("--session-cache", action='store_true', help="Reuse the REST session between runs instead of login/logout on every check")
+	parser.add_argument("--session-ttl", type=int, default=1800, help="Seconds a cached session is reused before logging in again (default: 1800)")
+	parser.add_argument("--cache-ttl", type=int, default=0, help="Share module results between plugin processes for this many seconds (default: 0, disabled)")
+	parser.add_argument("--cache-size", type=int, default=10000, help="Maximum number of host/module results kept in the response cache (default: 10000)")
+	parser.add_argument("--breaker-threshold", type=int, default=0, help="Stop asking an array after this many consecutive checks could not reach it (default: 0, disabled)")
+	parser.add_argument("--breaker-cooldown", type=int, default=60, help="Seconds checks of an unreachable array answer at once before one of them tries again (default: 60)")
+	parser.add_argument("--breaker-status", type=str, choices=['unknown', 'critical'], default='unknown', help="Status of the checks skipped by the breaker (default: unknown)")
+	parser.add_argument("--snapshot", action='store_true', help="Keep a snapshot of the components of each host in --state-dir and report new, removed and changed ones (reads every component, so --server-filter is ignored)")
+	parser.add_argument("--history", action='store_true', help="Record results and component state changes in <state-dir>/history.db, and report flapping modules")
+	parser.add_argument("--history-days", type=int, default=7, help="Days of state changes kept in the history (default: 7)")
+	parser.add_argument("--flap-high", type=float, default=50, help="Percent of state changes from which a module is flapping (default: 50)")
+	parser.add_argument("--flap-low", type=float, default=25, help="Percent of state changes below which a module stops flapping (default: 25)")
+	parser.add_argument("--history-query", type=float, metavar='HOURS', help="Print the state changes of the last HOURS (of -H, or of every host) from the history and exit")
+	parser.add_argument("--profile", type=str, metavar='DIR', help="Write cProfile statistics of every module and of the run, and the top allocation sites, to DIR (checks modules one at a time)")
+	parser.add_argument("--timings", action='store_true', help="Append per-phase timings, response bytes and entry counts to the perfdata")
+	parser.add_argument("--trace-log", type=str, help="Append one JSON line with the per-phase timings of every run to this file")
+	parser.add_argument("--daemon", action='store_true', help="Run the collector daemon for every array in --inventory")
+	parser.add_argument("--client", action='store_true', help="Answer the check from the collector daemon instead of the array")
+	parser.add_argument("--inventory", type=str, help="Inventory file listing the arrays (INI, one section per array). Without --daemon, checks every array of it")
+	parser.add_argument("--fleet-workers", type=int, default=8, help="Maximum number of arrays checked concurrently with --inventory (default: 8)")
+	parser.add_argument("--exporter", action='store_true', help="Serve the -m modules (default: all) of every array in --inventory as Prometheus metrics")
+	parser.add_argument("--listen", type=str, default='127.0.0.1:9597', help="Address:port of the --exporter HTTP server (default: 127.0.0.1:9597)")
+	parser.add_argument("--adaptive", action='store_true', help="Daemon/exporter: poll each module at its own interval, more often while it is not OK or changing, less while it is stable")
+	parser.add_argument("--request-budget", type=int, default=0, help="Daemon/exporter: most requests per minute sent to one array (default: 0, unlimited)")
+	parser.add_argument("--socket", type=str, help="Unix socket of the collector daemon (default: <state-dir>/check_unity.sock)")
+	parser.add_argument("--interval", type=int, default=60, help="Polling interval of the daemon and exporter in seconds (default: 60)")
+	parser.add_argument("--passive-command-file", type=str, help="Also submit every result as PROCESS_SERVICE_CHECK_RESULT to this Nagios command file")
+	parser.add_argument("--passive-spool-dir", type=str, help="Also submit every result as a check result file in this Nagios check_result_path")
+	parser.add_argument("--passive-service", type=str, default='%(module)s', help="Service description of passive results, with %%(host)s and %%(module)s (default: %%(module)s)")
+	parser.add_argument("--passive-host", type=str, help="Nagios host name of passive results for -H (default: the -H value; inventory section names with --inventory)")
+	parser.add_argument("--max-age", type=int, default=300, help="Oldest daemon result accepted by --client, in seconds (default: 300)")
 	args = parser.parse_args()
 
+	if not args.socket:
+		args.socket = os.path.join(args.state_dir, 'check_unity.sock')
+
+	REST['transport']	= args.transport
+	if args.transport == 'stdlib':
+		import ssl
+		if not hasattr(ssl, '_create_unverified_context'):
+			parser.error('--transport stdlib needs Python 2.7.9 or later')
+	REST['connect_timeout']	= args.connect_timeout
+	REST['read_timeout']	= args.read_timeout
+	REST['retries']		= args.retries
+	FETCH['page_size']	= args.page_size
+	FETCH['early_exit']	= args.early_exit
+	# Snapshots need every component, not only the unhealthy ones.
+	FETCH['server_filter']	= args.server_filter and not args.snapshot
+	METRIC['state_dir']	= args.state_dir
+	CAPACITY['top']		= args.top
+	TREND['hours']		= args.trend_hours
+	TREND['window']		= args.trend_window
+	TREND['interval']	= args.trend_interval
+	TREND['export']		= args.trend_export
+	METRIC['interval']	= args.metric_interval
+	METRIC['warning']	= args.warning
+	METRIC['critical']	= args.critical
+
+	global REQUEST_COUNTS
+	if args.request_budget > 0:
+		REQUEST_COUNTS = {}
+
+	# Only for the state kept outside the modules: the alert, metric and trend
+	# modules answer UNSAFE_STATE_DIR themselves, and a --client or a check
+	# of stateless modules does not touch --state-dir at all.
+	stateful = args.session_cache or args.cache_ttl > 0 or args.breaker_threshold > 0 or args.history or args.snapshot
+	if (args.history_query is not None or (stateful and not (args.client or args.daemon or args.exporter))) and os.path.lexists(args.state_dir):
+		try:
+			checkStateDir(args.state_dir)
+		except UnsafeStateDir as e:
+			print ('UNKNOWN: UNSAFE_STATE_DIR,%s; refusing to use it,0' % e)
+			sys.exit(3)
+
+	if args.history_query is not None:
+		queryHistory(args.state_dir, args.history_query, args.hostaddress)
+		sys.exit(0)
+
+	if args.daemon or args.exporter:
+		if not args.inventory:
+			parser.error('--%s requires --inventory' % ('daemon' if args.daemon else 'exporter'))
+		try:
+			arrays = readInventory(args.inventory)
+		except (IOError, ValueError) as e:
+			parser.error(str(e))
+
+	if args.daemon:
+		makeStateDir(os.path.dirname(args.socket) or '.', private=False)
+		runDaemon(args, arrays)
+		sys.exit(0)
+
+	if args.exporter:
+		runExporter(args, arrays, parseModules(parser, args.module or ['all']))
+		sys.exit(0)
+
 	hostaddress	= args.hostaddress
 	user		= args.user
 	password	= args.password
-	module		= args.module
-
-	if (not hostaddress and not user and not password and not module):
-		parser.print_help()
-		sys.exit(1)
-
-	token, cookie = login(hostaddress, user, password)
-
-	value  = None
-	descid = None
-	desc   = None
-
-	if token and cookie:
-
-		if (module.lower() == 'system'):
-			value, descid, desc = getSystem(hostaddress, token, cookie)
-		if (module.lower() == 'battery'):
-			value, descid, desc = getBattery(hostaddress, token, cookie)
-		if (module.lower() == 'dae'):
-			value, descid, desc = getDae(hostaddress, token, cookie)
-		if (module.lower() == 'disk'):
-			value, descid, desc = getDisk(hostaddress, token, cookie)
-		if (module.lower() == 'dpe'):
-			value, descid, desc = getDpe(hostaddress, token, cookie)
-		if (module.lower() == 'ethernetport'):
-			value, descid, desc = getEthernetport(hostaddress, token, cookie)
-		if (module.lower() == 'fan'):
-			value, descid, desc = getFan(hostaddress, token, cookie)
-		if (module.lower() == 'fcport'):
-			value, descid, desc = getFcport(hostaddress, token, cookie)
-		if (module.lower() == 'iomodule'):
-			value, descid, desc = getIomodule(hostaddress, token, cookie)
-		if (module.lower() == 'lcc'):
-			value, descid, desc = getLcc(hostaddress, token, cookie)
-		if (module.lower() == 'memorymodule'):
-			value, descid, desc = getMemorymodule(hostaddress, token, cookie)
-		if (module.lower() == 'powersupply'):
-			value, descid, desc = getPowersupply(hostaddress, token, cookie)
-		if (module.lower() == 'sasport'):
-			value, descid, desc = getSasport(hostaddress, token, cookie)
-		if (module.lower() == 'ssc'):
-			value, descid, desc = getSsc(hostaddress, token, cookie)
-		if (module.lower() == 'ssd'):
-			value, descid, desc = getSsd(hostaddress, token, cookie)
-		if (module.lower() == 'storageprocessor'):
-			value, descid, desc = getStorageprocessor(hostaddress, token, cookie)
-		if (module.lower() == 'uncommittedport'):
-			value, descid, desc = getUncommittedport(hostaddress, token, cookie)
-
-                s = logout(hostaddress, token, cookie)
+
+	if not args.module:
+		parser.error('the following arguments are required: -m/--module')
+	if not args.inventory and not hostaddress:
+		parser.error('the following arguments are required: -H/--hostaddress')
+	if not args.inventory and not args.client and not (user and password):
+		parser.error('the following arguments are required: -u/--user, -p/--password')
+
+	modules		= parseModules(parser, args.module)
+
+	if args.timeout > 0:
+		REST['deadline'] = time.time() + args.timeout - DEADLINE_MARGIN
+		signal.signal(signal.SIGALRM, timedOut)
+		signal.alarm(args.timeout)
+
+	global TRACE, OBSERVED, PROFILE
+	if args.timings or args.trace_log or args.profile:
+		TRACE = Trace()
+	if args.profile:
+		makeStateDir(args.profile, private=False)
+		PROFILE = Profile(args.profile)
+		args.workers = args.fleet_workers = 1
+		atexit.register(PROFILE.finish)
+	if args.history or args.snapshot:
+		OBSERVED = {}
+
+	started = time.time()
+	if args.inventory:
+		try:
+			arrays = readInventory(args.inventory)
+		except (IOError, ValueError) as e:
+			parser.error(str(e))
+		hosts = checkFleet(arrays, modules, args)
+	elif args.client:
+		hosts = [(args.passive_host or hostaddress, queryDaemon(args.socket, hostaddress, modules, args.max_age))]
 	else:
-		value  = 0
-		descid = 'COULD_NOT_LOGIN'
-		desc   = 'Could not login on REST url'
-		
-	
-	if (value or value == 0) and descid and desc:
-		s_nagios, s_msg1, s_msg2, s_val, s_exit = NagiosStatus(value, descid, desc)
-		print ('%s: %s,%s,%s' % (s_nagios,s_msg1,s_msg2,s_val))
-                sys.exit(s_exit)
-	sys.exit(0)
+		hosts = [(args.passive_host or hostaddress, checkHost(hostaddress, user, password, modules, args))]
+
+	if args.passive_command_file or args.passive_spool_dir:
+		try:
+			submitPassive(hosts, args, started)
+		except (IOError, OSError) as e:
+			print ('UNKNOWN: COULD_NOT_SUBMIT_PASSIVE,%s,0' % e)
+			sys.exit(3)
+
+	perfdata = TRACE.perfdata() if (TRACE is not None and args.timings) else None
+	if args.inventory:
+		status = report([('%s: %s' % (name, module), prefixPerfdata(result, name + ' ')) for name, results in hosts for module, result in results], perfdata)
+	else:
+		status = report(hosts[0][1], perfdata)
+
+	if TRACE is not None and args.trace_log:
+		try:
+			TRACE.write(args.trace_log, [name for name, results in hosts], modules, status)
+		except (IOError, OSError):
+			pass
+	sys.exit(status)
 
 
 if __name__ == '__main__':
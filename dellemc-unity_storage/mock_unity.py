@@ -0,0 +1,519 @@
+#!/usr/bin/python
+
+'''
+* DESCRIPTION :
+*       Local stand-in for the EMC Unity REST API, for benchmarks and tests
+*	of check_unity.py without a real array.
+*
+* Implements the login/logout calls, every /api/types/<type>/instances
+* collection used by check_unity.py (with page/per_page pagination,
+* with_entrycount, orderby and simple filter expressions such as
+* 'health.value ne 5'), the alert collection, the real-time metric query
+* calls and the metric history (metricValue). Collections are
+* generated with --count entries each, or replayed from recorded responses:
+*
+*	curl -k -u user:pass -H 'X-EMC-REST-CLIENT: true' \
+*	  'https://<array>/api/types/disk/instances?fields=health,id&per_page=2000&compact=true' > fixtures/disk.json
+*
+* Latency (--latency/--jitter) and 503 answers (--error-rate) can be injected.
+* The listening address is printed on the first line of stdout.
+*
+'''
+
+import argparse
+import base64
+import json
+import os
+import random
+import re
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+	from urlparse import urlparse, parse_qs
+except ImportError:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+	from urllib.parse import urlparse, parse_qs
+
+
+## Collections served by default, with their default number of entries.
+#
+TYPES = {
+	'system':		1,
+	'battery':		2,
+	'dae':			4,
+	'disk':			100,
+	'dpe':			1,
+	'ethernetPort':		16,
+	'fan':			10,
+	'fcPort':		8,
+	'ioModule':		4,
+	'lcc':			8,
+	'memoryModule':		8,
+	'powerSupply':		10,
+	'sasPort':		8,
+	'ssc':			0,
+	'ssd':			2,
+	'storageProcessor':	2,
+	'uncommittedPort':	0,
+	'pool':			2,
+	'lun':			50,
+	'filesystem':		20,
+}
+
+## Collections whose entries also get a name, a size and the given used
+## fields, between 10% and 99% of the size.
+#
+SIZED = {
+	'pool':		['sizeUsed', 'sizeFree'],
+	'lun':		['sizeAllocated'],
+	'filesystem':	['sizeUsed', 'sizeAllocated'],
+}
+
+HEALTH = {
+	0:	('ALRT_COMPONENT_UNKNOWN', 'The component health is unknown.'),
+	5:	('ALRT_COMPONENT_OK', 'The component is operating normally. No action is required.'),
+	7:	('ALRT_COMPONENT_OK_BUT', 'The component is operating normally, with a minor warning.'),
+	10:	('ALRT_COMPONENT_DEGRADED', 'The component is degraded.'),
+	15:	('ALRT_COMPONENT_MINOR', 'The component has a minor issue.'),
+	20:	('ALRT_COMPONENT_MAJOR', 'The component has a major issue.'),
+	25:	('ALRT_COMPONENT_FAULTED', 'The component has faulted.'),
+	30:	('ALRT_COMPONENT_NON_RECOVERABLE', 'The component has a non recoverable error.'),
+}
+
+
+## Filter expressions: 'attribute op value' terms joined with 'and', where op
+## is one of eq, ne, lt, le, gt, ge and value a number or a quoted string.
+#
+FILTER_RE = re.compile(r'\s*([\w.]+)\s+(eq|ne|lt|le|gt|ge)\s+("[^"]*"|[-+\w.]+)\s*(?:and\b|$)', re.I)
+
+FILTER_OPS = {
+	'eq': lambda a, b: a == b,
+	'ne': lambda a, b: a != b,
+	'lt': lambda a, b: a is not None and a < b,
+	'le': lambda a, b: a is not None and a <= b,
+	'gt': lambda a, b: a is not None and a > b,
+	'ge': lambda a, b: a is not None and a >= b,
+}
+
+
+def parseFilter(filter):
+	terms = []
+	pos = 0
+	while pos < len(filter):
+		m = FILTER_RE.match(filter, pos)
+		if not m or m.end() == pos:
+			raise ValueError('bad filter at %r' % filter[pos:])
+		attribute, op, value = m.groups()
+		value = value[1:-1] if value.startswith('"') else json.loads(value)
+		terms.append((attribute.split('.'), FILTER_OPS[op.lower()], value))
+		pos = m.end()
+	return terms
+
+
+def matchFilter(terms, content):
+	for path, op, value in terms:
+		x = content
+		for name in path:
+			x = x.get(name) if isinstance(x, dict) else None
+		if not op(x, value):
+			return False
+	return True
+
+
+## Builds the entries of every collection as pre-serialized JSON strings, so
+## that pages of tens of thousands of entries are cheap to serve, each with
+## its parsed 'content' for filters.
+#
+def buildCollections(counts, health, fixtures):
+	collections = {}
+	for name, count in counts.items():
+		values = [5] * count
+		value, n = health.get(name, (5, 0))
+		for i in range(max(0, count - n), count):
+			values[i] = value
+		entries = []
+		for i, value in enumerate(values):
+			descid, desc = HEALTH.get(value, HEALTH[0])
+			content = {'id': '%s_%d' % (name, i), 'health': {'value': value, 'descriptionIds': [descid], 'descriptions': [desc], 'resolutionIds': [], 'resolutions': []}}
+			if name in SIZED:
+				rnd = random.Random('%s_%d' % (name, i))
+				size = rnd.randint(1, 1024) * 1073741824
+				used = int(size * rnd.uniform(0.1, 0.99))
+				content.update({'name': '%s_%d' % (name, i), 'sizeTotal': size})
+				if name == 'lun':
+					# A third of the LUNs are thick, allocated in full.
+					content['isThinEnabled'] = i % 3 != 0
+					if not content['isThinEnabled']:
+						used = size
+				for field in SIZED[name]:
+					content[field] = size - used if field == 'sizeFree' else used
+			entries.append((content, json.dumps({'content': content})))
+		collections[name] = entries
+
+	if fixtures:
+		for filename in os.listdir(fixtures):
+			if filename.endswith('.json'):
+				with open(os.path.join(fixtures, filename)) as f:
+					recorded = json.load(f)
+				collections[filename[:-5].lower()] = [(x['content'], json.dumps(x)) for x in recorded['entries']]
+	return collections
+
+
+## Alerts cycle through these (severity, messageId, message).
+#
+ALERT_MESSAGES = [
+	(6, '14:60002', 'The component is operating normally.'),
+	(4, '14:60001', 'Storage pool has exceeded its user-specified threshold.'),
+	(6, '14:60003', 'A scheduled snapshot was created.'),
+	(3, '14:60004', 'A disk has faulted.'),
+	(2, '14:60005', 'Storage processor has faulted.'),
+]
+
+
+def makeAlert(n, stamp):
+	severity, messageId, message = ALERT_MESSAGES[n % len(ALERT_MESSAGES)]
+	content = {'id': 'alert_%d' % n, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(stamp)), 'severity': severity, 'messageId': messageId, 'message': message, 'isAcknowledged': False}
+	return (content, json.dumps({'content': content}))
+
+
+class MockHandler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, format, *args):
+		if self.server.options.verbose:
+			BaseHTTPRequestHandler.log_message(self, format, *args)
+
+	def reply(self, status, body, headers=None):
+		body = body.encode('utf-8')
+		if len(body) > 1024 and 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+			gz = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+			body = gz.compress(body) + gz.flush()
+			headers = dict(headers or {}, **{'Content-Encoding': 'gzip'})
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		for k, v in (headers or {}).items():
+			self.send_header(k, v)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def error(self, status, message):
+		self.reply(status, json.dumps({'error': {'errorCode': status, 'httpStatusCode': status, 'messages': [{'en-US': message}]}}))
+
+	def injected(self):
+		options = self.server.options
+		if options.latency or options.jitter:
+			time.sleep((options.latency + random.uniform(0, options.jitter)) / 1000.0)
+		if options.error_rate and random.random() < options.error_rate:
+			self.error(503, 'Injected error')
+			return True
+		return False
+
+	def authorized(self):
+		token  = self.headers.get('EMC-CSRF-TOKEN')
+		cookie = re.search(r'mod_sec_emc=(\w+)', self.headers.get('Cookie') or '')
+		with self.server.lock:
+			return bool(cookie) and self.server.sessions.get(cookie.group(1)) == token
+
+	def do_GET(self):
+		if self.injected():
+			return
+		url = urlparse(self.path)
+		query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+
+		if url.path == '/api/types/loginSessionInfo':
+			return self.login()
+		if not self.authorized():
+			return self.error(401, 'Unauthorized')
+
+		m = re.match(r'^/api/instances/metricRealTimeQuery/(\d+)$', url.path)
+		if m:
+			if self.metricQuery(int(m.group(1))) is None:
+				return self.error(404, 'Unknown query')
+			return self.reply(200, json.dumps({'@base': 'https://localhost/api/instances/metricRealTimeQuery', 'content': {'id': int(m.group(1))}}))
+
+		m = re.match(r'^/api/types/(\w+)/instances$', url.path)
+		if not m:
+			return self.error(404, 'Not found')
+		name = m.group(1).lower()
+		if name == 'metricqueryresult':
+			return self.metricResults(query)
+		if name == 'metricvalue':
+			return self.metricValues(query)
+		if name == 'alert':
+			entries = self.alerts()
+		elif name in self.server.collections:
+			entries = self.server.collections[name]
+		else:
+			return self.error(404, 'Unknown type %s' % m.group(1))
+		if query.get('filter'):
+			try:
+				terms = parseFilter(query['filter'])
+			except ValueError as e:
+				return self.error(422, str(e))
+			entries = [x for x in entries if matchFilter(terms, x[0])]
+		if query.get('orderby'):
+			attribute, sep, direction = query['orderby'].partition(' ')
+			entries = sorted(entries, key=lambda x: x[0].get(attribute), reverse=direction.strip().lower() == 'desc')
+		self.page([entry for content, entry in entries], query)
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8')
+		if self.injected():
+			return
+		if not self.authorized():
+			return self.error(401, 'Unauthorized')
+
+		url = urlparse(self.path)
+		if url.path == '/api/types/loginSessionInfo/action/logout':
+			cookie = re.search(r'mod_sec_emc=(\w+)', self.headers.get('Cookie'))
+			with self.server.lock:
+				self.server.sessions.pop(cookie.group(1), None)
+			return self.reply(200, json.dumps({'logout': True}))
+		if url.path == '/api/types/metricRealTimeQuery/instances':
+			with self.server.lock:
+				self.server.query_ids += 1
+				id = self.server.query_ids
+				self.server.queries[id] = {'paths': json.loads(body)['paths'], 'read': time.time()}
+			return self.reply(201, json.dumps({'@base': 'https://localhost/api/instances/metricRealTimeQuery', 'content': {'id': id}}))
+		self.error(404, 'Not found')
+
+	def do_DELETE(self):
+		if self.injected():
+			return
+		if not self.authorized():
+			return self.error(401, 'Unauthorized')
+
+		m = re.match(r'^/api/instances/metricRealTimeQuery/(\d+)$', urlparse(self.path).path)
+		if not m:
+			return self.error(404, 'Not found')
+		with self.server.lock:
+			if self.server.queries.pop(int(m.group(1)), None) is None:
+				return self.error(404, 'Unknown query')
+		self.reply(204, '')
+
+	## Returns the metric query 'id', or None when it does not exist or expired
+	## (not read for --metric-query-ttl seconds).
+	#
+	def metricQuery(self, id):
+		ttl = self.server.options.metric_query_ttl
+		with self.server.lock:
+			if ttl:
+				for n in [n for n, q in self.server.queries.items() if q['read'] + ttl < time.time()]:
+					del self.server.queries[n]
+			return self.server.queries.get(id)
+
+	def login(self):
+		options = self.server.options
+		auth = self.headers.get('Authorization') or ''
+		if not auth.startswith('Basic '):
+			return self.error(401, 'Unauthorized')
+		user, sep, password = base64.b64decode(auth[6:]).decode('utf-8').partition(':')
+		if (options.user and user != options.user) or (options.password and password != options.password):
+			return self.error(401, 'Unauthorized')
+
+		token  = '%032x' % random.getrandbits(128)
+		cookie = '%032x' % random.getrandbits(128)
+		with self.server.lock:
+			self.server.sessions[cookie] = token
+		self.reply(200, json.dumps({'@base': 'https://localhost/api/types/loginSessionInfo', 'entries': []}), {'EMC-CSRF-TOKEN': token, 'Set-Cookie': 'mod_sec_emc=%s; Path=/; Secure; HttpOnly' % cookie})
+
+	def page(self, entries, query):
+		per_page = int(query.get('per_page', 2000))
+		page     = int(query.get('page', 1))
+		chunk    = entries[(page - 1) * per_page:page * per_page]
+
+		links = [{'rel': 'self', 'href': '&page=%d' % page}]
+		if page * per_page < len(entries):
+			links.append({'rel': 'next', 'href': '&page=%d' % (page + 1)})
+		head = {'@base': 'https://localhost%s' % urlparse(self.path).path, 'updated': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()), 'links': links}
+		if query.get('with_entrycount') == 'true':
+			head['entryCount'] = len(entries)
+
+		self.reply(200, json.dumps(head)[:-1] + ', "entries": [' + ', '.join(chunk) + ']}')
+
+	## --alerts alerts one minute apart up to the start of the mock, then one
+	## more every --alert-every seconds.
+	#
+	def alerts(self):
+		options = self.server.options
+		with self.server.lock:
+			alerts = self.server.alerts
+			if not alerts:
+				for n in range(options.alerts):
+					alerts.append(makeAlert(n, self.server.started - (options.alerts - n) * 60))
+			if options.alert_every:
+				for k in range(len(alerts) - options.alerts, int((time.time() - self.server.started) / options.alert_every)):
+					alerts.append(makeAlert(len(alerts), self.server.started + (k + 1) * options.alert_every))
+			return list(alerts)
+
+	## Samples change every --metric-step seconds; values are pseudo random
+	## per object but stable within one sample.
+	#
+	def metricResults(self, query):
+		filter = query.get('filter', '')
+		m = re.search(r'queryId eq (\d+)', filter)
+		metricquery = self.metricQuery(int(m.group(1))) if m else None
+		if metricquery is None:
+			return self.error(404, 'Unknown query')
+		metricquery['read'] = time.time()
+
+		step = self.server.options.metric_step
+		stamp = int(time.time()) // step * step
+		timestamp = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(stamp))
+		since = re.search(r'timestamp gt "([^"]+)"', filter)
+		entries = []
+		if not (since and since.group(1) >= timestamp):
+			rnd = random.Random(stamp)
+			luns = self.server.options.luns
+			for path in metricquery['paths']:
+				if '.lun.' in path:
+					values = dict((sp, dict(('sv_%d' % i, round(rnd.uniform(0, 2000), 2)) for i in range(luns))) for sp in ('spa', 'spb'))
+				else:
+					values = dict((sp, round(rnd.uniform(0, 100), 2)) for sp in ('spa', 'spb'))
+				entries.append(json.dumps({'content': {'queryId': int(m.group(1)), 'path': path, 'timestamp': timestamp, 'values': values}}))
+		self.page(entries, query)
+
+	## --metric-days of history per path, newest first as on the array, one
+	## sample per 'interval eq' seconds (default 300); the values of a sample
+	## only depend on path and time. Pages of one filter are kept for the
+	## following page requests.
+	#
+	def metricValues(self, query):
+		filter = query.get('filter', '')
+		path = re.search(r'path eq "([^"]+)"', filter)
+		if not path:
+			return self.error(422, 'metricValue needs a path filter')
+		path = path.group(1)
+		interval = re.search(r'interval eq (\d+)', filter)
+		interval = int(interval.group(1)) if interval else 300
+		since = re.search(r'timestamp gt "([^"]+)"', filter)
+		since = since.group(1) if since else ''
+
+		last = int(time.time()) // interval * interval
+		key = (path, interval, since, last)
+		with self.server.lock:
+			entries = self.server.history.get(key)
+		if entries is None:
+			entries = []
+			luns = self.server.options.luns
+			for n in range(self.server.options.metric_days * 86400 // interval):
+				stamp = last - n * interval
+				timestamp = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(stamp))
+				if timestamp <= since:
+					break
+				rnd = random.Random('%s %d' % (path, stamp))
+				if '.lun.' in path:
+					values = dict((sp, dict(('sv_%d' % i, round(rnd.uniform(0, 2000), 2)) for i in range(luns))) for sp in ('spa', 'spb'))
+				else:
+					values = dict((sp, round(rnd.uniform(0, 100), 2)) for sp in ('spa', 'spb'))
+				entries.append(json.dumps({'content': {'path': path, 'timestamp': timestamp, 'interval': interval, 'values': values}}))
+			with self.server.lock:
+				if len(self.server.history) > 16:
+					self.server.history.clear()
+				self.server.history[key] = entries
+		self.page(entries, query)
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	# Clients hanging up early (--early-exit, timeouts) are not worth a traceback.
+	def handle_error(self, request, client_address):
+		if self.options.verbose:
+			HTTPServer.handle_error(self, request, client_address)
+
+
+def selfSignedCert(directory):
+	certfile = os.path.join(directory, 'cert.pem')
+	keyfile  = os.path.join(directory, 'key.pem')
+	subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost', '-keyout', keyfile, '-out', certfile], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	return certfile, keyfile
+
+
+def parsePairs(parser, values, option):
+	pairs = {}
+	for value in values or []:
+		name, sep, rest = value.partition('=')
+		if not sep:
+			parser.error('%s: expected TYPE=VALUE, got %s' % (option, value))
+		pairs[name.lower()] = rest
+	return pairs
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Mock EMC Unity REST API for check_unity.py")
+	parser.add_argument("--address", type=str, default='127.0.0.1', help="Listening address (default: 127.0.0.1)")
+	parser.add_argument("--port", type=int, default=0, help="Listening port, 0 picks a free one (default: 0)")
+	parser.add_argument("--certfile", type=str, help="TLS certificate (default: a temporary self-signed one, needs openssl)")
+	parser.add_argument("--keyfile", type=str, help="TLS private key")
+	parser.add_argument("-u", "--user", type=str, help="Only accept this user (default: any)")
+	parser.add_argument("-p", "--password", type=str, help="Only accept this password (default: any)")
+	parser.add_argument("--count", type=str, action='append', help="Entries of a collection as TYPE=N, repeatable (e.g. disk=20000)")
+	parser.add_argument("--default-count", type=int, help="Entries of every collection not set with --count (default: a small physical array)")
+	parser.add_argument("--health", type=str, action='append', help="Health of the last entries of a collection as TYPE=VALUE[:N], repeatable (e.g. disk=25:2)")
+	parser.add_argument("--fixtures", type=str, help="Directory of recorded <type>.json responses to replay instead of generated entries")
+	parser.add_argument("--latency", type=float, default=0, help="Added latency per request in ms (default: 0)")
+	parser.add_argument("--jitter", type=float, default=0, help="Random extra latency per request, up to this many ms (default: 0)")
+	parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests answered with 503 (default: 0)")
+	parser.add_argument("--alerts", type=int, default=50, help="Alerts raised before the mock started (default: 50)")
+	parser.add_argument("--alert-every", type=float, default=0, help="Raise a new alert every this many seconds (default: 0, never)")
+	parser.add_argument("--metric-step", type=int, default=60, help="Seconds between two metric samples (default: 60)")
+	parser.add_argument("--metric-query-ttl", type=int, default=0, help="Seconds after which an unread metric query expires (default: 0, never)")
+	parser.add_argument("--metric-days", type=int, default=7, help="Days of metric history (metricValue) (default: 7)")
+	parser.add_argument("--luns", type=int, default=50, help="LUNs in the LUN metric samples (default: 50)")
+	parser.add_argument("-v", "--verbose", action='store_true', help="Log every request to stderr")
+	options = parser.parse_args()
+
+	counts = dict((name.lower(), options.default_count if options.default_count is not None else count) for name, count in TYPES.items())
+	for name, count in parsePairs(parser, options.count, '--count').items():
+		counts[name] = int(count)
+
+	health = {}
+	for name, spec in parsePairs(parser, options.health, '--health').items():
+		value, sep, n = spec.partition(':')
+		health[name] = (int(value), int(n or 1))
+
+	server = MockServer((options.address, options.port), MockHandler)
+	server.options     = options
+	server.lock        = threading.Lock()
+	server.sessions    = {}
+	server.queries     = {}
+	server.query_ids   = 0
+	server.alerts      = []
+	server.history     = {}
+	server.started     = time.time()
+	server.collections = buildCollections(counts, health, options.fixtures)
+
+	tmpdir = None
+	if not options.certfile:
+		tmpdir = tempfile.mkdtemp(prefix='mock_unity-')
+		options.certfile, options.keyfile = selfSignedCert(tmpdir)
+	context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+	context.load_cert_chain(options.certfile, options.keyfile)
+	# The handshake then happens in the request thread, not in accept().
+	server.socket = context.wrap_socket(server.socket, server_side=True, do_handshake_on_connect=False)
+	if tmpdir:
+		shutil.rmtree(tmpdir)
+
+	print ('listening on %s:%d' % server.server_address)
+	sys.stdout.flush()
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,780 @@
+#!/usr/bin/python
+
+'''
+* DESCRIPTION :
+*       Regression tests of check_unity.py against mock_unity.py
+*
+* Covers the parsing and state logic that is easy to get wrong, one test
+* case per feature. Every test starts its own mock_unity.py (needs openssl)
+* and uses --transport stdlib, so python-requests is not needed.
+*
+* Example:
+*	python -m unittest -v test_check_unity
+*	python -m pytest -q test_check_unity.py
+*
+'''
+
+import argparse
+import bisect
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+try:
+	from StringIO import StringIO
+except ImportError:
+	from io import StringIO
+
+HERE   = os.path.dirname(os.path.abspath(__file__))
+PLUGIN = os.path.join(HERE, 'check_unity.py')
+MOCK   = os.path.join(HERE, 'mock_unity.py')
+
+sys.path.insert(0, HERE)
+import check_unity
+import mock_unity
+
+
+## Recorded disk collection whose strings hold what the parser must not
+## mistake for structure: quotes, backslashes, brackets, a nested "entries"
+## key and \u escapes (a surrogate pair among them, as json.dumps writes them).
+#
+FIXTURE_DISKS = [
+	{'id': 'disk_quote', 'name': 'say "hi", then ] and }', 'health': {'value': 5, 'descriptionIds': ['ALRT_COMPONENT_OK'], 'descriptions': ['OK']}},
+	{'id': 'disk_backslash', 'name': 'C:\\disks\\ ends in \\', 'health': {'value': 5, 'descriptionIds': ['ALRT_COMPONENT_OK'], 'descriptions': ['OK']}},
+	{'id': 'disk_entries', 'name': '"entries": [{"content": {}}]', 'health': {'value': 5, 'descriptionIds': ['ALRT_COMPONENT_OK'], 'descriptions': ['OK']}},
+	{'id': 'disk_unicode', 'name': u'caf\u00e9 \u2603 \U0001f4be', 'health': {'value': 10, 'descriptionIds': ['ALRT_DISK_DEGRADED'], 'descriptions': [u'd\u00e9grad\u00e9']}},
+	{'id': 'disk_empty', 'name': '', 'health': {'value': 25, 'descriptionIds': ['ALRT_DISK_FAULTED'], 'descriptions': ['The disk has faulted.\nReplace it.']}},
+]
+
+
+## Starts mock_unity.py with 'args' and returns (process, "address:port").
+#
+def startMock(args):
+	p = subprocess.Popen([sys.executable, MOCK] + args, stdout=subprocess.PIPE)
+	line = p.stdout.readline().decode('utf-8').strip()
+	if not line.startswith('listening on '):
+		p.kill()
+		p.wait()
+		raise RuntimeError('mock_unity.py did not start: %s' % line)
+	return p, line[len('listening on '):]
+
+
+def stopMock(p):
+	p.kill()
+	p.wait()
+	p.stdout.close()
+
+
+## Runs one check as Nagios would and returns (exit status, descid, output).
+#
+def runCheck(hostaddress, args):
+	p = subprocess.Popen([sys.executable, PLUGIN, '-H', hostaddress, '--transport', 'stdlib'] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	out, err = p.communicate()
+	out = out.decode('utf-8')
+	first = out.split('\n')[0]
+	descid = first.partition(': ')[2].partition(',')[0]
+	return p.returncode, descid, out
+
+
+class MockTestCase(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.tmpdir = tempfile.mkdtemp(prefix='test_check_unity-')
+		cls.certfile, cls.keyfile = mock_unity.selfSignedCert(cls.tmpdir)
+
+	@classmethod
+	def tearDownClass(cls):
+		shutil.rmtree(cls.tmpdir)
+
+	def setUp(self):
+		self.statedir = tempfile.mkdtemp(prefix='state-', dir=self.tmpdir)
+		self.mocks = []
+
+	def tearDown(self):
+		for p in self.mocks:
+			stopMock(p)
+
+	def startMock(self, args):
+		p, address = startMock(['--certfile', self.certfile, '--keyfile', self.keyfile] + args)
+		self.mocks.append(p)
+		return p, address
+
+	def stopMock(self, p):
+		self.mocks.remove(p)
+		stopMock(p)
+
+	## Replaces the mock listening on 'address' by one started with 'args', on
+	## the same port so that the plugin sees the same array.
+	#
+	def restartMock(self, p, address, args):
+		self.stopMock(p)
+		return self.startMock(['--port', address.rpartition(':')[2]] + args)
+
+
+class IterEntriesTest(MockTestCase):
+
+	def setUp(self):
+		MockTestCase.setUp(self)
+		fixtures = os.path.join(self.statedir, 'fixtures')
+		os.mkdir(fixtures)
+		with open(os.path.join(fixtures, 'disk.json'), 'w') as f:
+			json.dump({'entries': [{'content': content} for content in FIXTURE_DISKS]}, f)
+		p, self.address = self.startMock(['--fixtures', fixtures])
+		self.saved = dict(check_unity.REST)
+		check_unity.REST['transport'] = 'stdlib'
+		self.token, self.cookie = check_unity.login(self.address, 'user', 'password')
+		self.assertTrue(self.token)
+
+	def tearDown(self):
+		check_unity.logout(self.address, self.token, self.cookie)
+		check_unity.REST.update(self.saved)
+		MockTestCase.tearDown(self)
+
+	def fetchPage(self):
+		r = check_unity.restGet(self.address, '/api/types/disk/instances?fields=id,name,health&per_page=2000&with_entrycount=true&compact=true', self.token, self.cookie)
+		self.assertEqual(r.status_code, 200)
+		return r.text.encode('utf-8')
+
+	def entries(self, chunks):
+		head = {}
+		entries = [entry['content'] for entry in check_unity.iterEntries(chunks, head)]
+		return entries, head.get('entryCount')
+
+	def testWholeDocument(self):
+		self.assertEqual(self.entries([self.fetchPage()]), (FIXTURE_DISKS, len(FIXTURE_DISKS)))
+
+	def testEverySplit(self):
+		body = self.fetchPage()
+		for n in range(1, len(body)):
+			self.assertEqual(self.entries([body[:n], body[n:]]), (FIXTURE_DISKS, len(FIXTURE_DISKS)), 'split at %d: %r|%r' % (n, body[n - 10:n], body[n:n + 10]))
+
+	def testByteChunks(self):
+		body = self.fetchPage()
+		self.assertEqual(self.entries([body[i:i + 1] for i in range(len(body))]), (FIXTURE_DISKS, len(FIXTURE_DISKS)))
+
+	## Multi-byte UTF-8 (the mock only sends \u escapes) split between chunks.
+	#
+	def testSplitUtf8(self):
+		body = self.fetchPage().decode('utf-8')
+		body = json.dumps(json.loads(body), ensure_ascii=False).encode('utf-8')
+		self.assertTrue(len(body) > len(body.decode('utf-8')))
+		for n in range(1, len(body)):
+			self.assertEqual(self.entries([body[:n], body[n:]])[0], FIXTURE_DISKS, 'split at %d' % n)
+
+	def testTruncated(self):
+		body = self.fetchPage()
+		end = body.rindex(b']')
+		for n in (end, end - 1, body.index(b'disk_unicode')):
+			with self.assertRaises(ValueError):
+				self.entries([body[:n]])
+
+	def testPaginated(self):
+		saved = dict(check_unity.FETCH)
+		check_unity.FETCH['page_size'] = 2
+		try:
+			contents = list(check_unity.iterInstances(self.address, self.token, self.cookie, 'disk', 'id,name,health'))
+		finally:
+			check_unity.FETCH.update(saved)
+		self.assertEqual(contents, FIXTURE_DISKS)
+
+	def testHealth(self):
+		code, descid, out = runCheck(self.address, ['-u', 'user', '-p', 'password', '-m', 'disk', '--state-dir', self.statedir])
+		self.assertEqual((code, descid), (2, 'ALRT_DISK_FAULTED'), out)
+
+
+class RetryTest(MockTestCase):
+
+	def setUp(self):
+		MockTestCase.setUp(self)
+		p, self.address = self.startMock(['--error-rate', '1'])
+		self.saved = dict(check_unity.REST)
+		check_unity.REST.update({'transport': 'stdlib', 'retries': 2, 'backoff': 0.01})
+		check_unity.REQUEST_COUNTS = {}
+
+	def tearDown(self):
+		check_unity.REQUEST_COUNTS = None
+		check_unity.REST.update(self.saved)
+		MockTestCase.tearDown(self)
+
+	## A POST the array may have acted on (a metric query) is not sent twice.
+	#
+	def testIdempotentOnly(self):
+		for method, sent, kwargs in (('GET', 3, {}), ('DELETE', 3, {}), ('POST', 1, {'data': '{}'})):
+			check_unity.REQUEST_COUNTS.clear()
+			r = check_unity.restRequest(method, self.address, '/api/types/metricRealTimeQuery/instances', **kwargs)
+			self.assertEqual((method, r.status_code, check_unity.requestCount(self.address)), (method, 503, sent))
+
+
+## Stands in for the time module of check_unity: sleep() only moves the clock
+## on, and ends the run (ClockStopped) once 'seconds' have gone by.
+#
+class ClockStopped(BaseException):
+	pass
+
+
+class FakeClock(object):
+
+	def __init__(self, seconds):
+		self.now   = time.time()
+		self.until = self.now + seconds
+
+	def time(self):
+		return self.now
+
+	def sleep(self, seconds):
+		self.now += seconds
+		if self.now > self.until:
+			raise ClockStopped()
+
+	def __getattr__(self, name):
+		return getattr(time, name)
+
+
+## Largest number of 'stamps' within any 'seconds' long window, both ends
+## included.
+#
+def busiestWindow(stamps, seconds=60):
+	stamps = sorted(stamps)
+	return max([bisect.bisect_right(stamps, stamps[i] + seconds) - i for i in range(len(stamps))] or [0])
+
+
+class BudgetTest(MockTestCase):
+
+	def setUp(self):
+		MockTestCase.setUp(self)
+		self.clock = FakeClock(1800)
+		check_unity.time = self.clock
+
+	def tearDown(self):
+		check_unity.time = time
+		MockTestCase.tearDown(self)
+
+	## As many requests of cost 1 as the bucket lets through, every 0.5s for
+	## half an hour.
+	#
+	def sendAll(self, budget):
+		stamps = []
+		while self.clock.now < self.clock.until:
+			while budget.take(1):
+				stamps.append(self.clock.now)
+				budget.charge(1 - min(1, budget.capacity))
+			self.clock.now += 0.5
+		return stamps
+
+	def testRefill(self):
+		for per_minute in (1, 2, 5, 6, 7, 60, 600):
+			self.clock = check_unity.time = FakeClock(1800)
+			budget = check_unity.RequestBudget(per_minute)
+			stamps = self.sendAll(budget)
+			self.assertTrue(busiestWindow(stamps) <= per_minute, (per_minute, busiestWindow(stamps)))
+			# Once the burst is spent, the refill rate.
+			self.assertTrue(len(stamps) >= 28 * 60 * budget.rate, (per_minute, len(stamps)))
+
+	## A Collector polling modules of several pages each (and logging in)
+	## every 10 seconds, about 48 requests a minute, sends no more than
+	## --request-budget requests in any minute.
+	#
+	def testCollector(self):
+		p, address = self.startMock(['--count', 'disk=5', '--count', 'fan=5', '--count', 'battery=3'])
+		self.clock = check_unity.time = FakeClock(600)
+		stamps = []
+		transport = check_unity.TRANSPORTS['stdlib']
+		def counted(*args, **kwargs):
+			stamps.append(self.clock.now)
+			return transport(*args, **kwargs)
+
+		saved = (dict(check_unity.REST), dict(check_unity.FETCH), check_unity.REQUEST_COUNTS)
+		check_unity.REST['transport'] = 'stdlib'
+		check_unity.TRANSPORTS['stdlib'] = counted
+		check_unity.FETCH['page_size'] = 2
+		check_unity.REQUEST_COUNTS = {}
+		try:
+			args = argparse.Namespace(request_budget=30, adaptive=False, interval=10, workers=1)
+			collector = check_unity.Collector({'name': 'unity01', 'hostaddress': address, 'user': 'user', 'password': 'password'}, ['disk', 'fan', 'battery'], args)
+			try:
+				collector.run()
+			except ClockStopped:
+				pass
+			collector.logout()
+		finally:
+			check_unity.TRANSPORTS['stdlib'] = transport
+			check_unity.REST.update(saved[0])
+			check_unity.FETCH.update(saved[1])
+			check_unity.REQUEST_COUNTS = saved[2]
+
+		self.assertEqual(sorted(collector.results), ['battery', 'disk', 'fan'])
+		self.assertTrue(busiestWindow(stamps) <= 30, busiestWindow(stamps))
+		self.assertTrue(len(stamps) >= 9 * 25, len(stamps))
+
+
+class CollectorTest(MockTestCase):
+
+	## A failing 'published' callback is logged and the collector keeps
+	## polling instead of serving its last results forever.
+	#
+	def testPublishedFails(self):
+		p, address = self.startMock([])
+		calls = []
+		def published(collector):
+			calls.append(collector.refreshes)
+			if len(calls) == 1:
+				raise ValueError('render failed')
+
+		saved = (dict(check_unity.REST), sys.stderr)
+		check_unity.REST['transport'] = 'stdlib'
+		check_unity.time = FakeClock(300)
+		sys.stderr = stderr = StringIO()
+		try:
+			args = argparse.Namespace(request_budget=0, adaptive=False, interval=60, workers=1)
+			collector = check_unity.Collector({'name': 'unity01', 'hostaddress': address, 'user': 'user', 'password': 'password'}, ['disk'], args, published)
+			try:
+				collector.run()
+			except ClockStopped:
+				pass
+			collector.logout()
+		finally:
+			check_unity.time = time
+			check_unity.REST.update(saved[0])
+			sys.stderr = saved[1]
+
+		# One refresh a minute, the first one's failure included.
+		self.assertEqual(calls, list(range(1, 7)))
+		self.assertTrue('unity01: collector failed:' in stderr.getvalue() and 'ValueError: render failed' in stderr.getvalue(), stderr.getvalue())
+
+
+class ExporterTest(unittest.TestCase):
+
+	def testSpecialValues(self):
+		args = argparse.Namespace(request_budget=0)
+		collector = check_unity.Collector({'name': 'unity01', 'hostaddress': '127.0.0.1:1', 'user': 'user', 'password': 'password'}, ['lunlatency'], args)
+		perfdata = [('avg', float('nan'), 'us', None, None, 0, None), ('max', float('inf'), 'us', None, None, 0, None), ('min', -float('inf'), 'us', None, None, 0, None), ('total', 12.5, 'us', None, None, 0, None)]
+		collector.results['lunlatency'] = ((5, 'METRIC_OK', 'LUN response time', perfdata), 1700000000.0)
+		page = check_unity.renderMetrics([collector]).decode('utf-8')
+		values = dict(line.rsplit(' ', 1) for line in page.split('\n') if line.startswith('unity_perfdata'))
+		self.assertEqual(values, {
+			'unity_perfdata{array="unity01",label="avg",module="lunlatency",unit="us"}': 'NaN',
+			'unity_perfdata{array="unity01",label="max",module="lunlatency",unit="us"}': '+Inf',
+			'unity_perfdata{array="unity01",label="min",module="lunlatency",unit="us"}': '-Inf',
+			'unity_perfdata{array="unity01",label="total",module="lunlatency",unit="us"}': '12.5',
+		})
+		self.assertTrue('unity_result_timestamp_seconds{array="unity01",module="lunlatency"} 1700000000.0' in page, page)
+
+
+class MetricTest(MockTestCase):
+
+	def setUp(self):
+		MockTestCase.setUp(self)
+		self.saved = (dict(check_unity.REST), dict(check_unity.METRIC), check_unity.TRANSPORTS['stdlib'])
+		check_unity.REST['transport'] = 'stdlib'
+		check_unity.METRIC['state_dir'] = self.statedir
+		self.requests = []
+		transport = self.saved[2]
+		def logged(method, hostaddress, url, *args, **kwargs):
+			r = transport(method, hostaddress, url, *args, **kwargs)
+			if 'metricRealTimeQuery' in url:
+				self.requests.append((method, url.split('?')[0], r.status_code))
+			return r
+		check_unity.TRANSPORTS['stdlib'] = logged
+
+	def tearDown(self):
+		check_unity.logout(self.address, self.token, self.cookie)
+		check_unity.REST.update(self.saved[0])
+		check_unity.METRIC.update(self.saved[1])
+		check_unity.TRANSPORTS['stdlib'] = self.saved[2]
+		MockTestCase.tearDown(self)
+
+	def start(self, args):
+		p, self.address = self.startMock(args)
+		self.token, self.cookie = check_unity.login(self.address, 'user', 'password')
+		self.path = check_unity.stateFile(self.statedir, 'metricquery', self.address, 'spcpu') + '.json'
+
+	def check(self):
+		del self.requests[:]
+		result = check_unity.getMetric(self.address, self.token, self.cookie, 'spcpu')
+		descid = result[1]
+		if descid.startswith('METRIC_SPCPU_'):
+			descid = 'METRIC_SPCPU'
+		return descid, check_unity.readStateFile(self.path)['id'], list(self.requests)
+
+	def testReuse(self):
+		self.start(['--metric-step', '1'])
+		descid, id, requests = self.check()
+		self.assertEqual((descid, requests), ('METRIC_QUERY_PENDING', [('POST', '/api/types/metricRealTimeQuery/instances', 201)]))
+		for n in range(3):
+			time.sleep(1.1)
+			self.assertEqual(self.check(), ('METRIC_SPCPU', id, []))
+
+	## Checks further apart than 3 intervals without a new sample keep a
+	## query the array still has.
+	#
+	def testLongGap(self):
+		self.start(['--metric-step', '3600'])
+		descid, id, requests = self.check()
+		self.assertEqual(self.check()[:2], ('METRIC_SPCPU', id))
+		state = check_unity.readStateFile(self.path)
+		state['sampled'] -= 3 * state['interval']
+		check_unity.writeStateFile(self.path, state)
+		self.assertEqual(self.check(), ('METRIC_SPCPU', id, [('GET', '/api/instances/metricRealTimeQuery/%d' % id, 200)]))
+
+	## The array dropped the unread query (404): it is deleted as far as the
+	## array is concerned and a new one replaces it.
+	#
+	def testRecreate(self):
+		self.start(['--metric-step', '1', '--metric-query-ttl', '2'])
+		descid, id, requests = self.check()
+		time.sleep(3.2)
+		descid, newid, requests = self.check()
+		self.assertNotEqual(newid, id)
+		self.assertEqual(requests, [
+			('DELETE', '/api/instances/metricRealTimeQuery/%d' % id, 404),
+			('POST', '/api/types/metricRealTimeQuery/instances', 201),
+		])
+		time.sleep(1.1)
+		self.assertEqual(self.check(), ('METRIC_SPCPU', newid, []))
+
+	def testIntervalChanged(self):
+		self.start(['--metric-step', '1'])
+		descid, id, requests = self.check()
+		check_unity.METRIC['interval'] = 30
+		descid, newid, requests = self.check()
+		self.assertEqual(requests, [
+			('DELETE', '/api/instances/metricRealTimeQuery/%d' % id, 204),
+			('POST', '/api/types/metricRealTimeQuery/instances', 201),
+		])
+		self.assertEqual(check_unity.readStateFile(self.path)['interval'], 30)
+
+
+class TrendTest(unittest.TestCase):
+
+	WINDOW = 600
+
+	def setUp(self):
+		self.statedir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.statedir)
+		self.settings = {'window': self.WINDOW, 'interval': 60}
+		# 24 windows of 10 samples; 'c' only has samples in the first 6.
+		rnd = random.Random(1)
+		self.start = 1700006400
+		self.half = self.start + 12 * self.WINDOW
+		self.samples = {'a': [], 'b': [], 'c': []}
+		for i in range(240):
+			stamp = self.start + i * 60
+			self.samples['a'].append((stamp, rnd.lognormvariate(2, 1)))
+			self.samples['b'].append((stamp, rnd.uniform(0, 100)))
+			if i < 60:
+				self.samples['c'].append((stamp, rnd.uniform(1000, 2000)))
+
+	## The samples from 'start' on, as readTrend() returns them.
+	def series(self, start):
+		series = check_unity.Series(max)
+		for name, samples in sorted(self.samples.items()):
+			for stamp, value in samples:
+				if stamp >= start:
+					series.add(stamp, [(name, value)])
+		series.sort()
+		return series
+
+	## Two checks: the first 12 windows, then the rest.
+	def store(self):
+		store = check_unity.TrendStore(self.settings, self.start)
+		series = self.series(self.start)
+		store.append([row for row in check_unity.summarizeSeries(series, self.WINDOW) if row[0] < self.half], series, self.half)
+		series = self.series(store.end())
+		store.append(check_unity.summarizeSeries(series, self.WINDOW), series, self.half + 12 * self.WINDOW)
+		return store
+
+	## Exact nearest-rank percentiles of the samples from 'start' on.
+	def exact(self, name, start):
+		values = sorted(v for stamp, v in self.samples[name] if stamp >= start)
+		return [values[int(round((len(values) - 1) * p / 100.0))] for p in check_unity.TREND_PERCENTILES]
+
+	def assertPercentiles(self, overall, start):
+		self.assertEqual([row[1] for row in overall], sorted(name for name in self.samples if self.samples[name][-1][0] >= start))
+		for row in overall:
+			values = [v for stamp, v in self.samples[row[1]] if stamp >= start]
+			self.assertEqual(row[2:4], (len(values), min(values)))
+			self.assertAlmostEqual(row[4], sum(values) / len(values))
+			self.assertEqual(row[5], max(values))
+			for found, exact in zip(row[6], self.exact(row[1], start)):
+				self.assertTrue(abs(found - exact) <= exact * 0.011, (row[1], found, exact))
+
+	def testPercentiles(self):
+		store = self.store()
+		self.assertEqual(store.end(), self.start + 24 * self.WINDOW)
+		self.assertEqual(store.rows(), check_unity.summarizeSeries(self.series(self.start), self.WINDOW))
+		self.assertPercentiles(store.overall([], self.series(store.end()), store.end()), self.start)
+
+	## Rows and samples not stored yet count as if they were.
+	def testPending(self):
+		store = check_unity.TrendStore(self.settings, self.start)
+		series = self.series(self.start)
+		store.append([row for row in check_unity.summarizeSeries(series, self.WINDOW) if row[0] < self.half], series, self.half)
+		series = self.series(store.end())
+		self.assertPercentiles(store.overall(check_unity.summarizeSeries(series, self.WINDOW), series, store.end()), self.start)
+
+	def testTrim(self):
+		store = self.store()
+		oldest = self.start + 8 * self.WINDOW
+		store.trim(oldest)
+		self.assertEqual(store.since, oldest)
+		self.assertEqual(list(store.starts), list(range(oldest, oldest + 16 * self.WINDOW, self.WINDOW)))
+		# 'c' had no sample left.
+		self.assertEqual(sorted(store.objects), ['a', 'b'])
+		for name, obj in store.objects.items():
+			buckets = [check_unity.trendBucket(v) for stamp, v in self.samples[name] if stamp >= oldest]
+			self.assertEqual(list(obj['samples']), buckets)
+			self.assertEqual(sum(obj['histogram']), len(buckets))
+			self.assertEqual([obj['histogram'][b] for b in set(buckets)], [buckets.count(b) for b in set(buckets)])
+		self.assertPercentiles(store.overall([], self.series(store.end()), store.end()), oldest)
+		# Within the first window left, nothing more goes.
+		store.trim(oldest + 1)
+		self.assertEqual(len(store.starts), 16)
+
+	def testSaveLoad(self):
+		store = self.store()
+		path = os.path.join(self.statedir, 'trend.dat')
+		store.save(path)
+		self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+		loaded = check_unity.TrendStore.load(path, self.settings)
+		self.assertEqual((loaded.since, list(loaded.starts), loaded.rows()), (store.since, list(store.starts), store.rows()))
+		for name, obj in store.objects.items():
+			self.assertEqual((loaded.objects[name]['samples'], loaded.objects[name]['histogram']), (obj['samples'], obj['histogram']))
+		self.assertEqual(loaded.overall([], self.series(store.end()), loaded.end()), store.overall([], self.series(store.end()), store.end()))
+		self.assertTrue(check_unity.TrendStore.load(path, dict(self.settings, window=3600)) is None)
+		self.assertTrue(check_unity.TrendStore.load(path + '.missing', self.settings) is None)
+
+
+class AlertTest(MockTestCase):
+
+	## The mock raises an alert every 0.2s. Its timestamps have whole
+	## seconds, so about five alerts share each one.
+	#
+	def setUp(self):
+		MockTestCase.setUp(self)
+		p, self.address = self.startMock(['--alerts', '3', '--alert-every', '0.2'])
+		self.saved = (dict(check_unity.REST), dict(check_unity.METRIC))
+		check_unity.REST['transport'] = 'stdlib'
+		check_unity.METRIC['state_dir'] = self.statedir
+		self.token, self.cookie = check_unity.login(self.address, 'user', 'password')
+		self.path = check_unity.stateFile(self.statedir, 'alert', self.address) + '.json'
+
+	def tearDown(self):
+		check_unity.logout(self.address, self.token, self.cookie)
+		check_unity.REST.update(self.saved[0])
+		check_unity.METRIC.update(self.saved[1])
+		MockTestCase.tearDown(self)
+
+	def check(self):
+		result = check_unity.getAlert(self.address, self.token, self.cookie)
+		return result, check_unity.readStateFile(self.path)
+
+	## Number of the newest alert (alert_<n>) of a cursor.
+	def newest(self, cursor):
+		return max(int(id.rpartition('_')[2]) for id in cursor['ids'])
+
+	def testFirstRun(self):
+		result, cursor = self.check()
+		self.assertEqual(result[1], 'NO_NEW_ALERTS')
+		self.assertEqual(result[3][0][1], 0)
+		self.assertEqual(self.newest(cursor), 2)
+
+	## Every alert is reported by exactly one check, the ones sharing the
+	## timestamp of the cursor included.
+	#
+	def testEachAlertOnce(self):
+		result, cursor = self.check()
+		first = self.newest(cursor)
+		reported = 0
+		ties = 0
+		for n in range(12):
+			time.sleep(0.15)
+			result, cursor = self.check()
+			reported += result[3][0][1]
+			ties = max(ties, len(cursor['ids']))
+			if result[3][0][1]:
+				self.assertTrue(result[1].startswith('14:6000'), result)
+		self.assertTrue(ties > 1, cursor)
+		self.assertTrue(self.newest(cursor) - first >= 8, cursor)
+		self.assertEqual(reported, self.newest(cursor) - first)
+
+
+class PassiveTest(MockTestCase):
+
+	## A description from the array must not end the external command and
+	## smuggle in one of its own.
+	#
+	def testCommandFileNewline(self):
+		fixtures = os.path.join(self.statedir, 'fixtures')
+		os.mkdir(fixtures)
+		with open(os.path.join(fixtures, 'disk.json'), 'w') as f:
+			json.dump({'entries': [{'content': {'id': 'disk_0', 'health': {'value': 25, 'descriptionIds': ['ALRT_DISK_FAULTED'], 'descriptions': ['faulted.\r\n[1] DISABLE_NOTIFICATIONS']}}}]}, f)
+		p, address = self.startMock(['--fixtures', fixtures])
+		command = os.path.join(self.statedir, 'nagios.cmd')
+		open(command, 'w').close()
+
+		code, descid, out = runCheck(address, ['-u', 'user', '-p', 'password', '-m', 'disk', '--state-dir', self.statedir, '--passive-command-file', command, '--passive-host', 'unity01'])
+		self.assertEqual(code, 2, out)
+		with open(command, 'rb') as f:
+			lines = f.read().decode('utf-8').split('\n')
+		self.assertEqual(len(lines), 2, lines)
+		self.assertTrue(lines[0].endswith(';unity01;disk;2;CRITICAL: ALRT_DISK_FAULTED,faulted.\\n[1] DISABLE_NOTIFICATIONS,25'), lines[0])
+		self.assertEqual(lines[1], '')
+
+
+class StateDirTest(MockTestCase):
+
+	def setUp(self):
+		MockTestCase.setUp(self)
+		p, self.address = self.startMock([])
+		os.chmod(self.statedir, 0o777)
+
+	def check(self, args):
+		return runCheck(self.address, ['-u', 'user', '-p', 'password', '--state-dir', self.statedir] + args)[:2]
+
+	## A directory other users can write to is only refused when the run keeps
+	## state in it.
+	#
+	def testUnsafe(self):
+		self.assertEqual(self.check(['-m', 'disk']), (0, 'ALRT_COMPONENT_OK'))
+		self.assertEqual(self.check(['-m', 'disk', '--breaker-threshold', '3']), (3, 'UNSAFE_STATE_DIR'))
+		self.assertEqual(self.check(['-m', 'disk', '--cache-ttl', '60']), (3, 'UNSAFE_STATE_DIR'))
+		self.assertEqual(self.check(['-m', 'alert']), (3, 'UNSAFE_STATE_DIR'))
+		self.assertEqual(os.listdir(self.statedir), [])
+
+		os.chmod(self.statedir, 0o700)
+		self.assertEqual(self.check(['-m', 'disk', '--breaker-threshold', '3']), (0, 'ALRT_COMPONENT_OK'))
+
+
+class SnapshotTest(MockTestCase):
+
+	def check(self, address, args):
+		code, descid, out = runCheck(address, ['-u', 'user', '-p', 'password', '-m', 'disk,fan', '--state-dir', self.statedir] + args)
+		return dict((line.split(': ')[0], line.split(': ', 2)[2]) for line in out.split('\n')[1:] if line)
+
+	def testDiff(self):
+		p, address = self.startMock(['--count', 'disk=3', '--count', 'fan=2'])
+		self.assertEqual(self.check(address, ['--snapshot'])['snapshot'], 'SNAPSHOT_RECORDED,Recorded 5 components of disk, fan,5')
+		self.assertEqual(self.check(address, ['--snapshot'])['snapshot'], 'SNAPSHOT_UNCHANGED,No change in 5 components,5')
+
+		p, address = self.restartMock(p, address, ['--count', 'disk=4', '--count', 'fan=2', '--health', 'fan=25'])
+		self.assertEqual(self.check(address, ['--snapshot'])['snapshot'], 'SNAPSHOT_CHANGED,1 new, 0 removed, 1 changed of 6 components: disk +disk_3(5), fan fan_1 5->25,5')
+
+		# A component that disappeared is a WARNING.
+		p, address = self.restartMock(p, address, ['--count', 'disk=2', '--count', 'fan=2', '--health', 'fan=25'])
+		self.assertEqual(self.check(address, ['--snapshot'])['snapshot'], 'SNAPSHOT_CHANGED,0 new, 2 removed, 0 changed of 4 components: disk -disk_2, disk -disk_3,10')
+
+	## Cached results have no components: with --snapshot and --history the
+	## health modules are read from the array on every check.
+	#
+	def testResponseCache(self):
+		p, address = self.startMock(['--count', 'disk=3', '--count', 'fan=2'])
+		args = ['--snapshot', '--history', '--cache-ttl', '600']
+		self.assertEqual(self.check(address, args)['snapshot'], 'SNAPSHOT_RECORDED,Recorded 5 components of disk, fan,5')
+		self.assertEqual(self.check(address, args)['snapshot'], 'SNAPSHOT_UNCHANGED,No change in 5 components,5')
+
+		p, address = self.restartMock(p, address, ['--count', 'disk=3', '--count', 'fan=2', '--health', 'disk=25'])
+		results = self.check(address, args)
+		self.assertEqual(results['disk'], 'ALRT_COMPONENT_FAULTED,The component has faulted.,25')
+		self.assertEqual(results['snapshot'], 'SNAPSHOT_CHANGED,0 new, 0 removed, 1 changed of 5 components: disk disk_2 5->25,5')
+
+
+class BreakerTest(MockTestCase):
+
+	COOLDOWN = 2
+
+	def setUp(self):
+		MockTestCase.setUp(self)
+		p, self.address = self.startMock(['-u', 'user', '-p', 'secret'])
+		self.path = check_unity.stateFile(self.statedir, 'breaker', self.address) + '.json'
+
+	def check(self, password):
+		code, descid, out = runCheck(self.address, ['-u', 'user', '-p', password, '-m', 'fan', '--state-dir', self.statedir, '--breaker-threshold', '2', '--breaker-cooldown', str(self.COOLDOWN)])
+		return descid
+
+	def waitCooldown(self):
+		time.sleep(self.COOLDOWN + 0.2)
+
+	def testOpenProbeClose(self):
+		# Closed: every failure goes to the array, the second one opens.
+		self.assertEqual(self.check('wrong'), 'COULD_NOT_LOGIN')
+		self.assertEqual(check_unity.readStateFile(self.path)['failures'], 1)
+		self.assertEqual(self.check('wrong'), 'COULD_NOT_LOGIN')
+		self.assertEqual(self.check('secret'), 'CIRCUIT_OPEN')
+
+		# Half-open: the probe fails and the cool-down starts again.
+		self.waitCooldown()
+		self.assertEqual(self.check('wrong'), 'COULD_NOT_LOGIN')
+		self.assertEqual(self.check('secret'), 'CIRCUIT_OPEN')
+
+		# Half-open: the probe succeeds and closes the breaker.
+		self.waitCooldown()
+		self.assertEqual(self.check('secret'), 'ALRT_COMPONENT_OK')
+		self.assertFalse(os.path.exists(self.path))
+		self.assertEqual(self.check('wrong'), 'COULD_NOT_LOGIN')
+		self.assertEqual(self.check('secret'), 'ALRT_COMPONENT_OK')
+
+	def testSingleProbe(self):
+		self.assertEqual(self.check('wrong'), 'COULD_NOT_LOGIN')
+		self.assertEqual(self.check('wrong'), 'COULD_NOT_LOGIN')
+		self.waitCooldown()
+
+		# Another check claimed the probe: this one keeps short-circuiting.
+		self.assertEqual(check_unity.breakerCheck(self.path, 2, self.COOLDOWN), None)
+		self.assertEqual(self.check('secret'), 'CIRCUIT_OPEN')
+
+		# A probe that never reports back is given up after the cool-down.
+		self.waitCooldown()
+		self.assertEqual(self.check('secret'), 'ALRT_COMPONENT_OK')
+		self.assertFalse(os.path.exists(self.path))
+
+
+class FlapTest(MockTestCase):
+
+	def testFlapPercent(self):
+		self.assertEqual(check_unity.flapPercent([0, 2, 0, 2]), 0)
+		self.assertEqual(check_unity.flapPercent([0] * check_unity.FLAP_WINDOW), 0)
+		self.assertAlmostEqual(check_unity.flapPercent([0, 2] * 10 + [0]), 100)
+		# Recent changes weigh more than old ones.
+		self.assertTrue(check_unity.flapPercent([0, 2, 2, 2, 2]) < check_unity.flapPercent([0, 0, 0, 0, 2]))
+		self.assertAlmostEqual(check_unity.flapPercent([0, 2, 2, 2, 2]), 20)
+		self.assertAlmostEqual(check_unity.flapPercent([0, 0, 0, 0, 2]), 30)
+
+	## The array alternates between healthy and a faulted disk (the mock is
+	## restarted on the same port), then stays healthy. With the default
+	## --flap-high 50 and --flap-low 25 the module flaps from the 5th check
+	## (4 changes in 5) and stops at the 15th (24% weighted), reporting the
+	## faulted disk meanwhile.
+	#
+	def testWindow(self):
+		p, address = self.startMock([])
+		faulted = False
+		seen = []
+		for fault in [False, True, False, True] + [False] * 12:
+			if fault != faulted:
+				p, address = self.restartMock(p, address, ['--health', 'disk=25'] if fault else [])
+				faulted = fault
+			code, descid, out = runCheck(address, ['-u', 'user', '-p', 'password', '-m', 'disk', '--state-dir', self.statedir, '--history'])
+			seen.append((code, descid))
+
+		expected  = [(0, 'ALRT_COMPONENT_OK'), (2, 'ALRT_COMPONENT_FAULTED')] * 2
+		expected += [(2, 'FLAPPING')] * 10
+		expected += [(0, 'ALRT_COMPONENT_OK')] * 2
+		self.assertEqual(seen, expected)
+
+		code, descid, out = runCheck(address, ['--history-query', '1', '--state-dir', self.statedir])
+		self.assertEqual(code, 0, out)
+		changes = [line.split()[3:] for line in out.split('\n') if line]
+		down, up = ['disk', '-', 'OK(5)', '->', 'CRITICAL(25)'], ['disk', '-', 'CRITICAL(25)', '->', 'OK(5)']
+		self.assertEqual([change for change in changes if change[1] == '-'], [down, up, down, up], out)
+		self.assertEqual(len([change for change in changes if change[1] != '-']), 4, out)
+
+
+if __name__ == '__main__':
+	unittest.main()